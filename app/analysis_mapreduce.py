@@ -0,0 +1,187 @@
+"""Análise map-reduce para documentos longos.
+
+Todos os chunks do documento são divididos em grupos de cerca de
+``ANALYZE_GROUP_SIZE``, com fronteiras definidas pelo conteúdo. Cada grupo é
+analisado em paralelo (etapa *map*) e o resultado parcial fica em
+``doc_analysis_parts``, chaveado pelo hash dos chunks do grupo — ao reanalisar após uma edição pequena, só os grupos
+alterados voltam ao modelo. A etapa *reduce* junta as listas parciais e
+condensa os resumos em níveis, de ``ANALYZE_REDUCE_FANIN`` em
+``ANALYZE_REDUCE_FANIN``, até um resumo final.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence
+
+import psycopg
+from psycopg.rows import dict_row
+from psycopg.types.json import Json
+
+from analyzers import combined
+
+DB_URL = os.getenv("DATABASE_URL")
+GROUP_SIZE = int(os.getenv("ANALYZE_GROUP_SIZE", "20"))
+MAP_CONCURRENCY = int(os.getenv("ANALYZE_MAP_CONCURRENCY", "4"))
+REDUCE_FANIN = int(os.getenv("ANALYZE_REDUCE_FANIN", "8"))
+LIST_SECTIONS = ("findings", "pros", "cons", "timeline", "divergences", "convergences")
+logger = logging.getLogger("sophia.analysis")
+
+
+def _chunk_key(c: Dict[str, Any]) -> str:
+    return c.get("chunk_hash") or hashlib.sha256((c.get("content") or "").encode("utf-8", errors="ignore")).hexdigest()
+
+
+def group_hash(path: str, group: Sequence[Dict[str, Any]]) -> str:
+    """Hash do conteúdo do grupo; a posição dos chunks no documento não entra."""
+
+    h = hashlib.sha256(path.encode("utf-8", errors="ignore"))
+    for c in group:
+        h.update(f"\n{_chunk_key(c)}".encode("utf-8"))
+    return h.hexdigest()
+
+
+def split_groups(ctx: List[Dict[str, Any]], size: int = GROUP_SIZE) -> List[List[Dict[str, Any]]]:
+    """Agrupa por fronteiras definidas pelo conteúdo (média de ``size`` chunks).
+
+    Um grupo termina no chunk cujo hash cai no divisor, respeitando o mínimo
+    de ``size // 2`` e o máximo de ``2 * size`` chunks. Inserir ou remover um
+    chunk só desloca a fronteira do grupo onde ele está; os demais grupos
+    mantêm os mesmos chunks e, portanto, o mesmo ``group_hash``.
+    """
+
+    size = max(1, size)
+    lo, hi = max(1, size // 2), 2 * size
+    divisor = max(1, size - lo + 1)
+    groups: List[List[Dict[str, Any]]] = []
+    cur: List[Dict[str, Any]] = []
+    for c in ctx:
+        cur.append(c)
+        if len(cur) >= hi or (len(cur) >= lo and int(_chunk_key(c)[:8], 16) % divisor == 0):
+            groups.append(cur)
+            cur = []
+    if cur:
+        groups.append(cur)
+    return groups
+
+
+def _load_parts(hashes: List[str]) -> Dict[str, Dict[str, Any]]:
+    try:
+        with psycopg.connect(DB_URL) as conn, conn.cursor(row_factory=dict_row) as cur:
+            cur.execute(
+                "SELECT group_hash, result FROM doc_analysis_parts WHERE group_hash = ANY(%s)",
+                (hashes,),
+            )
+            return {r["group_hash"]: r["result"] for r in cur.fetchall()}
+    except psycopg.Error as exc:  # pragma: no cover - fallback defensivo
+        logger.warning("Não foi possível ler análises parciais: %s", exc)
+        return {}
+
+
+def _save_parts(path: str, parts: List[tuple]) -> None:
+    try:
+        with psycopg.connect(DB_URL) as conn, conn.cursor() as cur:
+            if parts:
+                cur.executemany(
+                    """INSERT INTO doc_analysis_parts(group_hash, path, group_no, result, created_at)
+                           VALUES(%s,%s,%s,%s,now())
+                           ON CONFLICT (group_hash) DO UPDATE SET
+                             group_no=EXCLUDED.group_no, result=EXCLUDED.result, created_at=now()""",
+                    [(h, path, no, Json(res)) for h, no, res in parts],
+                )
+            conn.commit()
+    except psycopg.Error as exc:  # pragma: no cover - fallback defensivo
+        logger.warning("Não foi possível salvar análises parciais: %s", exc)
+
+
+def _prune_parts(path: str, keep: List[str]) -> None:
+    try:
+        with psycopg.connect(DB_URL) as conn, conn.cursor() as cur:
+            cur.execute(
+                "DELETE FROM doc_analysis_parts WHERE path=%s AND NOT (group_hash = ANY(%s))",
+                (path, keep),
+            )
+            conn.commit()
+    except psycopg.Error as exc:  # pragma: no cover - fallback defensivo
+        logger.warning("Não foi possível remover análises parciais antigas: %s", exc)
+
+
+def _merge_lists(parts: Sequence[Dict[str, Any]]) -> Dict[str, List[Any]]:
+    out: Dict[str, List[Any]] = {s: [] for s in LIST_SECTIONS}
+    seen: Dict[str, set] = {s: set() for s in LIST_SECTIONS}
+    for part in parts:
+        for s in LIST_SECTIONS:
+            for it in part.get(s) or []:
+                key = " ".join(str(v) for k, v in sorted(it.items()) if k != "support").lower()
+                if key in seen[s]:
+                    continue
+                seen[s].add(key)
+                out[s].append(it)
+    out["timeline"].sort(key=lambda ev: ev.get("date") or "")
+    return out
+
+
+def _reduce_summaries(summaries: List[str], model: str) -> Dict[str, Any]:
+    """Condensa resumos parciais em níveis até caber numa chamada final."""
+
+    fanin = max(2, REDUCE_FANIN)
+    level = [s for s in summaries if s]
+    with ThreadPoolExecutor(max_workers=max(1, MAP_CONCURRENCY), thread_name_prefix="reduce") as ex:
+        while len(level) > fanin:
+            batches = [level[i : i + fanin] for i in range(0, len(level), fanin)]
+            futs = [
+                ex.submit(combined.analyze_sections, _summaries_ctx(b), ["summary"], model)
+                for b in batches
+            ]
+            level = [f.result().get("summary", "") for f in futs]
+    return combined.analyze_sections(
+        _summaries_ctx(level), ["summary", "divergences", "convergences"], model
+    )
+
+
+def _summaries_ctx(summaries: Sequence[str]) -> str:
+    return "\n\n".join(f"[Parte {i}] {s}" for i, s in enumerate(summaries, 1))
+
+
+def analyze_long(ctx: List[Dict[str, Any]], model: str) -> Dict[str, Any]:
+    """Analisa todos os chunks em grupos e devolve as seções no formato combinado."""
+
+    path = ctx[0]["path"]
+    groups = split_groups(ctx)
+    hashes = [group_hash(path, g) for g in groups]
+    cached = _load_parts(hashes)
+    todo = [(no, g, h) for no, (g, h) in enumerate(zip(groups, hashes)) if h not in cached]
+    logger.info("Map-reduce %s: %s grupos, %s em cache", path, len(groups), len(groups) - len(todo))
+
+    # Um grupo que falha interrompe a análise (nada é gravado em doc_analysis);
+    # os grupos que deram certo ficam salvos para a próxima tentativa.
+    fresh: List[tuple] = []
+    error: Optional[Exception] = None
+    if todo:
+        with ThreadPoolExecutor(max_workers=max(1, MAP_CONCURRENCY), thread_name_prefix="map") as ex:
+            futs = [(no, h, ex.submit(combined.analyze, g, model)) for no, g, h in todo]
+            for no, h, fut in futs:
+                try:
+                    res = fut.result()
+                except Exception as exc:
+                    error = error or exc
+                    continue
+                cached[h] = res
+                fresh.append((h, no, res))
+    _save_parts(path, fresh)
+    if error is not None:
+        raise error
+    _prune_parts(path, hashes)
+
+    parts = [cached[h] for h in hashes]
+    if len(parts) == 1:
+        return parts[0]
+    merged: Dict[str, Any] = _merge_lists(parts)
+    reduced = _reduce_summaries([p.get("summary", "") for p in parts], model)
+    merged["summary"] = reduced.get("summary", "")
+    merged["divergences"] = reduced.get("divergences", []) + merged["divergences"]
+    merged["convergences"] = reduced.get("convergences", []) + merged["convergences"]
+    return merged
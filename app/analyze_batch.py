@@ -0,0 +1,140 @@
+"""Análise em lote de documentos, executada no próprio processo.
+
+Os documentos são analisados em paralelo (``ANALYZE_CONCURRENCY``) e os
+resultados são gravados em blocos em ``doc_analysis``. Cada análise guarda o
+``source_hash`` dos chunks usados (com o modo e ``ANALYSIS_VERSION``);
+documentos cujo hash não mudou desde a última análise são pulados, o que
+torna o lote retomável.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Optional
+
+import psycopg
+from psycopg.rows import dict_row
+
+import model_registry
+from analyze_doc import (
+    ANALYSIS_MODE,
+    ANALYSIS_MODES,
+    ANALYZE_K,
+    DB_URL,
+    analyze_context,
+    context_fingerprint,
+    context_limit,
+    load_context_by_path,
+    upsert_analyses,
+)
+
+ANALYZE_CONCURRENCY = int(os.getenv("ANALYZE_CONCURRENCY", "4"))
+ANALYZE_FLUSH_EVERY = int(os.getenv("ANALYZE_FLUSH_EVERY", "20"))
+logger = logging.getLogger("sophia.analysis")
+
+
+def iter_paths(cur, prefix: Optional[str], limit: int) -> List[str]:
+    if prefix:
+        cur.execute(
+            "SELECT DISTINCT path FROM docs WHERE path LIKE %s ORDER BY path ASC LIMIT %s",
+            (prefix.rstrip("/") + "%", limit),
+        )
+    else:
+        cur.execute(
+            "SELECT path FROM (SELECT path, min(id) AS mid FROM docs GROUP BY path ORDER BY mid DESC LIMIT %s) t",
+            (limit,),
+        )
+    return [r["path"] for r in cur.fetchall()]
+
+
+def _analyzed_hashes(cur, paths: List[str]) -> Dict[str, Optional[str]]:
+    if not paths:
+        return {}
+    cur.execute("SELECT path, source_hash FROM doc_analysis WHERE path = ANY(%s)", (paths,))
+    return {r["path"]: r["source_hash"] for r in cur.fetchall()}
+
+
+def run(
+    prefix: Optional[str] = None,
+    limit: int = 50,
+    k: int = ANALYZE_K,
+    concurrency: int = ANALYZE_CONCURRENCY,
+    force: bool = False,
+    mode: str = ANALYSIS_MODE,
+    progress: Optional[Callable[[int, int], None]] = None,
+    should_stop: Optional[Callable[[], bool]] = None,
+) -> Dict[str, Any]:
+    """Analisa os documentos pendentes.
+
+    ``progress(feitos, total)`` é chamado a cada documento concluído e
+    ``should_stop()`` permite interromper o lote; as análises já concluídas
+    são gravadas antes de sair.
+    """
+
+    with psycopg.connect(DB_URL, row_factory=dict_row) as conn:
+        with conn.cursor() as cur:
+            paths = iter_paths(cur, prefix, limit)
+            done = {} if force else _analyzed_hashes(cur, paths)
+        # Não segura a transação (xmin e locks) durante as chamadas ao LLM.
+        conn.commit()
+
+        def analyze_path(path: str) -> Optional[Dict[str, Any]]:
+            # O contexto é carregado no worker: só ``concurrency`` documentos ficam em memória.
+            with psycopg.connect(DB_URL, row_factory=dict_row) as c, c.cursor() as cur:
+                ctx = load_context_by_path(cur, path, k=context_limit(mode, k))
+            if not ctx or done.get(path) == context_fingerprint(ctx, mode):
+                return None
+            return analyze_context(ctx, model, mode)
+
+        ok = failed = skipped = 0
+        buffer: List[Dict[str, Any]] = []
+        with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="analyze") as ex:
+            model = model_registry.gen_model()
+            futures = {ex.submit(analyze_path, p): p for p in paths}
+            for fut in as_completed(futures):
+                try:
+                    res = fut.result()
+                except Exception as exc:
+                    failed += 1
+                    logger.warning("Falha ao analisar %s: %s", futures[fut], exc)
+                    print(f"{futures[fut]}: {exc}", file=sys.stderr)
+                else:
+                    if res is None:
+                        skipped += 1
+                    else:
+                        buffer.append(res)
+                    if len(buffer) >= ANALYZE_FLUSH_EVERY:
+                        upsert_analyses(conn, buffer)
+                        ok += len(buffer)
+                        buffer = []
+                if progress:
+                    progress(ok + len(buffer) + failed + skipped, len(paths))
+                if should_stop and should_stop():
+                    ex.shutdown(wait=False, cancel_futures=True)
+                    break
+        upsert_analyses(conn, buffer)
+        ok += len(buffer)
+
+    return {"ok": ok, "total": len(paths), "skipped": skipped, "failed": failed}
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="Analisar documentos em lote")
+    ap.add_argument("--prefix", help="PREFIXO de caminho para filtrar", default=None)
+    ap.add_argument("--limit", type=int, default=50)
+    ap.add_argument("--k", type=int, default=ANALYZE_K)
+    ap.add_argument("--concurrency", type=int, default=ANALYZE_CONCURRENCY, help="Documentos simultâneos")
+    ap.add_argument("--force", action="store_true", help="Reanalisar mesmo sem mudanças nos chunks")
+    ap.add_argument("--mode", choices=ANALYSIS_MODES, default=ANALYSIS_MODE)
+    a = ap.parse_args(argv)
+    print(json.dumps(run(a.prefix, a.limit, a.k, a.concurrency, a.force, a.mode), ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover - CLI entry
+    sys.exit(main())
@@ -0,0 +1,230 @@
+"""Análise estruturada de um documento indexado em ``docs``.
+
+Carrega os primeiros ``k`` chunks do documento, executa os analisadores
+(prós/contras, resumo/achados, linha do tempo e divergências) — numa única
+chamada estruturada ou um por um — e grava o resultado em ``doc_analysis``.
+As funções ficam expostas para que o lote (``analyze_batch``) reutilize o
+mesmo fluxo sem abrir um subprocesso por documento.
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+import psycopg
+from dotenv import load_dotenv
+from psycopg.rows import dict_row
+from psycopg.types.json import Json
+
+import model_registry
+from analysis_mapreduce import analyze_long
+from analyzers import combined
+from analyzers.argument_miner import pros_cons, summary_findings
+from analyzers.contradiction_finder import detect as detect_contra
+from analyzers.legal_extractors import extract_meta
+from analyzers.timeline_builder import build as build_timeline
+
+load_dotenv(Path(__file__).with_name(".env"), override=True)
+DB_URL = os.getenv("DATABASE_URL")
+ANALYZE_K = int(os.getenv("ANALYZE_K", "40"))
+ANALYSIS_MODE = os.getenv("ANALYSIS_MODE", "combined")
+ANALYSIS_MODES = ("combined", "separate", "mapreduce")
+# Incrementar ao mudar prompts ou esquemas dos analisadores: invalida os checkpoints.
+ANALYSIS_VERSION = "1"
+logger = logging.getLogger("sophia.analysis")
+
+UPSERT_SQL = """
+INSERT INTO doc_analysis(doc_id,path,tipo,numero,data,orgao,tema,processo_sei,summary,pros,cons,
+                         findings,citations,timeline,divergences,source_hash,created_at)
+VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,now())
+ON CONFLICT(doc_id) DO UPDATE SET
+  path=EXCLUDED.path,tipo=EXCLUDED.tipo,numero=EXCLUDED.numero,data=EXCLUDED.data,orgao=EXCLUDED.orgao,
+  tema=EXCLUDED.tema,processo_sei=EXCLUDED.processo_sei,summary=EXCLUDED.summary,pros=EXCLUDED.pros,
+  cons=EXCLUDED.cons,findings=EXCLUDED.findings,citations=EXCLUDED.citations,timeline=EXCLUDED.timeline,
+  divergences=EXCLUDED.divergences,source_hash=EXCLUDED.source_hash,created_at=now()
+"""
+
+
+def context_limit(mode: str, k: Optional[int]) -> Optional[int]:
+    """No modo map-reduce o documento inteiro é analisado (sem ``LIMIT``)."""
+
+    return None if mode == "mapreduce" else k
+
+
+def load_context_by_path(cur, path: str, k: Optional[int] = ANALYZE_K) -> List[Dict[str, Any]]:
+    cur.execute(
+        "SELECT id, path, chunk_no, chunk_hash, content FROM docs WHERE path=%s ORDER BY chunk_no ASC LIMIT %s",
+        (path, k),
+    )
+    return [
+        {
+            "n": i + 1,
+            "id": r["id"],
+            "path": r["path"],
+            "chunk": r["chunk_no"],
+            "chunk_hash": r["chunk_hash"],
+            "content": r["content"],
+        }
+        for i, r in enumerate(cur.fetchall())
+    ]
+
+
+def load_context_by_docid(cur, doc_id: int, k: Optional[int] = ANALYZE_K) -> List[Dict[str, Any]]:
+    cur.execute("SELECT path FROM docs WHERE id=%s", (doc_id,))
+    r = cur.fetchone()
+    if not r:
+        return []
+    return load_context_by_path(cur, r["path"], k=k)
+
+
+def context_fingerprint(ctx: Iterable[Dict[str, Any]], mode: str = ANALYSIS_MODE) -> str:
+    """Hash estável dos ``chunk_hash`` usados, do modo e da versão (checkpoint do lote)."""
+
+    h = hashlib.sha256(f"{mode}:{ANALYSIS_VERSION}\n".encode("utf-8"))
+    for c in ctx:
+        h.update(f"{c['chunk']}:{c.get('chunk_hash') or ''}\n".encode("utf-8"))
+    return h.hexdigest()
+
+
+def _run_separate(ctx: List[Dict[str, Any]], model: str) -> Dict[str, Any]:
+    with ThreadPoolExecutor(max_workers=4, thread_name_prefix="analyzer") as ex:
+        f_pc = ex.submit(pros_cons, ctx, model)
+        f_sf = ex.submit(summary_findings, ctx, model)
+        f_tl = ex.submit(build_timeline, ctx, model)
+        f_contra = ex.submit(detect_contra, ctx, model)
+        return {
+            "pc": f_pc.result(),
+            "sf": f_sf.result(),
+            "tl": f_tl.result(),
+            "contra": f_contra.result(),
+        }
+
+
+def analyze_context(
+    ctx: List[Dict[str, Any]], model: Optional[str] = None, mode: str = ANALYSIS_MODE
+) -> Dict[str, Any]:
+    """Analisa o contexto e devolve a linha de ``doc_analysis``.
+
+    ``mode="combined"`` faz uma única chamada estruturada; ``"separate"``
+    executa os quatro analisadores em paralelo; ``"mapreduce"`` analisa o
+    documento inteiro em grupos de chunks e reduz os resultados parciais.
+    """
+
+    model = model or model_registry.gen_model()
+
+    if mode == "combined":
+        sections = combined.split_sections(combined.analyze(ctx, model))
+    elif mode == "mapreduce":
+        sections = combined.split_sections(analyze_long(ctx, model))
+    else:
+        sections = _run_separate(ctx, model)
+    text_all = " ".join([c["content"] or "" for c in ctx])
+    return {
+        "doc_id": ctx[0]["id"],
+        "path": ctx[0]["path"],
+        "meta": extract_meta(text_all, {}),
+        **sections,
+        "cites": [{"n": c["n"], "path": c["path"], "chunk": c["chunk"]} for c in ctx],
+        "source_hash": context_fingerprint(ctx, mode),
+    }
+
+
+def _analysis_params(res: Dict[str, Any]) -> tuple:
+    meta, pc, sf, tl = res["meta"], res["pc"], res["sf"], res["tl"]
+    return (
+        res["doc_id"],
+        res["path"],
+        meta.get("tipo"),
+        meta.get("numero"),
+        meta.get("data"),
+        meta.get("orgao"),
+        None,
+        None,
+        sf.get("summary", ""),
+        Json(pc.get("pros", [])),
+        Json(pc.get("cons", [])),
+        Json(sf.get("findings", [])),
+        Json(res["cites"]),
+        Json(tl.get("timeline", [])),
+        Json(res["contra"]),
+        res.get("source_hash"),
+    )
+
+
+def upsert_analyses(conn, results: List[Dict[str, Any]]) -> None:
+    """Grava várias análises numa única transação."""
+
+    if not results:
+        return
+    with conn.cursor() as cur:
+        cur.executemany(UPSERT_SQL, [_analysis_params(r) for r in results])
+    conn.commit()
+
+
+def upsert_analysis(conn, any_doc_id, path, meta, pc, sf, tl, contra, cites, source_hash=None):
+    upsert_analyses(
+        conn,
+        [
+            {
+                "doc_id": any_doc_id,
+                "path": path,
+                "meta": meta,
+                "pc": pc,
+                "sf": sf,
+                "tl": tl,
+                "contra": contra,
+                "cites": cites,
+                "source_hash": source_hash,
+            }
+        ],
+    )
+
+
+def analyze(
+    path: Optional[str] = None,
+    doc_id: Optional[int] = None,
+    k: int = ANALYZE_K,
+    mode: str = ANALYSIS_MODE,
+) -> Dict[str, Any]:
+    # Conexões curtas antes e depois das chamadas ao LLM, para não deixar uma
+    # transação ociosa aberta durante a análise.
+    k = context_limit(mode, k)
+    with psycopg.connect(DB_URL, row_factory=dict_row) as conn, conn.cursor() as cur:
+        ctx = load_context_by_path(cur, path, k=k) if path else load_context_by_docid(cur, doc_id, k=k)
+    if not ctx:
+        raise LookupError("Contexto vazio.")
+    res = analyze_context(ctx, mode=mode)
+    with psycopg.connect(DB_URL) as conn:
+        upsert_analyses(conn, [res])
+    return {"ok": True, "path": res["path"], "meta": res["meta"]}
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="Analisar um documento indexado")
+    ap.add_argument("--path", help="Caminho completo do documento")
+    ap.add_argument("--doc_id", type=int, help="ID de um chunk em docs")
+    ap.add_argument("--k", type=int, default=ANALYZE_K)
+    ap.add_argument("--mode", choices=ANALYSIS_MODES, default=ANALYSIS_MODE, help="Chamada única ou analisadores separados")
+    args = ap.parse_args(argv)
+    if not args.path and not args.doc_id:
+        print("Forneça --path ou --doc_id", file=sys.stderr)
+        return 2
+    try:
+        result = analyze(args.path, args.doc_id, args.k, args.mode)
+    except LookupError as exc:
+        print(str(exc), file=sys.stderr)
+        return 1
+    print(json.dumps(result, ensure_ascii=False, default=str))
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover - CLI entry
+    sys.exit(main())
@@ -0,0 +1,207 @@
+"""Análise combinada: uma única chamada estruturada para todas as seções.
+
+Os analisadores individuais (``argument_miner``, ``timeline_builder`` e
+``contradiction_finder``) enviam o mesmo contexto quatro vezes. Aqui o
+contexto é montado uma vez e o modelo devolve resumo, achados, prós/contras,
+linha do tempo e divergências no mesmo JSON. Cada seção é validada contra o
+esquema; apenas as seções inválidas são pedidas novamente.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import llm_gateway
+
+logger = logging.getLogger("sophia.analysis")
+
+QUOTE_CHARS = int(os.getenv("ANALYSIS_QUOTE_CHARS", "1200"))
+RETRIES = int(os.getenv("ANALYSIS_RETRIES", "2"))
+# Seções que podem faltar sem invalidar a análise.
+OPTIONAL_SECTIONS = ("divergences", "convergences")
+
+SYSTEM = (
+    "Você é analista jurídico-regulatório. Responda SÓ com base no CONTEXTO. "
+    "Cada item deve conter support=[{n,path,chunk}] apontando os trechos usados. "
+    "Se faltar base, escreva 'falta base' e deixe as listas vazias."
+)
+
+_SUPPORT = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "n": {"type": "integer"},
+            "path": {"type": "string"},
+            "chunk": {"type": "integer"},
+        },
+        "required": ["n", "path", "chunk"],
+        "additionalProperties": False,
+    },
+}
+
+
+def _items(**fields: Dict[str, Any]) -> Dict[str, Any]:
+    props = {**fields, "support": _SUPPORT}
+    return {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": props,
+            "required": list(props),
+            "additionalProperties": False,
+        },
+    }
+
+
+_STR = {"type": "string"}
+
+SECTION_SCHEMAS: Dict[str, Dict[str, Any]] = {
+    "summary": _STR,
+    "findings": _items(what=_STR, so_what=_STR),
+    "pros": _items(claim=_STR, why=_STR),
+    "cons": _items(claim=_STR, why=_STR),
+    "timeline": _items(date=_STR, event=_STR),
+    "divergences": _items(topic=_STR, views={"type": "array", "items": _STR}),
+    "convergences": _items(topic=_STR, consensus=_STR),
+}
+
+SECTION_PROMPTS = {
+    "summary": "summary: resumo crítico em 5-10 pontos.",
+    "findings": "findings: achados relevantes (what, so_what).",
+    "pros": "pros: argumentos favoráveis com justificativa (claim, why).",
+    "cons": "cons: argumentos contrários com justificativa (claim, why).",
+    "timeline": "timeline: eventos datados, data no formato YYYY-MM-DD (date, event).",
+    "divergences": "divergences: divergências objetivas entre os trechos (topic, views).",
+    "convergences": "convergences: convergências entre os trechos (topic, consensus).",
+}
+
+
+def _valid_support(items: Any) -> bool:
+    return isinstance(items, list) and all(
+        isinstance(s, dict) and isinstance(s.get("n"), int) for s in items
+    )
+
+
+def _valid_list(*keys: str) -> Callable[[Any], bool]:
+    def check(value: Any) -> bool:
+        if not isinstance(value, list):
+            return False
+        for it in value:
+            if not isinstance(it, dict) or not _valid_support(it.get("support", [])):
+                return False
+            if any(not isinstance(it.get(k), (str, list)) for k in keys):
+                return False
+        return True
+
+    return check
+
+
+VALIDATORS: Dict[str, Callable[[Any], bool]] = {
+    "summary": lambda v: isinstance(v, str),
+    "findings": _valid_list("what", "so_what"),
+    "pros": _valid_list("claim", "why"),
+    "cons": _valid_list("claim", "why"),
+    "timeline": _valid_list("date", "event"),
+    "divergences": _valid_list("topic", "views"),
+    "convergences": _valid_list("topic", "consensus"),
+}
+
+
+def build_context(contexts: List[Dict[str, Any]]) -> str:
+    parts = []
+    for i, c in enumerate(contexts, 1):
+        quote = (c.get("content", "") or "")[:QUOTE_CHARS].replace("\x00", " ")
+        parts.append(f"[#{c.get('n', i)}] {c.get('path', '')} (chunk {c.get('chunk', 0)}): {quote}")
+    return "\n".join(parts)
+
+
+def _response_format(sections: Sequence[str]) -> Dict[str, Any]:
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "doc_analysis",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {s: SECTION_SCHEMAS[s] for s in sections},
+                "required": list(sections),
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+def _request(ctx: str, sections: Sequence[str], model: str) -> Dict[str, Any]:
+    instr = "\n".join(f"- {SECTION_PROMPTS[s]}" for s in sections)
+    r = llm_gateway.chat(
+        "analysis",
+        model=model,
+        temperature=0.1,
+        response_format=_response_format(sections),
+        messages=[
+            {"role": "system", "content": SYSTEM},
+            {"role": "user", "content": f"CONTEXTO:\n{ctx}\n\nPreencha as seções:\n{instr}"},
+        ],
+    )
+    data = json.loads(r.choices[0].message.content or "{}")
+    return data if isinstance(data, dict) else {}
+
+
+def analyze_sections(
+    ctx: str, sections: Sequence[str], model: str, retries: int = RETRIES
+) -> Dict[str, Any]:
+    """Pede ``sections`` para o contexto já montado, refazendo só as inválidas.
+
+    Levanta ``RuntimeError`` se, esgotadas as tentativas, faltar alguma seção
+    fora de ``OPTIONAL_SECTIONS``; as opcionais ausentes só geram aviso.
+    """
+
+    out: Dict[str, Any] = {}
+    missing = list(sections)
+    last_exc: Optional[Exception] = None
+    for attempt in range(retries + 1):
+        try:
+            data = _request(ctx, missing, model)
+        except Exception as exc:
+            logger.warning("Falha na análise combinada (tentativa %s): %s", attempt + 1, exc)
+            last_exc = exc
+            data = {}
+        for s in missing:
+            if s in data and VALIDATORS[s](data[s]):
+                out[s] = data[s]
+        missing = [s for s in sections if s not in out]
+        if not missing:
+            break
+    required = [s for s in missing if s not in OPTIONAL_SECTIONS]
+    if required:
+        raise RuntimeError(f"seções sem resposta válida: {', '.join(required)}") from last_exc
+    if missing:
+        logger.warning("Seções sem resposta válida: %s", ", ".join(missing))
+    return out
+
+
+def analyze(contexts: List[Dict[str, Any]], model: str, retries: int = RETRIES) -> Dict[str, Any]:
+    """Analisa o contexto numa chamada e refaz só as seções que falharam na validação."""
+
+    wanted = list(SECTION_SCHEMAS)
+    if len(contexts) < 2:
+        wanted = [s for s in wanted if s not in ("divergences", "convergences")]
+    return analyze_sections(build_context(contexts), wanted, model, retries)
+
+
+def split_sections(res: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """Converte o resultado combinado no formato dos analisadores individuais."""
+
+    return {
+        "pc": {"pros": res.get("pros", []), "cons": res.get("cons", [])},
+        "sf": {"summary": res.get("summary", ""), "findings": res.get("findings", [])},
+        "tl": {"timeline": res.get("timeline", [])},
+        "contra": {
+            "divergences": res.get("divergences", []),
+            "convergences": res.get("convergences", []),
+        },
+    }
@@ -1,28 +1,30 @@
 from fastapi import FastAPI, HTTPException, Header
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
-from typing import Optional
-import os
+from typing import List, Optional
+from datetime import date
+import itertools
 import json
-import subprocess
-import sys
+import os
 import psycopg
-from pathlib import Path
 
 from search_answer import answer as answer_single
 from search_chat import chat_respond
+import batch_ask
+import chunk_graph
+import db
+import jobs
+import llm_gateway
+import model_registry
+import model_router
+import report_builder
 
 DB_URL = os.getenv("DATABASE_URL")
-APP_DIR = os.path.dirname(__file__)
 app = FastAPI(title="Sophia RAG API", version="1.1")
+JOBS_EMBEDDED_WORKER = os.getenv("JOBS_EMBEDDED_WORKER", "true").lower() == "true"
+_job_worker: Optional[jobs.Worker] = None
 ALLOW_FINETUNE = os.getenv("ALLOW_FINETUNE", "false").lower() == "true"
 FINETUNE_TOKEN = os.getenv("FINETUNE_TOKEN") or os.getenv("ADMIN_TOKEN")
-FINETUNE_HISTORY_FILE = Path(
-    os.getenv(
-        "FINETUNE_HISTORY",
-        os.path.join(os.getenv("FINETUNE_DIR", "finetune"), "history.jsonl"),
-    )
-)
 PUBLIC_URL = (os.getenv("PUBLIC_URL") or os.getenv("API_URL") or "http://localhost:18888").rstrip("/")
 GPT_PLUGIN_NAME = os.getenv("GPT_PLUGIN_NAME", "Sophia RAG")
 GPT_PLUGIN_DESCRIPTION = os.getenv(
@@ -33,22 +35,45 @@ GPT_CONTACT_EMAIL = os.getenv("GPT_CONTACT_EMAIL", "contato@example.com")
 GPT_LEGAL_URL = os.getenv("GPT_LEGAL_URL")
 GPT_LOGO_URL = os.getenv("GPT_LOGO_URL", f"{PUBLIC_URL}/static/logo.png")
 
+class SearchFilters(BaseModel):
+    path_prefix: Optional[str] = None
+    ext: Optional[str] = None
+    tipo: Optional[str] = None
+    orgao: Optional[str] = None
+    date_from: Optional[date] = None
+    date_to: Optional[date] = None
+
 class AskIn(BaseModel):
     question: str
     top_k: Optional[int] = None
+    filters: Optional[SearchFilters] = None
+
+class AskBatchIn(BaseModel):
+    questions: List[str] = Field(..., min_length=1)
+    top_k: Optional[int] = None
+    filters: Optional[SearchFilters] = None
 
 class ChatIn(BaseModel):
     session: str
     message: str
+    filters: Optional[SearchFilters] = None
 
 class AnalyzeIn(BaseModel):
     path: Optional[str] = None
     doc_id: Optional[int] = None
     k: Optional[int] = 40
+    mode: Optional[str] = None
 
 class AnalyzeBatchIn(BaseModel):
     prefix: Optional[str] = None
     limit: Optional[int] = 50
+    concurrency: Optional[int] = None
+    force: bool = False
+    mode: Optional[str] = None
+
+class ChunkGraphIn(BaseModel):
+    divergences: bool = True
+    limit: Optional[int] = Field(default=None, gt=0)
 
 class FeedbackIn(BaseModel):
     query_hash: str
@@ -71,25 +96,51 @@ class FinetuneExportOut(BaseModel):
 
 class UseModelIn(BaseModel):
     model_id: str
+    canary_percent: Optional[int] = Field(default=None, ge=0, le=100)
+
+
+class RouteIn(BaseModel):
+    model: str
+    weight: int = Field(default=1, ge=0)
+
+
+class RoutingIn(BaseModel):
+    routes: Optional[list[RouteIn]] = None
+    shadow_model: Optional[str] = None
+    shadow_percent: int = Field(default=100, ge=0, le=100)
+
+
+def _check_admin(x_admin_token: Optional[str]) -> None:
+    expected_token = FINETUNE_TOKEN
+    if expected_token:
+        provided = x_admin_token or ""
+        if provided.startswith("Bearer "):
+            provided = provided.split(" ", 1)[1]
+        if provided != expected_token:
+            raise HTTPException(status_code=401, detail="token inválido")
+
+
+def _enqueue(kind: str, params: Optional[dict] = None) -> dict:
+    try:
+        job_id = jobs.enqueue(kind, params)
+    except psycopg.Error as exc:
+        raise HTTPException(status_code=500, detail=f"DB error: {exc.pgerror or exc}") from exc
+    return {"ok": True, "job_id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}"}
+
+
+@app.on_event("startup")
+def start_job_worker():
+    global _job_worker
+    if JOBS_EMBEDDED_WORKER and _job_worker is None:
+        _job_worker = jobs.Worker()
+        _job_worker.start()
 
 
-def _append_finetune_history(entry: dict) -> None:
-    if not entry:
-        return
-    if FINETUNE_HISTORY_FILE.exists():
-        try:
-            with FINETUNE_HISTORY_FILE.open("r", encoding="utf-8") as handle:
-                for line in handle:
-                    try:
-                        if json.loads(line).get("job_id") == entry.get("job_id"):
-                            return
-                    except json.JSONDecodeError:
-                        continue
-        except OSError:
-            pass
-    FINETUNE_HISTORY_FILE.parent.mkdir(parents=True, exist_ok=True)
-    with FINETUNE_HISTORY_FILE.open("a", encoding="utf-8") as handle:
-        handle.write(json.dumps(entry, ensure_ascii=False) + "\n")
+@app.on_event("shutdown")
+def stop_job_worker():
+    if _job_worker is not None:
+        _job_worker.stop()
+
 
 @app.get("/health")
 def health():
@@ -99,7 +150,7 @@ def health():
             cur.fetchone()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"DB error: {e}")
-    return {"ok": True}
+    return {"ok": True, "replicas": db.replicas(), "llm": llm_gateway.usage()}
 
 @app.post("/ask")
 def ask(inp: AskIn):
@@ -107,45 +158,61 @@ def ask(inp: AskIn):
         inp.question,
         k=inp.top_k or int(os.getenv("TOPK", "12")),
         return_metadata=True,
+        filters=inp.filters.model_dump(exclude_none=True) if inp.filters else None,
     )
     return {"answer": ans, "citations": cites, "query_hash": qhash}
 
+@app.post("/ask/batch")
+def ask_batch(inp: AskBatchIn):
+    # NDJSON: uma linha por pergunta (campo "index"), na ordem em que ficam prontas.
+    if len(inp.questions) > batch_ask.BATCH_MAX_QUESTIONS:
+        raise HTTPException(
+            status_code=413, detail=f"máximo de {batch_ask.BATCH_MAX_QUESTIONS} perguntas por lote"
+        )
+    records = batch_ask.run(
+        inp.questions,
+        k=inp.top_k or int(os.getenv("TOPK", "12")),
+        filters=inp.filters.model_dump(exclude_none=True) if inp.filters else None,
+    )
+    lines = (json.dumps(r, ensure_ascii=False, default=str) + "\n" for r in records)
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
 @app.post("/chat")
 def chat(inp: ChatIn):
-    ans, cites, qhash = chat_respond(inp.session, inp.message)
+    filters = inp.filters.model_dump(exclude_none=True) if inp.filters else None
+    ans, cites, qhash = chat_respond(inp.session, inp.message, filters=filters)
     return {"answer": ans, "citations": cites, "query_hash": qhash}
 
 @app.post("/analyze_doc")
 def analyze_doc(inp: AnalyzeIn):
-    cmd = [sys.executable, "-u", os.path.join(APP_DIR, "analyze_doc.py")]
-    if inp.path:
-        cmd += ["--path", inp.path]
-    if inp.doc_id is not None:
-        cmd += ["--doc_id", str(inp.doc_id)]
-    if inp.k:
-        cmd += ["--k", str(inp.k)]
-    r = subprocess.run(cmd, capture_output=True, text=True)
-    if r.returncode != 0:
-        raise HTTPException(status_code=500, detail=r.stderr.strip())
-    try:
-        return json.loads(r.stdout.strip())
-    except Exception:
-        return {"ok": True, "raw": r.stdout.strip()}
+    if not inp.path and inp.doc_id is None:
+        raise HTTPException(status_code=400, detail="informe path ou doc_id")
+    return _enqueue("analyze_doc", inp.model_dump(exclude_none=True))
 
 @app.post("/analyze_batch")
 def analyze_batch(inp: AnalyzeBatchIn):
-    cmd = [sys.executable, "-u", os.path.join(APP_DIR, "analyze_batch.py")]
-    if inp.prefix:
-        cmd += ["--prefix", inp.prefix]
-    if inp.limit:
-        cmd += ["--limit", str(inp.limit)]
-    r = subprocess.run(cmd, capture_output=True, text=True)
-    if r.returncode != 0:
-        raise HTTPException(status_code=500, detail=r.stderr.strip())
+    return _enqueue("analyze_batch", inp.model_dump(exclude_none=True))
+
+@app.post("/chunk_graph")
+def chunk_graph_job(inp: ChunkGraphIn):
+    return _enqueue("chunk_graph", inp.model_dump(exclude_none=True))
+
+@app.get("/related_docs")
+def related_docs(path: Optional[str] = None, doc_id: Optional[int] = None, limit: int = 10):
+    # "Veja também" a partir do grafo de vizinhos (job chunk_graph), sem busca vetorial.
+    if not path and doc_id is None:
+        raise HTTPException(status_code=400, detail="informe path ou doc_id")
     try:
-        return json.loads(r.stdout.strip())
-    except Exception:
-        return {"ok": True, "raw": r.stdout.strip()}
+        return {"related": chunk_graph.related(path, doc_id, limit)}
+    except psycopg.Error as exc:
+        raise HTTPException(status_code=500, detail=f"DB error: {exc.pgerror or exc}") from exc
+
+@app.get("/divergences")
+def divergences(path: Optional[str] = None, limit: int = 50):
+    try:
+        return {"divergences": chunk_graph.divergences_for(path, limit)}
+    except psycopg.Error as exc:
+        raise HTTPException(status_code=500, detail=f"DB error: {exc.pgerror or exc}") from exc
 
 @app.post("/feedback")
 def feedback(inp: FeedbackIn):
@@ -168,85 +235,105 @@ def finetune(
 ):
     if not ALLOW_FINETUNE:
         raise HTTPException(status_code=403, detail="fine-tuning desabilitado")
-    expected_token = FINETUNE_TOKEN
-    if expected_token:
-        provided = x_admin_token or ""
-        if provided.startswith("Bearer "):
-            provided = provided.split(" ", 1)[1]
-        if provided != expected_token:
-            raise HTTPException(status_code=401, detail="token inválido")
-    cmd = [sys.executable, "-u", os.path.join(APP_DIR, "finetune.py")]
-    if inp.status:
-        cmd += ["--status", inp.status]
-    if inp.watch:
-        cmd.append("--watch")
-    r = subprocess.run(cmd, capture_output=True, text=True)
-    if r.returncode != 0:
-        detail = r.stderr.strip() or r.stdout.strip() or "erro ao executar finetune"
-        raise HTTPException(status_code=500, detail=detail)
-    try:
-        payload = json.loads(r.stdout.strip() or "{}")
-    except json.JSONDecodeError as exc:
-        raise HTTPException(status_code=500, detail=f"resposta inválida: {exc}") from exc
-    if not inp.status:
-        _append_finetune_history(payload.get("history_entry"))
-    return payload
+    _check_admin(x_admin_token)
+    return _enqueue("finetune", inp.model_dump(exclude_none=True))
 
 
 @app.post("/finetune/export")
 def finetune_export():
-    r = subprocess.run(
-        [sys.executable, "-u", os.path.join(APP_DIR, "finetune_export.py")],
-        capture_output=True,
-        text=True,
-    )
-    if r.returncode != 0:
-        raise HTTPException(status_code=500, detail=r.stderr.strip())
-    try:
-        return json.loads(r.stdout.strip())
-    except Exception:
-        return {"ok": True, "raw": r.stdout.strip()}
+    return _enqueue("finetune_export")
 
 
 @app.post("/finetune/start")
 def finetune_start():
-    r = subprocess.run(
-        [sys.executable, "-u", os.path.join(APP_DIR, "finetune_openai.py")],
-        capture_output=True,
-        text=True,
-    )
-    if r.returncode != 0:
-        raise HTTPException(status_code=500, detail=r.stderr.strip())
-    try:
-        return json.loads(r.stdout.strip())
-    except Exception:
-        return {"ok": True, "raw": r.stdout.strip()}
+    return _enqueue("finetune_start")
+
+
+@app.get("/jobs")
+def list_jobs(kind: Optional[str] = None, status: Optional[str] = None, limit: int = 50):
+    return jobs.list_jobs(kind, status, limit)
+
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: int):
+    job = jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="job não encontrado")
+    return job
+
+
+@app.get("/jobs/{job_id}/progress")
+def job_progress(job_id: int):
+    job = jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="job não encontrado")
+    return {k: job[k] for k in ("id", "status", "progress", "message", "heartbeat_at")}
+
+
+@app.post("/jobs/{job_id}/cancel")
+def job_cancel(job_id: int):
+    job = jobs.cancel(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="job não encontrado")
+    return {"ok": True, **job}
+
+
+@app.get("/finetune/model")
+def current_model():
+    return model_registry.get_current()
 
 
 @app.post("/finetune/use_model")
-def use_model(inp: UseModelIn):
-    r = subprocess.run(
-        [sys.executable, "-u", os.path.join(APP_DIR, "model_registry.py"), "use", inp.model_id],
-        capture_output=True,
-        text=True,
-    )
-    if r.returncode != 0:
-        raise HTTPException(status_code=500, detail=r.stderr.strip())
-    os.system("systemctl restart sophia-api >/dev/null 2>&1 || true")
-    return {"ok": True, "registry": r.stdout.strip()}
+def use_model(
+    inp: UseModelIn,
+    x_admin_token: Optional[str] = Header(default=None, alias="x-admin-token"),
+):
+    _check_admin(x_admin_token)
+    try:
+        if inp.canary_percent is not None:
+            registry = model_registry.set_canary(inp.model_id, inp.canary_percent)
+        else:
+            registry = model_registry.set_current(inp.model_id)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    return {"ok": True, "registry": registry}
 
 
 @app.post("/finetune/rollback")
-def rollback_model():
-    r = subprocess.run(
-        [sys.executable, "-u", os.path.join(APP_DIR, "model_registry.py"), "rollback"],
-        capture_output=True,
-        text=True,
-    )
-    if r.returncode != 0:
-        raise HTTPException(status_code=500, detail=r.stderr.strip())
-    os.system("systemctl restart sophia-api >/dev/null 2>&1 || true")
-    return {"ok": True, "registry": r.stdout.strip()}
+def rollback_model(x_admin_token: Optional[str] = Header(default=None, alias="x-admin-token")):
+    _check_admin(x_admin_token)
+    try:
+        registry = model_registry.rollback()
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    return {"ok": True, "registry": registry}
+
+
+@app.post("/finetune/routing")
+def set_routing(
+    inp: RoutingIn,
+    x_admin_token: Optional[str] = Header(default=None, alias="x-admin-token"),
+):
+    """Configura o A/B (``routes``) e/ou o modelo em sombra."""
+
+    _check_admin(x_admin_token)
+    try:
+        registry = model_registry.get_current()
+        if inp.routes is not None:
+            registry = model_registry.set_routes([r.model_dump() for r in inp.routes])
+        if inp.shadow_model is not None:
+            registry = model_registry.set_shadow(inp.shadow_model, inp.shadow_percent if inp.shadow_model else 0)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    return {"ok": True, "registry": registry}
+
+
+@app.get("/finetune/model_stats")
+def model_stats(days: int = 7, source: Optional[str] = None):
+    try:
+        return model_router.stats(days, source)
+    except psycopg.Error as exc:
+        raise HTTPException(status_code=500, detail=f"DB error: {exc.pgerror or exc}") from exc
 
 
 @app.get("/.well-known/ai-plugin.json", include_in_schema=False)
@@ -273,7 +360,7 @@ def gpt_manifest():
 
 @app.get("/analysis")
 def analysis(path: Optional[str] = None, limit: int = 50):
-    with psycopg.connect(DB_URL) as conn, conn.cursor() as cur:
+    with db.connect(readonly=True) as conn, conn.cursor() as cur:
         if path:
             cur.execute("SELECT * FROM doc_analysis WHERE path=%s", (path,))
             row = cur.fetchone()
@@ -291,13 +378,33 @@ def analysis(path: Optional[str] = None, limit: int = 50):
         ]
 
 @app.get("/report")
-def report(prefix: Optional[str] = None, limit: int = 100):
-    cmd = [sys.executable, "-u", os.path.join(APP_DIR, "report_builder.py")]
-    if prefix:
-        cmd += ["--prefix", prefix]
-    if limit:
-        cmd += ["--limit", str(limit)]
-    r = subprocess.run(cmd, capture_output=True, text=True)
-    if r.returncode != 0:
-        raise HTTPException(status_code=500, detail=r.stderr.strip())
-    return {"markdown": r.stdout}
+def report(
+    prefix: Optional[str] = None,
+    limit: int = 100,
+    format: str = "json",
+    cursor: Optional[str] = None,
+):
+    """Relatório das análises; ``markdown``, ``ndjson`` e ``csv`` são enviados em fluxo.
+
+    O padrão ``json`` mantém o contrato ``{"markdown": ...}`` (mais ``next_cursor``).
+    """
+
+    fmt = "markdown" if format == "json" else format
+    page: dict = {}
+    try:
+        chunks = report_builder.stream(prefix, limit, fmt, cursor, page)
+        if format == "json":
+            return {"markdown": "".join(chunks), "next_cursor": page.get("next_cursor")}
+        # O gerador só consulta o banco ao ser consumido; o primeiro pedaço
+        # sai aqui para que erros virem 400/500 antes do início do fluxo e
+        # para que o cursor da próxima página já esteja em ``page``.
+        first = next(chunks, "")
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    except psycopg.Error as exc:
+        raise HTTPException(status_code=500, detail=f"DB error: {exc.pgerror or exc}") from exc
+    nxt = page.get("next_cursor")
+    headers = {"X-Next-Cursor": nxt} if nxt else {}
+    return StreamingResponse(
+        itertools.chain([first], chunks), media_type=report_builder.MEDIA_TYPES[fmt], headers=headers
+    )
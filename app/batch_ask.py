@@ -0,0 +1,317 @@
+"""Perguntas em lote (``/ask/batch`` e CLI) compartilhando as etapas do pipeline.
+
+Para uma lista de perguntas:
+
+1. remove duplicadas (pelo ``sha`` da pergunta) e consulta o cache de QA de
+   todas numa única query;
+2. gera os embeddings das que faltam em poucas chamadas grandes;
+3. carrega glossário e notas uma vez e faz a busca com até
+   ``BATCH_RETRIEVAL_WORKERS`` perguntas simultâneas; as de baixa confiança
+   são expandidas e todas as variantes recebem embedding numa só chamada;
+4. gera as respostas com até ``BATCH_GEN_CONCURRENCY`` chamadas simultâneas e
+   devolve cada resultado assim que fica pronto (NDJSON, na ordem de término).
+
+No modo offline (``--offline``) as etapas 1–3 são feitas e os prompts são
+gravados no formato JSONL da Batch API da OpenAI, junto com um manifesto;
+``--import-results`` grava as respostas devolvidas pela Batch API no cache.
+
+Exemplos::
+
+    python app/batch_ask.py perguntas.txt > respostas.ndjson
+    python app/batch_ask.py perguntas.txt --offline lote.jsonl
+    python app/batch_ask.py --import-results saida.jsonl --manifest lote.manifest.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import queue
+import sys
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import grounding
+import model_registry
+from search_answer import TOPK, build_messages, generate_from_rows
+from search_utils import (
+    GROUNDING_ACTION,
+    SELF_RAG_MODE,
+    embed_many,
+    expand_query,
+    finish_retrieval,
+    first_pass,
+    load_glossary,
+    load_notes,
+    save_cache,
+    sha,
+    try_cache_many,
+)
+
+EMBED_MODEL = os.getenv("EMBED_MODEL", "text-embedding-3-small")
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", "1000"))
+BATCH_RETRIEVAL_WORKERS = int(os.getenv("BATCH_RETRIEVAL_WORKERS", "8"))
+BATCH_GEN_CONCURRENCY = int(os.getenv("BATCH_GEN_CONCURRENCY", "4"))
+MAX_CTX_CHARS = 20000
+logger = logging.getLogger("sophia.batch")
+
+
+def _dedupe(questions: Sequence[str]) -> Tuple[List[str], Dict[str, List[int]]]:
+    uniq: List[str] = []
+    positions: Dict[str, List[int]] = {}
+    for i, q in enumerate(questions):
+        q = (q or "").strip()
+        if not q:
+            continue
+        h = sha(q)
+        if h not in positions:
+            uniq.append(q)
+            positions[h] = []
+        positions[h].append(i)
+    return uniq, positions
+
+
+def _records(question: str, positions: Dict[str, List[int]], **result: Any) -> Iterator[Dict[str, Any]]:
+    h = sha(question)
+    for i in positions[h]:
+        yield {"index": i, "question": question, "query_hash": h, **result}
+
+
+def _retrieve_all(
+    todo: Sequence[str], k: int, filters: Optional[Dict[str, Any]], workers: int
+) -> Iterator[Tuple[str, Any]]:
+    """``(pergunta, trechos | exceção)`` na ordem em que as buscas terminam.
+
+    As perguntas confiantes na primeira busca seguem direto; as demais são
+    expandidas em paralelo e todas as variantes vão num único ``embed_many``.
+    """
+
+    vecs = embed_many(todo, EMBED_MODEL)
+    glossary, notes = load_glossary(), load_notes()
+    done: "queue.Queue[Tuple[str, Any]]" = queue.Queue()
+
+    def finish(q: str, rows: List[Dict[str, Any]], flt: Any, plan: Dict[str, bool], variants: Any = ()) -> Any:
+        return finish_retrieval(q, rows, plan, k, flt, variants, glossary, notes)
+
+    def track(fut: Future, q: str) -> None:
+        fut.add_done_callback(lambda f: done.put((q, f.exception() or f.result())))
+
+    def ready() -> Iterator[Tuple[str, Any]]:
+        while True:
+            try:
+                yield done.get_nowait()
+            except queue.Empty:
+                return
+
+    yielded = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="batch-ret") as pool:
+        firsts = {pool.submit(first_pass, q, v, k, True, filters): q for q, v in zip(todo, vecs)}
+        expanding: Dict[str, Tuple[Any, Future]] = {}
+        for fut in as_completed(firsts):
+            q = firsts[fut]
+            if fut.exception():
+                done.put((q, fut.exception()))
+            else:
+                rows, flt, plan = fut.result()
+                if plan["expand"]:
+                    expanding[q] = ((rows, flt, plan), pool.submit(expand_query, q))
+                else:
+                    track(pool.submit(finish, q, rows, flt, plan), q)
+            for item in ready():
+                yielded += 1
+                yield item
+
+        if expanding:
+            texts = {q: exp.result()[1:] for q, (_, exp) in expanding.items()}
+            flat = [t for ts in texts.values() for t in ts]
+            try:
+                flat_vecs = embed_many(flat, EMBED_MODEL)
+            except Exception as exc:  # pragma: no cover - segue só com a primeira busca
+                logger.warning("Falha ao gerar embeddings das variantes do lote: %s", exc)
+                flat_vecs = [None] * len(flat)
+            logger.info("Lote: %s perguntas expandidas, %s variantes", len(expanding), len(flat))
+            it = iter(flat_vecs)
+            for q, ((rows, flt, plan), _) in expanding.items():
+                variants = [(t, next(it)) for t in texts[q]]
+                track(pool.submit(finish, q, rows, flt, plan, variants), q)
+
+        for _ in range(len(todo) - yielded):
+            yield done.get()
+
+
+def run(
+    questions: Sequence[str],
+    k: int = TOPK,
+    filters: Optional[Dict[str, Any]] = None,
+    retrieval_workers: int = BATCH_RETRIEVAL_WORKERS,
+    gen_concurrency: int = BATCH_GEN_CONCURRENCY,
+) -> Iterator[Dict[str, Any]]:
+    """Responde ``questions`` e produz um registro por pergunta de entrada."""
+
+    uniq, positions = _dedupe(questions)
+    cached = {} if filters else try_cache_many(uniq)
+    todo = []
+    for q in uniq:
+        row = cached.get(sha(q))
+        if row:
+            yield from _records(q, positions, answer=row["answer"], citations=row.get("citations") or [], cached=True)
+        else:
+            todo.append(q)
+    logger.info("Lote: %s perguntas, %s únicas, %s em cache", len(questions), len(uniq), len(uniq) - len(todo))
+    if not todo:
+        return
+
+    results: "queue.Queue[Tuple[str, Dict[str, Any]]]" = queue.Queue()
+
+    def generate(q: str, rows: List[Dict[str, Any]]) -> None:
+        try:
+            final, cites = generate_from_rows(q, sha(q), rows, k, MAX_CTX_CHARS, filters)
+            results.put((q, {"answer": final, "citations": cites, "cached": False}))
+        except Exception as exc:  # pragma: no cover - fallback defensivo
+            logger.exception("Falha ao responder pergunta do lote", exc_info=exc)
+            results.put((q, {"error": str(exc)}))
+
+    with ThreadPoolExecutor(max_workers=max(1, gen_concurrency), thread_name_prefix="batch-gen") as gen:
+        pending = 0
+        for q, rows in _retrieve_all(todo, k, filters, retrieval_workers):
+            if isinstance(rows, Exception):
+                yield from _records(q, positions, error=str(rows))
+                continue
+            gen.submit(generate, q, rows)
+            pending += 1
+            while not results.empty():
+                q2, res = results.get()
+                pending -= 1
+                yield from _records(q2, positions, **res)
+        while pending:
+            q2, res = results.get()
+            pending -= 1
+            yield from _records(q2, positions, **res)
+
+
+def export_batch(
+    questions: Sequence[str],
+    out_path: Path,
+    k: int = TOPK,
+    filters: Optional[Dict[str, Any]] = None,
+    retrieval_workers: int = BATCH_RETRIEVAL_WORKERS,
+) -> Dict[str, Any]:
+    """Grava os prompts das perguntas fora do cache no formato da Batch API."""
+
+    uniq, _ = _dedupe(questions)
+    cached = {} if filters else try_cache_many(uniq)
+    todo = [q for q in uniq if sha(q) not in cached]
+    manifest: Dict[str, Any] = {"filters": filters, "items": {}}
+    written = errors = 0
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    with out_path.open("w", encoding="utf-8") as fh:
+        for q, rows in _retrieve_all(todo, k, filters, retrieval_workers):
+            if isinstance(rows, Exception):
+                errors += 1
+                logger.warning("Busca falhou para %r: %s", q, rows)
+                continue
+            h = sha(q)
+            msgs, blocks, cites, _ = build_messages(q, rows, k, MAX_CTX_CHARS)
+            body = {"model": model_registry.gen_model(h), "messages": msgs, "temperature": 0.2}
+            fh.write(
+                json.dumps(
+                    {"custom_id": h, "method": "POST", "url": "/v1/chat/completions", "body": body},
+                    ensure_ascii=False,
+                )
+                + "\n"
+            )
+            manifest["items"][h] = {"question": q, "citations": cites, "blocks": blocks}
+            written += 1
+    manifest_path = out_path.with_suffix(".manifest.json")
+    manifest_path.write_text(json.dumps(manifest, ensure_ascii=False), encoding="utf-8")
+    return {
+        "requests": str(out_path),
+        "manifest": str(manifest_path),
+        "questions": len(questions),
+        "unique": len(uniq),
+        "cached": len(uniq) - len(todo),
+        "written": written,
+        "errors": errors,
+    }
+
+
+def import_results(results_path: Path, manifest_path: Path) -> Dict[str, Any]:
+    """Grava no cache de QA as respostas de um lote concluído da Batch API.
+
+    Não há verificação por LLM aqui; com ``SELF_RAG_MODE`` diferente de
+    ``llm`` as frases sem apoio são tratadas por ``grounding`` como no fluxo
+    online.
+    """
+
+    manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+    items = manifest["items"]
+    saved = failed = 0
+    out: List[Dict[str, Any]] = []
+    with results_path.open(encoding="utf-8") as fh:
+        for line in fh:
+            if not line.strip():
+                continue
+            rec = json.loads(line)
+            item = items.get(rec.get("custom_id"))
+            body = ((rec.get("response") or {}).get("body")) or {}
+            choices = body.get("choices") or []
+            if item is None or rec.get("error") or not choices:
+                failed += 1
+                continue
+            text = choices[0].get("message", {}).get("content") or ""
+            if SELF_RAG_MODE != "llm":
+                text = grounding.apply(text, grounding.check(text, item["blocks"]), GROUNDING_ACTION)
+            if not manifest.get("filters"):
+                save_cache(item["question"], text, item["citations"])
+            out.append({"question": item["question"], "query_hash": rec["custom_id"], "answer": text})
+            saved += 1
+    return {"saved": saved, "failed": failed, "answers": out}
+
+
+def read_questions(path: Path) -> List[str]:
+    """Uma pergunta por linha; em ``.jsonl``, strings ou objetos com ``question``."""
+
+    out = []
+    with path.open(encoding="utf-8") as fh:
+        for line in fh:
+            line = line.strip()
+            if not line:
+                continue
+            if path.suffix == ".jsonl":
+                rec = json.loads(line)
+                line = rec if isinstance(rec, str) else rec.get("question", "")
+            out.append(line)
+    return out
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="Perguntas em lote")
+    ap.add_argument("questions", nargs="?", type=Path, help="Arquivo de perguntas (.txt ou .jsonl)")
+    ap.add_argument("--top-k", type=int, default=TOPK)
+    ap.add_argument("--offline", type=Path, help="Gravar prompts no formato da Batch API neste JSONL")
+    ap.add_argument("--import-results", type=Path, help="Saída da Batch API a gravar no cache")
+    ap.add_argument("--manifest", type=Path, help="Manifesto gerado por --offline")
+    a = ap.parse_args(argv)
+
+    if a.import_results:
+        if not a.manifest:
+            ap.error("--import-results exige --manifest")
+        res = import_results(a.import_results, a.manifest)
+        print(json.dumps({k: v for k, v in res.items() if k != "answers"}, ensure_ascii=False))
+        return 0
+    if not a.questions:
+        ap.error("informe o arquivo de perguntas")
+    questions = read_questions(a.questions)
+    if a.offline:
+        print(json.dumps(export_batch(questions, a.offline, a.top_k), ensure_ascii=False))
+        return 0
+    for rec in run(questions, a.top_k):
+        print(json.dumps(rec, ensure_ascii=False), flush=True)
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover - CLI entry
+    sys.exit(main())
@@ -0,0 +1,421 @@
+"""Grafo de vizinhos entre trechos e divergências entre documentos.
+
+O job ``chunk_graph`` mantém em ``chunk_neighbors`` os ``GRAPH_K`` vizinhos
+mais próximos de cada trecho (por ``chunk_hash``), consultando o HNSW em
+lotes de ``GRAPH_BATCH`` trechos numa única query. É incremental: só trechos
+ainda sem nó em ``chunk_graph_nodes`` são consultados, e as arestas de volta
+para nós já existentes são atualizadas na mesma passada. Trechos removidos
+saem do grafo e os nós que apontavam para eles são refeitos.
+
+Com o grafo pronto, a análise entre documentos envia ao LLM apenas os pares
+com similaridade de ao menos ``GRAPH_DIVERGENCE_MIN_SIM`` e caminhos
+diferentes, ``GRAPH_PAIRS_PER_CALL`` pares por chamada; o resultado de cada
+par fica em ``chunk_divergences`` e não é pedido de novo enquanto os dois
+textos não mudarem. ``related`` responde "veja também" direto do grafo.
+
+    python app/chunk_graph.py build [--no-divergences] [--limit N]
+    python app/chunk_graph.py related --path /dados/x.pdf
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import psycopg
+from dotenv import load_dotenv
+from psycopg.rows import dict_row
+from psycopg.types.json import Json
+
+import chunk_store
+import db
+import llm_gateway
+import model_registry
+import vector_index
+
+load_dotenv(Path(__file__).with_name(".env"), override=True)
+DB_URL = os.getenv("DATABASE_URL")
+GRAPH_K = int(os.getenv("GRAPH_K", "10"))
+GRAPH_BATCH = int(os.getenv("GRAPH_BATCH", "256"))
+GRAPH_MIN_SIM = float(os.getenv("GRAPH_MIN_SIM", "0.5"))
+GRAPH_DIVERGENCE_MIN_SIM = float(os.getenv("GRAPH_DIVERGENCE_MIN_SIM", "0.85"))
+GRAPH_DIVERGENCE_LIMIT = int(os.getenv("GRAPH_DIVERGENCE_LIMIT", "200"))
+GRAPH_PAIRS_PER_CALL = int(os.getenv("GRAPH_PAIRS_PER_CALL", "8"))
+GRAPH_LLM_CONCURRENCY = int(os.getenv("GRAPH_LLM_CONCURRENCY", "4"))
+GRAPH_AFTER_INGEST = os.getenv("GRAPH_AFTER_INGEST", "false").lower() == "true"
+QUOTE_CHARS = int(os.getenv("ANALYSIS_QUOTE_CHARS", "1200"))
+logger = logging.getLogger("sophia.analysis")
+
+DIVERGENCE_SYSTEM = (
+    "Você compara pares de trechos de documentos diferentes sobre o mesmo tema. "
+    "Para cada par, indique se há divergência objetiva (entendimentos, regras, valores ou prazos "
+    "conflitantes) e descreva as posições. Responda SÓ com base nos trechos; diferenças de redação "
+    "sem conflito não são divergência."
+)
+
+_PAIRS_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "pair_divergences",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "pairs": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "pair": {"type": "integer"},
+                            "divergent": {"type": "boolean"},
+                            "topic": {"type": "string"},
+                            "views": {"type": "array", "items": {"type": "string"}},
+                        },
+                        "required": ["pair", "divergent", "topic", "views"],
+                        "additionalProperties": False,
+                    },
+                }
+            },
+            "required": ["pairs"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+PAIRS_SQL = """
+WITH pairs AS (
+  SELECT LEAST(src_hash, dst_hash) AS a_hash, GREATEST(src_hash, dst_hash) AS b_hash, MAX(sim) AS sim
+  FROM chunk_neighbors
+  WHERE sim >= %(min_sim)s
+  GROUP BY 1, 2
+)
+SELECT p.a_hash, p.b_hash, p.sim,
+       a.path AS a_path, a.chunk_no AS a_chunk, a.content AS a_content,
+       b.path AS b_path, b.chunk_no AS b_chunk, b.content AS b_content
+FROM pairs p
+CROSS JOIN LATERAL (
+  SELECT path, chunk_no, content FROM docs WHERE chunk_hash = p.a_hash ORDER BY path, chunk_no LIMIT 1
+) a
+CROSS JOIN LATERAL (
+  SELECT path, chunk_no, content FROM docs WHERE chunk_hash = p.b_hash AND path <> a.path
+  ORDER BY path, chunk_no LIMIT 1
+) b
+WHERE NOT EXISTS (SELECT 1 FROM chunk_divergences v WHERE v.a_hash = p.a_hash AND v.b_hash = p.b_hash)
+ORDER BY p.sim DESC
+LIMIT %(limit)s
+"""
+
+RELATED_SQL = """
+WITH edges AS (
+  SELECT n.dst_hash, n.sim FROM chunk_neighbors n WHERE n.src_hash = ANY(%(hashes)s)
+)
+SELECT d.path, MAX(e.sim) AS score, COUNT(DISTINCT e.dst_hash) AS links,
+       (array_agg(d.id ORDER BY e.sim DESC))[1] AS doc_id,
+       (array_agg(d.chunk_no ORDER BY e.sim DESC))[1] AS chunk
+FROM edges e JOIN docs d ON d.chunk_hash = e.dst_hash
+WHERE d.path <> %(path)s
+GROUP BY d.path
+ORDER BY score DESC, links DESC
+LIMIT %(limit)s
+"""
+
+
+def _table() -> str:
+    """Tabela com os embeddings indexados no layout atual."""
+
+    return "chunks" if chunk_store.enabled() else "docs"
+
+
+def _knn_sql(table: str) -> str:
+    order = vector_index.knn_order(vector_index.VECTOR_INDEX, "d.embedding", "s.embedding")
+    return f"""
+SELECT s.chunk_hash AS src, n.chunk_hash AS dst, 1 - (n.embedding <=> s.embedding) AS sim
+FROM (
+  SELECT DISTINCT ON (chunk_hash) chunk_hash, embedding FROM {table}
+  WHERE chunk_hash = ANY(%(hashes)s) AND embedding IS NOT NULL
+) s
+CROSS JOIN LATERAL (
+  SELECT d.chunk_hash, d.embedding FROM {table} d
+  WHERE d.embedding IS NOT NULL
+  ORDER BY {order}
+  LIMIT %(cand)s
+) n
+WHERE n.chunk_hash <> s.chunk_hash
+"""
+
+
+def pending(cur, limit: int) -> List[str]:
+    cur.execute(
+        f"""SELECT DISTINCT t.chunk_hash FROM {_table()} t
+             WHERE t.embedding IS NOT NULL
+               AND NOT EXISTS (SELECT 1 FROM chunk_graph_nodes g WHERE g.chunk_hash = t.chunk_hash)
+             LIMIT %s""",
+        (limit,),
+    )
+    return [r["chunk_hash"] for r in cur.fetchall()]
+
+
+def neighbours(cur, hashes: Sequence[str], k: int = GRAPH_K) -> Dict[str, List[Tuple[str, float]]]:
+    """Os ``k`` vizinhos de cada hash (sem o próprio texto e acima de ``GRAPH_MIN_SIM``)."""
+
+    # No layout docs cópias do mesmo texto voltam como linhas separadas; pede folga.
+    cur.execute(f"SET hnsw.ef_search={max(vector_index.ef_search(), k * 4)};")
+    cur.execute(_knn_sql(_table()), {"hashes": list(hashes), "cand": k * 4})
+    best: Dict[str, Dict[str, float]] = {h: {} for h in hashes}
+    for r in cur.fetchall():
+        if r["sim"] >= GRAPH_MIN_SIM:
+            seen = best[r["src"]]
+            seen[r["dst"]] = max(seen.get(r["dst"], -1.0), float(r["sim"]))
+    return {h: sorted(d.items(), key=lambda x: -x[1])[:k] for h, d in best.items()}
+
+
+def _trim(cur, srcs: Sequence[str], k: int) -> None:
+    cur.execute(
+        """DELETE FROM chunk_neighbors n
+            USING (SELECT src_hash, dst_hash,
+                          row_number() OVER (PARTITION BY src_hash ORDER BY sim DESC) AS rk
+                     FROM chunk_neighbors WHERE src_hash = ANY(%s)) r
+            WHERE n.src_hash = r.src_hash AND n.dst_hash = r.dst_hash AND r.rk > %s""",
+        (list(srcs), k),
+    )
+
+
+def add_nodes(conn: psycopg.Connection, hashes: Sequence[str], k: int = GRAPH_K) -> int:
+    """Grava as arestas de ``hashes`` e as de volta para nós já existentes."""
+
+    with conn.cursor(row_factory=dict_row) as cur:
+        nb = neighbours(cur, hashes, k)
+        fwd = [(src, dst, sim) for src, items in nb.items() for dst, sim in items]
+        cur.execute("DELETE FROM chunk_neighbors WHERE src_hash = ANY(%s)", (list(hashes),))
+        cur.executemany(
+            """INSERT INTO chunk_neighbors(src_hash, dst_hash, sim) VALUES(%s,%s,%s)
+               ON CONFLICT (src_hash, dst_hash) DO UPDATE SET sim = EXCLUDED.sim""",
+            fwd,
+        )
+        # Um trecho novo pode entrar na lista de vizinhos de um nó antigo.
+        cur.executemany(
+            """INSERT INTO chunk_neighbors(src_hash, dst_hash, sim)
+               SELECT %s, %s, %s WHERE EXISTS (SELECT 1 FROM chunk_graph_nodes WHERE chunk_hash = %s)
+               ON CONFLICT (src_hash, dst_hash) DO UPDATE SET sim = EXCLUDED.sim""",
+            [(dst, src, sim, dst) for src, dst, sim in fwd],
+        )
+        _trim(cur, sorted({dst for _, dst, _ in fwd}), k)
+        cur.executemany(
+            """INSERT INTO chunk_graph_nodes(chunk_hash) VALUES(%s)
+               ON CONFLICT (chunk_hash) DO UPDATE SET built_at = now()""",
+            [(h,) for h in hashes],
+        )
+    conn.commit()
+    return len(fwd)
+
+
+def gc(conn: psycopg.Connection) -> int:
+    """Tira do grafo os textos que saíram de ``docs``; quem apontava para eles é refeito."""
+
+    with conn.cursor() as cur:
+        cur.execute(
+            """DELETE FROM chunk_graph_nodes g
+                WHERE NOT EXISTS (SELECT 1 FROM docs d WHERE d.chunk_hash = g.chunk_hash)
+                RETURNING chunk_hash"""
+        )
+        gone = [r[0] for r in cur.fetchall()]
+        if gone:
+            cur.execute(
+                """DELETE FROM chunk_graph_nodes
+                    WHERE chunk_hash IN (SELECT src_hash FROM chunk_neighbors WHERE dst_hash = ANY(%s))""",
+                (gone,),
+            )
+            cur.execute("DELETE FROM chunk_neighbors WHERE src_hash = ANY(%(g)s) OR dst_hash = ANY(%(g)s)", {"g": gone})
+            cur.execute("DELETE FROM chunk_divergences WHERE a_hash = ANY(%(g)s) OR b_hash = ANY(%(g)s)", {"g": gone})
+    conn.commit()
+    return len(gone)
+
+
+def _quote(text: Optional[str]) -> str:
+    return (text or "")[:QUOTE_CHARS].replace("\x00", " ").replace("\n", " ")
+
+
+def compare(pairs: Sequence[Dict[str, Any]], model: str) -> Dict[int, Dict[str, Any]]:
+    """Uma chamada para vários pares; devolve ``{índice do par: resultado}``."""
+
+    parts = [
+        f"PAR {i}\n[A] {p['a_path']} (chunk {p['a_chunk']}): {_quote(p['a_content'])}\n"
+        f"[B] {p['b_path']} (chunk {p['b_chunk']}): {_quote(p['b_content'])}"
+        for i, p in enumerate(pairs, 1)
+    ]
+    r = llm_gateway.chat(
+        "analysis.cross",
+        model=model,
+        temperature=0.1,
+        response_format=_PAIRS_FORMAT,
+        messages=[
+            {"role": "system", "content": DIVERGENCE_SYSTEM},
+            {"role": "user", "content": "\n\n".join(parts) + "\n\nAvalie cada PAR (campo pair = número do par)."},
+        ],
+    )
+    data = json.loads(r.choices[0].message.content or "{}")
+    items = data.get("pairs", []) if isinstance(data, dict) else []
+    return {it["pair"]: it for it in items if isinstance(it, dict) and 1 <= it.get("pair", 0) <= len(pairs)}
+
+
+def find_divergences(
+    conn: psycopg.Connection,
+    limit: int = GRAPH_DIVERGENCE_LIMIT,
+    min_sim: float = GRAPH_DIVERGENCE_MIN_SIM,
+    model: Optional[str] = None,
+    should_stop: Optional[Callable[[], bool]] = None,
+) -> Dict[str, int]:
+    """Compara por LLM os pares ainda não avaliados, dos mais similares para os menos."""
+
+    model = model or model_registry.gen_model()
+    with conn.cursor(row_factory=dict_row) as cur:
+        cur.execute(PAIRS_SQL, {"min_sim": min_sim, "limit": limit})
+        pairs = cur.fetchall()
+    groups = [pairs[i : i + GRAPH_PAIRS_PER_CALL] for i in range(0, len(pairs), max(1, GRAPH_PAIRS_PER_CALL))]
+
+    def one(group: List[Dict[str, Any]]) -> List[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        if should_stop and should_stop():
+            return []
+        try:
+            res = compare(group, model)
+        except Exception as exc:  # pragma: no cover - fallback defensivo
+            logger.warning("Falha ao comparar pares de trechos: %s", exc)
+            return []
+        return [(p, res[i]) for i, p in enumerate(group, 1) if i in res]
+
+    done = divergent = 0
+    with ThreadPoolExecutor(max_workers=max(1, GRAPH_LLM_CONCURRENCY), thread_name_prefix="graph-llm") as ex:
+        for results in ex.map(one, groups):
+            with conn.cursor() as cur:
+                cur.executemany(
+                    """INSERT INTO chunk_divergences(a_hash, b_hash, sim, a_path, a_chunk, b_path, b_chunk,
+                                                     divergent, topic, views, model)
+                       VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+                       ON CONFLICT (a_hash, b_hash) DO NOTHING""",
+                    [
+                        (p["a_hash"], p["b_hash"], p["sim"], p["a_path"], p["a_chunk"], p["b_path"], p["b_chunk"],
+                         bool(r["divergent"]), r.get("topic"), Json(r.get("views") or []), model)
+                        for p, r in results
+                    ],
+                )
+            conn.commit()
+            done += len(results)
+            divergent += sum(1 for _, r in results if r["divergent"])
+    return {"pairs": len(pairs), "compared": done, "divergent": divergent}
+
+
+def run(
+    divergences: bool = True,
+    limit: Optional[int] = None,
+    progress: Optional[Callable[[int, int, str], None]] = None,
+    should_stop: Optional[Callable[[], bool]] = None,
+) -> Dict[str, Any]:
+    """Atualiza o grafo (e, com ``divergences``, compara os pares novos).
+
+    ``limit`` limita quantos trechos novos entram no grafo nesta execução;
+    ``progress(feitos, total, mensagem)`` e ``should_stop()`` seguem o padrão
+    de ``analyze_batch.run``.
+    """
+
+    out: Dict[str, Any] = {"ok": True}
+    with psycopg.connect(DB_URL) as conn:
+        out["removed"] = gc(conn)
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""SELECT COUNT(DISTINCT t.chunk_hash) FROM {_table()} t
+                     WHERE t.embedding IS NOT NULL
+                       AND NOT EXISTS (SELECT 1 FROM chunk_graph_nodes g WHERE g.chunk_hash = t.chunk_hash)"""
+            )
+            total = cur.fetchone()[0]
+        if limit is not None:
+            total = min(total, limit)
+        nodes = edges = 0
+        while nodes < total and not (should_stop and should_stop()):
+            with conn.cursor(row_factory=dict_row) as cur:
+                batch = pending(cur, min(GRAPH_BATCH, total - nodes))
+            if not batch:
+                break
+            edges += add_nodes(conn, batch)
+            nodes += len(batch)
+            if progress:
+                progress(nodes, total, f"{nodes}/{total} trechos no grafo")
+        out.update(nodes=nodes, edges=edges)
+        if divergences and not (should_stop and should_stop()):
+            if progress:
+                progress(nodes, total, "comparando pares entre documentos")
+            out["divergences"] = find_divergences(conn, should_stop=should_stop)
+    return out
+
+
+def related(path: Optional[str] = None, doc_id: Optional[int] = None, limit: int = 10) -> List[Dict[str, Any]]:
+    """Documentos mais ligados a ``path`` (ou ao trecho ``doc_id``) no grafo."""
+
+    with db.connect(readonly=True) as conn, conn.cursor(row_factory=dict_row) as cur:
+        if doc_id is not None:
+            cur.execute("SELECT path, chunk_hash FROM docs WHERE id=%s", (doc_id,))
+            row = cur.fetchone()
+            if not row:
+                return []
+            path, hashes = row["path"], [row["chunk_hash"]]
+        else:
+            cur.execute("SELECT DISTINCT chunk_hash FROM docs WHERE path=%s", (path,))
+            hashes = [r["chunk_hash"] for r in cur.fetchall()]
+        if not hashes:
+            return []
+        cur.execute(RELATED_SQL, {"hashes": hashes, "path": path, "limit": limit})
+        return [dict(r, score=round(float(r["score"]), 4)) for r in cur.fetchall()]
+
+
+def divergences_for(path: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
+    """Divergências encontradas (todas ou as que envolvem ``path``), mais similares primeiro."""
+
+    with db.connect(readonly=True) as conn, conn.cursor(row_factory=dict_row) as cur:
+        cur.execute(
+            """SELECT a_path, a_chunk, b_path, b_chunk, sim, topic, views, model, created_at
+                 FROM chunk_divergences v
+                WHERE divergent
+                  AND (%(path)s::text IS NULL
+                       OR v.a_hash IN (SELECT chunk_hash FROM docs WHERE path = %(path)s)
+                       OR v.b_hash IN (SELECT chunk_hash FROM docs WHERE path = %(path)s))
+                ORDER BY sim DESC
+                LIMIT %(limit)s""",
+            {"path": path, "limit": limit},
+        )
+        return cur.fetchall()
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="Grafo de vizinhos entre trechos")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("build", help="Atualizar o grafo e comparar pares entre documentos")
+    b.add_argument("--no-divergences", action="store_true")
+    b.add_argument("--limit", type=int, help="Máximo de trechos novos nesta execução")
+    r = sub.add_parser("related", help="Documentos relacionados")
+    r.add_argument("--path")
+    r.add_argument("--doc-id", type=int)
+    r.add_argument("--limit", type=int, default=10)
+    d = sub.add_parser("divergences", help="Divergências entre documentos")
+    d.add_argument("--path")
+    d.add_argument("--limit", type=int, default=50)
+    a = ap.parse_args(argv)
+    if a.cmd == "build":
+        logging.basicConfig(level=logging.INFO)
+        out: Any = run(not a.no_divergences, a.limit)
+    elif a.cmd == "related":
+        if not a.path and a.doc_id is None:
+            ap.error("informe --path ou --doc-id")
+        out = related(a.path, a.doc_id, a.limit)
+    else:
+        out = divergences_for(a.path, a.limit)
+    print(json.dumps(out, ensure_ascii=False, default=str))
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover - CLI entry
+    sys.exit(main())
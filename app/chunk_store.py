@@ -0,0 +1,179 @@
+"""Armazenamento endereçado por conteúdo dos trechos (``CHUNK_STORE=chunks``).
+
+Anexos padrão, cabeçalhos repetidos e cópias da mesma norma em várias pastas
+geram trechos de texto idêntico em ``docs``. Com ``CHUNK_STORE=chunks`` o
+texto de cada ``chunk_hash`` fica uma única vez em ``chunks`` (``content``,
+``tsv`` e ``embedding``), que concentra o GIN e o HNSW; ``docs`` continua com
+uma linha por ``(path, chunk_no)`` apontando para ``chunks`` pelo
+``chunk_hash``. A busca percorre ``chunks``, então cópias não ocupam
+posições do top-k, e cada resultado traz em ``sources`` todos os caminhos que
+contêm aquele texto.
+
+``docs.content`` é mantido (a análise e os relatórios leem o texto por
+arquivo); o que sai de ``docs`` são os índices e o embedding.
+
+Migração e manutenção::
+
+    python app/chunk_store.py migrate [--drop-docs-indexes]
+    python app/chunk_store.py gc             # remove trechos sem referência
+    python app/chunk_store.py restore-docs   # volta para CHUNK_STORE=docs
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+from typing import Any, Dict
+
+import psycopg
+from dotenv import load_dotenv
+
+import vector_index
+
+load_dotenv(Path(__file__).with_name(".env"), override=True)
+DB_URL = os.getenv("DATABASE_URL")
+EMBED_DIM = int(os.getenv("EMBED_DIM", "1536"))
+CHUNK_STORE = os.getenv("CHUNK_STORE", "docs").lower()  # docs | chunks
+
+
+def enabled() -> bool:
+    return CHUNK_STORE == "chunks"
+
+
+def ensure_schema(conn: psycopg.Connection) -> None:
+    """Cria ``chunks`` com o mesmo gatilho de ``tsv`` de ``docs``."""
+
+    with conn.cursor() as cur:
+        cur.execute(
+            f"""CREATE TABLE IF NOT EXISTS chunks (
+                  chunk_hash TEXT PRIMARY KEY,
+                  content TEXT NOT NULL,
+                  tsv TSVECTOR,
+                  embedding VECTOR({EMBED_DIM}),
+                  created_at TIMESTAMPTZ DEFAULT now()
+                );"""
+        )
+        cur.execute(
+            """DO $$ BEGIN
+              IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname='chunks_tsv_update_tr') THEN
+                CREATE TRIGGER chunks_tsv_update_tr BEFORE INSERT OR UPDATE OF content ON chunks
+                FOR EACH ROW EXECUTE FUNCTION docs_tsv_update();
+              END IF; END $$;"""
+        )
+        cur.execute("CREATE INDEX IF NOT EXISTS chunks_tsv_idx ON chunks USING GIN (tsv);")
+    conn.commit()
+
+
+def upsert(conn: psycopg.Connection, chunk_hash: str, content: str) -> bool:
+    """Grava o texto se o hash for novo; ``True`` se o trecho ainda não tem embedding."""
+
+    with conn.cursor() as cur:
+        cur.execute(
+            """INSERT INTO chunks(chunk_hash, content, embedding)
+               SELECT %(h)s, %(c)s, (SELECT embedding FROM emb_cache WHERE chunk_hash = %(h)s)
+               ON CONFLICT (chunk_hash) DO NOTHING""",
+            {"h": chunk_hash, "c": content},
+        )
+        cur.execute("SELECT embedding IS NULL FROM chunks WHERE chunk_hash = %s", (chunk_hash,))
+        return cur.fetchone()[0]
+
+
+def gc(conn: psycopg.Connection) -> int:
+    """Remove de ``chunks`` os textos que nenhuma linha de ``docs`` referencia."""
+
+    with conn.cursor() as cur:
+        cur.execute(
+            "DELETE FROM chunks c WHERE NOT EXISTS (SELECT 1 FROM docs d WHERE d.chunk_hash = c.chunk_hash)"
+        )
+        n = cur.rowcount
+    conn.commit()
+    return n
+
+
+def migrate(drop_docs_indexes: bool = False) -> Dict[str, Any]:
+    """Preenche ``chunks`` a partir de ``docs`` e cria o HNSW de ``chunks``.
+
+    Com ``drop_docs_indexes`` os índices GIN/HNSW e o gatilho de ``tsv`` de
+    ``docs`` são removidos (só faça isso com ``CHUNK_STORE=chunks`` em uso).
+    """
+
+    with psycopg.connect(DB_URL) as conn:
+        ensure_schema(conn)
+        with conn.cursor() as cur:
+            cur.execute(
+                """INSERT INTO chunks(chunk_hash, content, embedding)
+                   SELECT DISTINCT ON (d.chunk_hash) d.chunk_hash, d.content, COALESCE(d.embedding, e.embedding)
+                     FROM docs d LEFT JOIN emb_cache e ON e.chunk_hash = d.chunk_hash
+                    ORDER BY d.chunk_hash, d.embedding IS NULL
+                   ON CONFLICT (chunk_hash) DO NOTHING"""
+            )
+            added = cur.rowcount
+            cur.execute("SELECT COUNT(*), COUNT(DISTINCT chunk_hash) FROM docs")
+            rows, unique = cur.fetchone()
+        conn.commit()
+        vector_index.create_index(conn, vector_index.VECTOR_INDEX, "chunks")
+        if drop_docs_indexes:
+            import partitions
+
+            tables = [t for t, _ in partitions.list_partitions(conn)] or ["docs"]
+            for table in tables:
+                vector_index.drop_indexes(conn, table)
+            with conn.cursor() as cur:
+                cur.execute("DROP INDEX IF EXISTS docs_tsv_idx")
+                cur.execute("DROP TRIGGER IF EXISTS docs_tsv_update_tr ON docs")
+            conn.commit()
+    return {"ok": True, "docs": rows, "unique_chunks": unique, "added": added, "docs_indexes_dropped": drop_docs_indexes}
+
+
+def restore_docs() -> Dict[str, Any]:
+    """Copia de volta para ``docs`` o ``embedding`` e o ``tsv`` e recria os índices."""
+
+    import partitions
+
+    with psycopg.connect(DB_URL) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """UPDATE docs d SET embedding = c.embedding, tsv = c.tsv
+                     FROM chunks c
+                    WHERE c.chunk_hash = d.chunk_hash
+                      AND (d.embedding IS NULL OR d.tsv IS NULL)"""
+            )
+            updated = cur.rowcount
+            cur.execute("CREATE INDEX IF NOT EXISTS docs_tsv_idx ON docs USING GIN (tsv)")
+            cur.execute(
+                """DO $$ BEGIN
+                  IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname='docs_tsv_update_tr') THEN
+                    CREATE TRIGGER docs_tsv_update_tr BEFORE INSERT OR UPDATE OF content ON docs
+                    FOR EACH ROW EXECUTE FUNCTION docs_tsv_update();
+                  END IF; END $$;"""
+            )
+        conn.commit()
+        for table in [t for t, _ in partitions.list_partitions(conn)] or ["docs"]:
+            vector_index.create_index(conn, vector_index.VECTOR_INDEX, table)
+    return {"ok": True, "updated": updated}
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="Trechos endereçados por conteúdo (tabela chunks)")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    m = sub.add_parser("migrate", help="Preencher chunks a partir de docs e criar o HNSW")
+    m.add_argument("--drop-docs-indexes", action="store_true", help="Remover GIN/HNSW de docs ao final")
+    sub.add_parser("gc", help="Remover trechos sem referência em docs")
+    sub.add_parser("restore-docs", help="Preencher embedding/tsv de docs e recriar os índices")
+    a = ap.parse_args(argv)
+    if a.cmd == "migrate":
+        out: Any = migrate(a.drop_docs_indexes)
+    elif a.cmd == "restore-docs":
+        out = restore_docs()
+    else:
+        with psycopg.connect(DB_URL) as conn:
+            out = {"ok": True, "removed": gc(conn)}
+    print(json.dumps(out, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover - CLI entry
+    sys.exit(main())
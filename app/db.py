@@ -0,0 +1,91 @@
+"""Conexões com o primário e com réplicas de leitura.
+
+Escritas usam sempre ``DATABASE_URL``. Caminhos só de leitura (busca, cache de
+QA, ``/analysis``, ``/report``) chamam ``connect(readonly=True)``, que alterna
+entre as réplicas de ``DATABASE_URL_RO`` (lista separada por vírgulas). Uma
+réplica que falha ao conectar, ou cujo atraso de replicação passa de
+``DB_RO_MAX_LAG_SECONDS``, fica fora de rotação por ``DB_RO_RETRY_SECONDS``;
+sem réplica saudável, a leitura cai no primário.
+"""
+
+from __future__ import annotations
+
+import itertools
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List
+
+import psycopg
+from psycopg.rows import tuple_row
+
+DB_URL = os.getenv("DATABASE_URL")
+DB_URL_RO: List[str] = [u.strip() for u in os.getenv("DATABASE_URL_RO", "").split(",") if u.strip()]
+RO_CONNECT_TIMEOUT = int(os.getenv("DB_RO_CONNECT_TIMEOUT", "2"))
+RO_RETRY_SECONDS = float(os.getenv("DB_RO_RETRY_SECONDS", "30"))
+RO_MAX_LAG_SECONDS = float(os.getenv("DB_RO_MAX_LAG_SECONDS", "0"))  # 0 = não verifica
+RO_CHECK_SECONDS = float(os.getenv("DB_RO_CHECK_SECONDS", "10"))
+logger = logging.getLogger("sophia.db")
+
+_lock = threading.Lock()
+_rr = itertools.count()
+_down_until: Dict[str, float] = {}
+_checked_at: Dict[str, float] = {}
+
+
+def _mark_down(url: str, reason: Any) -> None:
+    with _lock:
+        _down_until[url] = time.monotonic() + RO_RETRY_SECONDS
+    logger.warning("Réplica fora de rotação por %ss: %s", RO_RETRY_SECONDS, reason)
+
+
+def _lag_ok(conn: psycopg.Connection, url: str) -> bool:
+    if RO_MAX_LAG_SECONDS <= 0:
+        return True
+    now = time.monotonic()
+    if now - _checked_at.get(url, 0.0) < RO_CHECK_SECONDS:
+        return True
+    with conn.cursor(row_factory=tuple_row) as cur:
+        cur.execute("SELECT COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)")
+        lag = cur.fetchone()[0]
+    conn.rollback()
+    _checked_at[url] = now
+    if float(lag) > RO_MAX_LAG_SECONDS:
+        _mark_down(url, f"atraso de replicação {float(lag):.1f}s")
+        return False
+    return True
+
+
+def replicas() -> List[Dict[str, Any]]:
+    """Estado das réplicas (para ``/health``)."""
+
+    now = time.monotonic()
+    return [
+        {"replica": i, "healthy": _down_until.get(url, 0.0) <= now}
+        for i, url in enumerate(DB_URL_RO)
+    ]
+
+
+def connect(readonly: bool = False, **kwargs: Any) -> psycopg.Connection:
+    """Conexão com o primário ou, se ``readonly``, com uma réplica saudável."""
+
+    if readonly and DB_URL_RO:
+        start = next(_rr)
+        now = time.monotonic()
+        for i in range(len(DB_URL_RO)):
+            url = DB_URL_RO[(start + i) % len(DB_URL_RO)]
+            if _down_until.get(url, 0.0) > now:
+                continue
+            try:
+                conn = psycopg.connect(url, connect_timeout=RO_CONNECT_TIMEOUT, **kwargs)
+            except psycopg.OperationalError as exc:
+                _mark_down(url, exc)
+                continue
+            try:
+                if _lag_ok(conn, url):
+                    return conn
+            except psycopg.Error as exc:
+                _mark_down(url, exc)
+            conn.close()
+    return psycopg.connect(DB_URL, **kwargs)
@@ -1,10 +1,11 @@
 """Ferramentas para acionar fine-tuning do modelo conversacional.
 
-Este módulo lê os arquivos JSONL presentes em ``FINETUNE_DIR`` e cria jobs de
-fine-tuning usando o provedor configurado (atualmente, via API compatível com a
-biblioteca ``openai``). Ele também permite consultar o status de jobs
-existentes, útil para acompanhar o progresso e automatizar rotinas de
-atualização de modelo.
+Este módulo monta o dataset a partir dos arquivos JSONL presentes em
+``FINETUNE_DIR`` (validação, deduplicação e contagem de tokens ficam em
+``finetune_dataset``) e cria jobs de fine-tuning usando o provedor configurado
+(atualmente, via API compatível com a biblioteca ``openai``). Ele também
+permite consultar o status de jobs existentes, útil para acompanhar o progresso
+e automatizar rotinas de atualização de modelo.
 """
 from __future__ import annotations
 
@@ -12,13 +13,12 @@ import argparse
 import json
 import os
 import sys
-import tempfile
 import time
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Iterable, Tuple
 
-from openai import OpenAI
+import llm_gateway
+from finetune_dataset import _normalise_record, build_dataset  # noqa: F401 - compat
 
 FINETUNE_DIR = Path(os.getenv("FINETUNE_DIR", "finetune"))
 FINETUNE_BASE = os.getenv("FINETUNE_BASE")
@@ -26,6 +26,7 @@ FINETUNE_HISTORY = Path(
     os.getenv("FINETUNE_HISTORY", FINETUNE_DIR / "history.jsonl")
 )
 POLL_SECONDS = int(os.getenv("FINETUNE_POLL_SECONDS", "10"))
+FINETUNE_MANIFEST = FINETUNE_DIR / "dataset_manifest.json"
 
 
 def _to_dict(obj):
@@ -43,73 +44,20 @@ def _to_dict(obj):
         return {"repr": repr(obj)}
 
 
-def _normalise_record(record: dict) -> dict:
-    """Ensure the record follows the chat fine-tuning schema."""
-
-    if "messages" in record and isinstance(record["messages"], list):
-        return {"messages": record["messages"]}
-
-    question = record.get("question") or record.get("prompt")
-    answer = record.get("answer") or record.get("completion")
-    if not question or not answer:
-        raise ValueError("registro precisa ter question/prompt e answer/completion")
-
-    messages = []
-    system_msg = record.get("system")
-    if system_msg:
-        messages.append({"role": "system", "content": str(system_msg)})
-    messages.append({"role": "user", "content": str(question)})
-    messages.append({"role": "assistant", "content": str(answer)})
-    return {"messages": messages}
-
-
-def _collect_records(directory: Path) -> Tuple[list[dict], list[str]]:
-    if not directory.exists():
-        raise FileNotFoundError(f"FINETUNE_DIR '{directory}' não encontrado")
-
-    records: list[dict] = []
-    sources: list[str] = []
-    for path in sorted(directory.glob("*.jsonl")):
-        with path.open("r", encoding="utf-8") as handle:
-            for lineno, raw in enumerate(handle, start=1):
-                raw = raw.strip()
-                if not raw:
-                    continue
-                try:
-                    obj = json.loads(raw)
-                except json.JSONDecodeError as exc:
-                    raise ValueError(f"JSON inválido em {path}:{lineno}: {exc}") from exc
-                try:
-                    norm = _normalise_record(obj)
-                except ValueError as exc:
-                    raise ValueError(f"Dados incompletos em {path}:{lineno}: {exc}") from exc
-                records.append(norm)
-        sources.append(str(path))
-    return records, sources
-
-
-def _write_dataset(records: Iterable[dict]) -> Path:
-    tmp = tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False, encoding="utf-8")
-    with tmp as handle:
-        for rec in records:
-            handle.write(json.dumps(rec, ensure_ascii=False) + "\n")
-    return Path(tmp.name)
-
-
 def _append_history(entry: dict) -> None:
     FINETUNE_HISTORY.parent.mkdir(parents=True, exist_ok=True)
     with FINETUNE_HISTORY.open("a", encoding="utf-8") as handle:
         handle.write(json.dumps(entry, ensure_ascii=False) + "\n")
 
 
-def _start_job(client: OpenAI, watch: bool = False) -> dict:
+def _start_job(client, watch: bool = False) -> dict:
     if not FINETUNE_BASE:
         raise RuntimeError("FINETUNE_BASE não configurado")
-    records, sources = _collect_records(FINETUNE_DIR)
-    if not records:
+    dataset_path, manifest = build_dataset(FINETUNE_DIR, exclude=[FINETUNE_HISTORY], manifest_path=FINETUNE_MANIFEST)
+    if not manifest["records"]:
+        dataset_path.unlink(missing_ok=True)
         raise RuntimeError(f"Nenhum dado encontrado em {FINETUNE_DIR}")
 
-    dataset_path = _write_dataset(records)
     try:
         upload = client.files.create(file=open(dataset_path, "rb"), purpose="fine-tune")
         job = client.fine_tuning.jobs.create(
@@ -128,8 +76,10 @@ def _start_job(client: OpenAI, watch: bool = False) -> dict:
         "status": job.status,
         "created_at": datetime.now(timezone.utc).isoformat(),
         "training_file": getattr(upload, "id", None),
-        "records": len(records),
-        "sources": sources,
+        "records": manifest["records"],
+        "tokens": manifest["tokens"],
+        "estimated_cost_usd": manifest["estimated_cost_usd"],
+        "sources": [src["source"] for src in manifest["sources"]],
     }
     _append_history(entry)
 
@@ -139,11 +89,18 @@ def _start_job(client: OpenAI, watch: bool = False) -> dict:
     result = {
         "job": job_dict,
         "history_entry": entry,
+        "manifest": manifest,
     }
     return result
 
 
-def _watch_job(client: OpenAI, job_id: str) -> dict:
+def _build_only() -> dict:
+    dataset_path, manifest = build_dataset(FINETUNE_DIR, exclude=[FINETUNE_HISTORY], manifest_path=FINETUNE_MANIFEST)
+    dataset_path.unlink(missing_ok=True)
+    return {"manifest": manifest}
+
+
+def _watch_job(client, job_id: str) -> dict:
     status = None
     job_dict = {}
     while status not in {"succeeded", "failed", "cancelled"}:
@@ -156,7 +113,7 @@ def _watch_job(client: OpenAI, job_id: str) -> dict:
     return job_dict
 
 
-def _status_job(client: OpenAI, job_id: str, watch: bool = False) -> dict:
+def _status_job(client, job_id: str, watch: bool = False) -> dict:
     if watch:
         job_dict = _watch_job(client, job_id)
     else:
@@ -172,9 +129,24 @@ def main(argv: list[str] | None = None) -> int:
     parser = argparse.ArgumentParser(description="Gerenciar jobs de fine-tuning do modelo de QA")
     parser.add_argument("--status", dest="status", help="Consultar job existente")
     parser.add_argument("--watch", dest="watch", action="store_true", help="Aguardar conclusão do job")
+    parser.add_argument(
+        "--dry-run",
+        dest="dry_run",
+        action="store_true",
+        help="Só validar o dataset e exibir o manifesto (tokens e custo estimado)",
+    )
     args = parser.parse_args(argv)
 
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    if args.dry_run:
+        try:
+            result = _build_only()
+        except Exception as exc:  # pragma: no cover - script style
+            print(json.dumps({"ok": False, "error": str(exc)}), file=sys.stderr)
+            return 1
+        print(json.dumps({"ok": True, **result}, ensure_ascii=False))
+        return 0
+
+    client = llm_gateway.client("finetune")
 
     try:
         if args.status:
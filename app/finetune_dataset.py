@@ -0,0 +1,229 @@
+"""Montagem validada do dataset de fine-tuning.
+
+Os arquivos ``*.jsonl`` de ``FINETUNE_DIR`` são validados e normalizados em
+paralelo (um processo por arquivo). Cada processo grava uma parte temporária
+com ``hash``, contagem de tokens e o registro normalizado; a etapa final junta
+as partes direto no arquivo de upload, descartando repetições pelo hash das
+mensagens. Os snapshots ``train[_<ts>]``/``val[_<ts>]`` de ``finetune_export.py`` e o
+histórico de jobs não entram no dataset.
+
+Linhas inválidas (inclusive as que não são objetos JSON) interrompem a
+montagem antes de qualquer upload; exemplos acima de ``FINETUNE_MAX_TOKENS``
+são rejeitados. As contagens ficam no manifesto, gravado ao lado do dataset.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+FINETUNE_BASE = os.getenv("FINETUNE_BASE") or "gpt-4o-mini"
+MAX_TOKENS = int(os.getenv("FINETUNE_MAX_TOKENS", "65536"))
+MAX_ERRORS = int(os.getenv("FINETUNE_MAX_ERRORS", "20"))
+WORKERS = int(os.getenv("FINETUNE_BUILD_WORKERS", str(min(8, os.cpu_count() or 1))))
+EPOCHS = int(os.getenv("FINETUNE_EPOCHS", "3"))
+PRICE_PER_MTOK = float(os.getenv("FINETUNE_PRICE_PER_MTOK", "3.0"))
+# Snapshots de finetune_export.py: train.jsonl, val_20240101_120000.jsonl etc.
+EXPORT_ARTIFACT_RE = re.compile(r"(train|val)(_\d+.*)?\.jsonl")
+EXCLUDED_NAMES = {"history.jsonl"}
+
+_ENCODER = None
+
+
+def _normalise_record(record: dict) -> dict:
+    """Ensure the record follows the chat fine-tuning schema."""
+
+    if not isinstance(record, dict):
+        raise ValueError("registro precisa ser um objeto JSON")
+    if "messages" in record and isinstance(record["messages"], list):
+        return {"messages": record["messages"]}
+
+    question = record.get("question") or record.get("prompt")
+    answer = record.get("answer") or record.get("completion")
+    if not question or not answer:
+        raise ValueError("registro precisa ter question/prompt e answer/completion")
+
+    messages = []
+    system_msg = record.get("system")
+    if system_msg:
+        messages.append({"role": "system", "content": str(system_msg)})
+    messages.append({"role": "user", "content": str(question)})
+    messages.append({"role": "assistant", "content": str(answer)})
+    return {"messages": messages}
+
+
+def _validate_messages(messages: List[Any]) -> None:
+    if not messages:
+        raise ValueError("messages vazio")
+    for msg in messages:
+        if not isinstance(msg, dict) or msg.get("role") not in {"system", "user", "assistant", "tool"}:
+            raise ValueError(f"mensagem inválida: {msg!r}"[:200])
+        if msg.get("content") is None and not msg.get("tool_calls"):
+            raise ValueError("mensagem sem content")
+    if not any(m.get("role") == "assistant" for m in messages):
+        raise ValueError("nenhuma mensagem do assistant")
+
+
+def _encoder():
+    global _ENCODER
+    if _ENCODER is None:
+        try:
+            import tiktoken
+
+            try:
+                _ENCODER = tiktoken.encoding_for_model(FINETUNE_BASE)
+            except KeyError:
+                _ENCODER = tiktoken.get_encoding("o200k_base")
+        except ImportError:  # pragma: no cover - estimativa sem tiktoken
+            _ENCODER = False
+    return _ENCODER
+
+
+def count_tokens(messages: List[Dict[str, Any]]) -> int:
+    """Tokens do exemplo no formato de chat (conteúdo + overhead por mensagem)."""
+
+    enc = _encoder()
+    total = 3
+    for msg in messages:
+        content = msg.get("content") or ""
+        if not isinstance(content, str):
+            content = json.dumps(content, ensure_ascii=False)
+        total += 4 + (len(enc.encode(content, disallowed_special=())) if enc else len(content) // 4)
+    return total
+
+
+def message_hash(messages: List[Dict[str, Any]]) -> str:
+    raw = json.dumps(messages, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def list_sources(directory: Path, exclude: Iterable[Path] = ()) -> List[Path]:
+    if not directory.exists():
+        raise FileNotFoundError(f"FINETUNE_DIR '{directory}' não encontrado")
+    skip = {Path(p).resolve() for p in exclude}
+    return [
+        p
+        for p in sorted(directory.glob("*.jsonl"))
+        if p.name not in EXCLUDED_NAMES
+        and not EXPORT_ARTIFACT_RE.fullmatch(p.name)
+        and p.resolve() not in skip
+    ]
+
+
+def _process_file(path: str, part_dir: str) -> Dict[str, Any]:
+    """Valida um arquivo e grava ``hash\\ttokens\\tjson`` numa parte temporária."""
+
+    stats = {"source": path, "part": None, "records": 0, "rejected": 0, "invalid": 0, "tokens": 0, "errors": []}
+    fd, part = tempfile.mkstemp(suffix=".part", dir=part_dir)
+    stats["part"] = part
+    with os.fdopen(fd, "w", encoding="utf-8") as out, open(path, "r", encoding="utf-8") as handle:
+        for lineno, raw in enumerate(handle, start=1):
+            raw = raw.strip()
+            if not raw:
+                continue
+            try:
+                norm = _normalise_record(json.loads(raw))
+                _validate_messages(norm["messages"])
+            except (json.JSONDecodeError, ValueError, AttributeError) as exc:
+                stats["invalid"] += 1
+                if len(stats["errors"]) < MAX_ERRORS:
+                    stats["errors"].append(f"{path}:{lineno}: {exc}")
+                continue
+            tokens = count_tokens(norm["messages"])
+            if tokens > MAX_TOKENS:
+                stats["rejected"] += 1
+                continue
+            out.write(f"{message_hash(norm['messages'])}\t{tokens}\t{json.dumps(norm, ensure_ascii=False)}\n")
+            stats["records"] += 1
+            stats["tokens"] += tokens
+    return stats
+
+
+def _source_stats(st: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: st[k] for k in ("source", "records", "rejected", "invalid", "tokens")}
+
+
+def _write_manifest(path: Path, manifest: Dict[str, Any]) -> None:
+    """Grava o manifesto da montagem junto do dataset, para consulta posterior."""
+
+    manifest = {**manifest, "built_at": datetime.now(timezone.utc).isoformat()}
+    path.write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+def build_dataset(
+    directory: Path,
+    output: Optional[Path] = None,
+    workers: int = WORKERS,
+    exclude: Iterable[Path] = (),
+    manifest_path: Optional[Path] = None,
+) -> Tuple[Path, Dict[str, Any]]:
+    """Monta o arquivo de upload e devolve ``(caminho, manifesto)``.
+
+    O manifesto também é gravado em ``manifest_path`` (padrão: ao lado de
+    ``output``, com sufixo ``.manifest.json``), inclusive quando a montagem
+    falha. Levanta ``ValueError`` com as primeiras linhas inválidas, se houver.
+    """
+
+    sources = list_sources(directory, exclude)
+    if output is None:
+        fd, name = tempfile.mkstemp(suffix=".jsonl")
+        os.close(fd)
+        output = Path(name)
+    if manifest_path is None:
+        manifest_path = output.with_suffix(".manifest.json")
+    with tempfile.TemporaryDirectory(prefix="ft_parts_") as part_dir:
+        with ProcessPoolExecutor(max_workers=max(1, workers)) as ex:
+            stats = list(ex.map(_process_file, [str(p) for p in sources], [part_dir] * len(sources)))
+        errors = [e for st in stats for e in st["errors"]]
+        if errors:
+            output.unlink(missing_ok=True)
+            _write_manifest(
+                manifest_path,
+                {
+                    "records": 0,
+                    "invalid": sum(st["invalid"] for st in stats),
+                    "errors": errors[:MAX_ERRORS],
+                    "sources": [_source_stats(st) for st in stats],
+                },
+            )
+            raise ValueError("Dados inválidos:\n" + "\n".join(errors[:MAX_ERRORS]))
+
+        seen: set[str] = set()
+        written = duplicates = total_tokens = 0
+        per_source = []
+        with output.open("w", encoding="utf-8") as dst:
+            for st in stats:
+                kept = 0
+                with open(st["part"], "r", encoding="utf-8") as part:
+                    for line in part:
+                        digest, tokens, payload = line.rstrip("\n").split("\t", 2)
+                        if digest in seen:
+                            duplicates += 1
+                            continue
+                        seen.add(digest)
+                        dst.write(payload + "\n")
+                        kept += 1
+                        total_tokens += int(tokens)
+                written += kept
+                per_source.append({**_source_stats(st), "kept": kept})
+
+    manifest = {
+        "records": written,
+        "duplicates": duplicates,
+        "rejected_too_long": sum(st["rejected"] for st in stats),
+        "invalid": 0,
+        "max_tokens": MAX_TOKENS,
+        "tokens": total_tokens,
+        "avg_tokens": round(total_tokens / written, 1) if written else 0,
+        "epochs": EPOCHS,
+        "estimated_cost_usd": round(total_tokens * EPOCHS * PRICE_PER_MTOK / 1_000_000, 4),
+        "sources": per_source,
+    }
+    _write_manifest(manifest_path, manifest)
+    return output, manifest
@@ -1,5 +1,5 @@
 from pathlib import Path
-import os, json, random, math
+import os, json, hashlib, argparse, shutil
 from datetime import datetime
 import psycopg
 from psycopg.rows import dict_row
@@ -12,6 +12,10 @@ DB_URL = os.getenv("DATABASE_URL")
 FINETUNE_DIR = Path(os.getenv("FINETUNE_DIR", "/opt/rag-sophia/finetune"))
 VAL_SPLIT = float(os.getenv("FINETUNE_VAL_SPLIT", "0.1"))
 SEED = int(os.getenv("FINETUNE_SEED", "42"))
+EXPORT_LIMIT = int(os.getenv("FINETUNE_EXPORT_LIMIT", "0"))  # 0 = sem limite por fonte
+ITERSIZE = int(os.getenv("FINETUNE_EXPORT_ITERSIZE", "2000"))
+STATE_P = FINETUNE_DIR / "export_state.json"
+HASHES_P = FINETUNE_DIR / "export_hashes.txt"
 
 FINETUNE_DIR.mkdir(parents=True, exist_ok=True)
 
@@ -25,67 +29,183 @@ def _msg(system, user, assistant):
 SYSTEM_PROMPT = ("Você é um analista jurídico-regulatório. Responda usando apenas o contexto, "
                  "cite fontes como [#n] + caminho e diga 'falta base' quando faltar.")
 
-def fetch(conn):
-    out = []
-    with conn.cursor(row_factory=dict_row) as cur:
-        cur.execute("SELECT question, answer, citations FROM qa_cache ORDER BY created_at DESC LIMIT 5000;")
-        for r in cur.fetchall():
-            q = (r["question"] or "").strip()
-            a = (r["answer"] or "").strip()
-            if not q or not a: continue
-            out.append(_msg(SYSTEM_PROMPT, q, a))
-    with conn.cursor(row_factory=dict_row) as cur:
-        cur.execute("SELECT path, summary, pros, cons FROM doc_analysis ORDER BY created_at DESC LIMIT 5000;")
-        for r in cur.fetchall():
-            path = r["path"]
-            summ = (r.get("summary") or "").strip()
-            pros = r.get("pros") or []
-            cons = r.get("cons") or []
-            if summ:
-                user = f"Resuma criticamente o documento e cite [#] com caminhos.\nDocumento: {path}"
-                out.append(_msg(SYSTEM_PROMPT, user, summ))
-            if pros or cons:
-                user = f"Liste prós e contras fundamentados de {path} com citações [#]."
-                as_lines=[]
-                if pros:
-                    as_lines.append("**Prós:**")
-                    for it in pros[:10]:
-                        as_lines.append(f"- {it.get('claim','')} — {it.get('why','')}")
-                if cons:
-                    as_lines.append("**Contras:**")
-                    for it in cons[:10]:
-                        as_lines.append(f"- {it.get('claim','')} — {it.get('why','')}")
-                out.append(_msg(SYSTEM_PROMPT, user, "\n".join(as_lines)))
-    with conn.cursor(row_factory=dict_row) as cur:
-        cur.execute("SELECT text FROM notes ORDER BY created_at DESC LIMIT 1000;")
-        for r in cur.fetchall():
-            t = (r["text"] or "").strip()
-            if t:
-                user = "Explique a nota abaixo e aponte 'falta base' se não houver citação suficiente.\nNota:\n" + t
-                out.append(_msg(SYSTEM_PROMPT, user, "falta base"))
-    return out
-
-def main():
-    random.seed(SEED)
-    with psycopg.connect(DB_URL) as conn:
-        data = fetch(conn)
-    random.shuffle(data)
-    n = len(data)
-    n_val = max(1, math.floor(n * VAL_SPLIT)) if n > 10 else 1
-    train = data[n_val:]
-    val = data[:n_val]
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    train_p = FINETUNE_DIR / f"train_{ts}.jsonl"
-    val_p   = FINETUNE_DIR / f"val_{ts}.jsonl"
-    with train_p.open("w", encoding="utf-8") as f:
-        for ex in train: f.write(json.dumps(ex, ensure_ascii=False) + "\n")
-    with val_p.open("w", encoding="utf-8") as f:
-        for ex in val: f.write(json.dumps(ex, ensure_ascii=False) + "\n")
-    (FINETUNE_DIR / "train.jsonl").unlink(missing_ok=True)
-    (FINETUNE_DIR / "val.jsonl").unlink(missing_ok=True)
-    (FINETUNE_DIR / "train.jsonl").symlink_to(train_p.name)
-    (FINETUNE_DIR / "val.jsonl").symlink_to(val_p.name)
-    print(json.dumps({"ok": True, "train": str(train_p), "val": str(val_p), "n": n, "val_split": n_val}, ensure_ascii=False))
+SOURCES = {
+    "qa_cache": "SELECT question, answer, created_at FROM qa_cache",
+    "doc_analysis": "SELECT path, summary, pros, cons, created_at FROM doc_analysis",
+    "notes": "SELECT text, created_at FROM notes",
+}
+
+def _examples(source, r):
+    if source == "qa_cache":
+        q = (r["question"] or "").strip()
+        a = (r["answer"] or "").strip()
+        if q and a:
+            yield _msg(SYSTEM_PROMPT, q, a)
+    elif source == "doc_analysis":
+        path = r["path"]
+        summ = (r.get("summary") or "").strip()
+        pros = r.get("pros") or []
+        cons = r.get("cons") or []
+        if summ:
+            user = f"Resuma criticamente o documento e cite [#] com caminhos.\nDocumento: {path}"
+            yield _msg(SYSTEM_PROMPT, user, summ)
+        if pros or cons:
+            user = f"Liste prós e contras fundamentados de {path} com citações [#]."
+            as_lines=[]
+            if pros:
+                as_lines.append("**Prós:**")
+                for it in pros[:10]:
+                    as_lines.append(f"- {it.get('claim','')} — {it.get('why','')}")
+            if cons:
+                as_lines.append("**Contras:**")
+                for it in cons[:10]:
+                    as_lines.append(f"- {it.get('claim','')} — {it.get('why','')}")
+            yield _msg(SYSTEM_PROMPT, user, "\n".join(as_lines))
+    elif source == "notes":
+        t = (r["text"] or "").strip()
+        if t:
+            user = "Explique a nota abaixo e aponte 'falta base' se não houver citação suficiente.\nNota:\n" + t
+            yield _msg(SYSTEM_PROMPT, user, "falta base")
+
+def fetch(conn, since=None, watermarks=None):
+    """Gera ``(fonte, exemplo)`` lendo cada tabela por cursor nomeado no servidor.
+
+    ``since`` traz o watermark (``created_at``) de cada fonte; só linhas mais
+    novas são lidas. ``watermarks`` é atualizado com o maior ``created_at`` visto.
+    """
+    since = since or {}
+    latest = {}
+    for source, base in SOURCES.items():
+        sql = base
+        params = []
+        if since.get(source):
+            sql += " WHERE created_at > %s"
+            params.append(since[source])
+        sql += " ORDER BY created_at ASC"
+        if EXPORT_LIMIT > 0:
+            sql += " LIMIT %s"
+            params.append(EXPORT_LIMIT)
+        with conn.cursor(name=f"export_{source}", row_factory=dict_row) as cur:
+            cur.itersize = ITERSIZE
+            cur.execute(sql, params)
+            for r in cur:
+                if r["created_at"] is not None:
+                    latest[source] = r["created_at"]
+                for ex in _examples(source, r):
+                    yield source, ex
+        if watermarks is not None and source in latest:
+            watermarks[source] = latest[source].isoformat()
+
+def content_hash(ex):
+    raw = json.dumps(ex["messages"], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(f"{SEED}:{raw}".encode("utf-8")).hexdigest()
+
+def is_val(h):
+    """Divisão determinística: a mesma amostra cai sempre no mesmo conjunto."""
+    return int(h[:8], 16) / 0xFFFFFFFF < VAL_SPLIT
+
+def _load_state():
+    if STATE_P.exists():
+        try:
+            return json.loads(STATE_P.read_text(encoding="utf-8"))
+        except json.JSONDecodeError:
+            return None
+    return None
+
+def _load_hashes():
+    if not HASHES_P.exists():
+        return set()
+    with HASHES_P.open("r", encoding="utf-8") as f:
+        return {l.strip() for l in f if l.strip()}
+
+def _relink(name, target):
+    link = FINETUNE_DIR / name
+    link.unlink(missing_ok=True)
+    link.symlink_to(target.name)
+
+def _staging(target, keep):
+    """Cópia temporária de ``target`` (ou arquivo vazio) para gravar o export."""
+    tmp = target.with_name(target.name + ".tmp")
+    if keep and target.exists():
+        shutil.copyfile(target, tmp)
+    else:
+        tmp.write_text("", encoding="utf-8")
+    return tmp
+
+def export(incremental=False):
+    state = _load_state() if incremental else None
+    if state and Path(state["train"]).exists() and Path(state["val"]).exists():
+        mode = "incremental"
+        train_p, val_p = Path(state["train"]), Path(state["val"])
+        since = state.get("watermarks", {})
+        seen = _load_hashes()
+    else:
+        mode = "full"
+        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+        train_p = FINETUNE_DIR / f"train_{ts}.jsonl"
+        val_p = FINETUNE_DIR / f"val_{ts}.jsonl"
+        since = {}
+        seen = set()
+    watermarks = dict(since)
+    n = n_val = dups = 0
+    held = None
+    # Tudo é gravado em arquivos temporários e só substitui train/val/hashes e
+    # o estado depois que o export termina; uma falha no meio não deixa o
+    # arquivo de hashes truncado nem o estado apontando para dados parciais.
+    keep = mode == "incremental"
+    staged = {p: _staging(p, keep) for p in (train_p, val_p, HASHES_P)}
+    try:
+        with psycopg.connect(DB_URL) as conn, \
+                staged[train_p].open("a", encoding="utf-8") as ft, \
+                staged[val_p].open("a", encoding="utf-8") as fv, \
+                staged[HASHES_P].open("a", encoding="utf-8") as fh:
+            for _, ex in fetch(conn, since, watermarks):
+                h = content_hash(ex)
+                if h in seen:
+                    dups += 1
+                    continue
+                seen.add(h)
+                fh.write(h + "\n")
+                line = json.dumps(ex, ensure_ascii=False) + "\n"
+                if is_val(h):
+                    fv.write(line); n_val += 1
+                elif mode == "full" and held is None:
+                    # Guardado até o fim: vai para a validação se ela ficar vazia.
+                    held = line
+                else:
+                    ft.write(line)
+                n += 1
+            if held is not None:
+                if n_val == 0:
+                    # O job de fine-tuning exige um arquivo de validação não vazio.
+                    fv.write(held); n_val = 1
+                else:
+                    ft.write(held)
+    except BaseException:
+        for tmp in staged.values():
+            tmp.unlink(missing_ok=True)
+        raise
+    for target, tmp in staged.items():
+        os.replace(tmp, target)
+    if mode == "full":
+        _relink("train.jsonl", train_p)
+        _relink("val.jsonl", val_p)
+    state_tmp = STATE_P.with_name(STATE_P.name + ".tmp")
+    state_tmp.write_text(json.dumps({
+        "train": str(train_p), "val": str(val_p), "watermarks": watermarks,
+        "updated_at": datetime.now().isoformat(),
+    }, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(state_tmp, STATE_P)
+    return {"ok": True, "mode": mode, "train": str(train_p), "val": str(val_p),
+            "n": n, "val_split": n_val, "duplicates": dups}
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Exportar datasets de fine-tuning (train/val)")
+    ap.add_argument("--incremental", action="store_true",
+                    default=os.getenv("FINETUNE_EXPORT_INCREMENTAL", "false").lower() == "true",
+                    help="Acrescenta só registros novos desde o último export")
+    args = ap.parse_args(argv)
+    print(json.dumps(export(args.incremental), ensure_ascii=False))
 
 if __name__ == "__main__":
     main()
@@ -1,7 +1,6 @@
 import os, json, time, sys
 from pathlib import Path
 from dotenv import load_dotenv
-from openai import OpenAI
 import psycopg
 from psycopg.rows import dict_row
 from psycopg.types.json import Json
@@ -9,6 +8,8 @@ from psycopg.types.json import Json
 APP_DIR = Path(__file__).parent
 load_dotenv(APP_DIR / ".env", override=True)
 
+import llm_gateway  # noqa: E402 - lê o .env acima
+
 DB_URL = os.getenv("DATABASE_URL")
 FINETUNE_DIR = Path(os.getenv("FINETUNE_DIR","/opt/rag-sophia/finetune"))
 BASE = os.getenv("FINETUNE_BASE","gpt-4o-mini")
@@ -35,7 +36,7 @@ def update_run(conn, rid, **k):
         cur.execute(f"UPDATE finetune_runs SET {sets_clause} WHERE id=%s", tuple(vals)); conn.commit()
 
 def main():
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    client = llm_gateway.client("finetune")
     train_p = FINETUNE_DIR / "train.jsonl"; val_p = FINETUNE_DIR / "val.jsonl"
     if not train_p.exists() or not val_p.exists():
         print("datasets ausentes; rode finetune_export.py", file=sys.stderr); sys.exit(2)
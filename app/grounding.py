@@ -0,0 +1,129 @@
+"""Verificação local e determinística do apoio das frases às citações.
+
+A resposta é dividida em frases; cada ``[#n]`` é resolvido para o bloco de
+contexto correspondente e o apoio é medido pela sobreposição de unigramas e
+bigramas (sem acentos nem stopwords) entre a frase e o bloco citado. Frases
+sem citação são comparadas com o bloco de maior BM25. Nenhuma chamada externa
+é feita; o verificador por LLM só precisa olhar as frases abaixo de
+``GROUNDING_MIN_SUPPORT``.
+"""
+
+from __future__ import annotations
+
+import math
+import os
+import re
+import unicodedata
+from collections import Counter
+from typing import Any, Dict, List, Optional, Sequence
+
+GROUNDING_MIN_SUPPORT = float(os.getenv("GROUNDING_MIN_SUPPORT", "0.35"))
+GROUNDING_MIN_TOKENS = int(os.getenv("GROUNDING_MIN_TOKENS", "4"))
+UNSUPPORTED_MARK = " (sem apoio claro no contexto)"
+
+_STOP = set(
+    """a ao aos as ate com como da das de dela dele deles do dos e ela ele eles em entre era essa esse esta
+    este foi for ha isso isto ja mais mas mesmo muito na nas nao no nos num numa o os ou para pela pelas pelo
+    pelos por qual quando que se sem ser seu sua seus suas sao sobre tambem tem um uma umas uns foram sera
+    pode podem deve devem bem onde""".split()
+)
+_CITE = re.compile(r"\[#(\d+)\]")
+_SENT = re.compile(r"(?<=[.!?;:])\s+(?=\S)|\n+")
+
+
+def _norm(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(ch for ch in text if not unicodedata.combining(ch))
+
+
+def tokens(text: str) -> List[str]:
+    return [t for t in re.findall(r"[a-z0-9]+", _norm(_CITE.sub(" ", text))) if len(t) > 1 and t not in _STOP]
+
+
+def _bigrams(toks: Sequence[str]) -> set:
+    return set(zip(toks, toks[1:]))
+
+
+def sentences(text: str) -> List[str]:
+    return [s.strip() for s in _SENT.split(text or "") if s.strip()]
+
+
+def overlap(sent_toks: Sequence[str], block_toks: Sequence[str]) -> float:
+    """Fração dos unigramas e bigramas da frase presentes no bloco (média das duas)."""
+
+    if not sent_toks:
+        return 1.0
+    bt = set(block_toks)
+    uni = sum(1 for t in set(sent_toks) if t in bt) / len(set(sent_toks))
+    sb = _bigrams(sent_toks)
+    if not sb:
+        return uni
+    bi = len(sb & _bigrams(block_toks)) / len(sb)
+    return (uni + bi) / 2
+
+
+class BM25:
+    def __init__(self, docs: Sequence[Sequence[str]], k1: float = 1.2, b: float = 0.75):
+        self.docs = [Counter(d) for d in docs]
+        self.lens = [len(d) for d in docs]
+        self.avg = (sum(self.lens) / len(self.lens)) if self.lens else 0.0
+        df: Counter = Counter()
+        for d in self.docs:
+            df.update(d.keys())
+        n = len(self.docs)
+        self.idf = {t: math.log(1 + (n - c + 0.5) / (c + 0.5)) for t, c in df.items()}
+        self.k1, self.b = k1, b
+
+    def score(self, query: Sequence[str], i: int) -> float:
+        d, ln = self.docs[i], self.lens[i]
+        out = 0.0
+        for t in set(query):
+            f = d.get(t, 0)
+            if f:
+                out += self.idf[t] * f * (self.k1 + 1) / (f + self.k1 * (1 - self.b + self.b * ln / (self.avg or 1)))
+        return out
+
+    def best(self, query: Sequence[str]) -> Optional[int]:
+        scores = [self.score(query, i) for i in range(len(self.docs))]
+        if not scores or max(scores) <= 0:
+            return None
+        return scores.index(max(scores))
+
+
+def check(draft: str, blocks: Sequence[str]) -> List[Dict[str, Any]]:
+    """Uma entrada por frase: ``text``, ``cited``, ``block`` usado e ``support`` (0..1)."""
+
+    btoks = [tokens(b) for b in blocks]
+    bm25 = BM25(btoks)
+    out = []
+    for sent in sentences(draft):
+        st = tokens(sent)
+        cited = [int(n) for n in _CITE.findall(sent) if 1 <= int(n) <= len(blocks)]
+        item: Dict[str, Any] = {"text": sent, "cited": cited, "block": None, "support": 1.0}
+        if len(st) >= GROUNDING_MIN_TOKENS:
+            top = None if cited else bm25.best(st)
+            candidates = cited or ([top + 1] if top is not None else [])
+            best, support = None, 0.0
+            for n in candidates:
+                s = overlap(st, btoks[n - 1])
+                if s > support or best is None:
+                    best, support = n, s
+            item["block"], item["support"] = best, round(support, 3)
+        out.append(item)
+    return out
+
+
+def weak(report: Sequence[Dict[str, Any]], threshold: float = GROUNDING_MIN_SUPPORT) -> List[Dict[str, Any]]:
+    return [r for r in report if r["support"] < threshold]
+
+
+def apply(draft: str, report: Sequence[Dict[str, Any]], action: str = "flag", threshold: float = GROUNDING_MIN_SUPPORT) -> str:
+    """Marca (``flag``) ou remove (``strip``) as frases sem apoio suficiente."""
+
+    out = draft
+    for r in weak(report, threshold):
+        if action == "strip":
+            out = out.replace(r["text"], "", 1)
+        else:
+            out = out.replace(r["text"], r["text"] + UNSUPPORTED_MARK, 1)
+    return re.sub(r"[ \t]{2,}", " ", out).strip()
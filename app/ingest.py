@@ -0,0 +1,272 @@
+from pathlib import Path
+import os, hashlib, threading, queue, time
+from datetime import datetime
+from dotenv import load_dotenv
+import psycopg
+from psycopg.rows import dict_row
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import deque
+from tqdm import tqdm
+from utils_text import (extract_text_no_ocr, extract_text_full, chunk_by_tokens, sha256_file,
+    pdf_is_likely_textual)
+import vector_index, partitions, llm_gateway, chunk_store, ingest_stats, chunk_graph
+load_dotenv(Path(__file__).with_name(".env"), override=True)
+DATA_DIR = Path(os.getenv("DATA_DIR",".")).expanduser()
+DB_URL = os.getenv("DATABASE_URL")
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS","1100"))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP","100"))
+MAX_WORKERS = int(os.getenv("MAX_WORKERS","8"))
+OCR_WORKERS = int(os.getenv("OCR_WORKERS","2"))
+EMBED_MODEL = os.getenv("EMBED_MODEL","text-embedding-3-small")
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE","256"))
+EMBED_TOKEN_BUDGET = int(os.getenv("EMBED_TOKEN_BUDGET","220000"))
+EMBED_DIM = int(os.getenv("EMBED_DIM","1536"))
+OCR_ENABLED = os.getenv("OCR_ENABLED","false").lower() == "true"
+LOG_LINES = int(os.getenv("LOG_LINES","5"))
+LOG_EVERY = int(os.getenv("LOG_EVERY","120"))
+DELTA_MODE = os.getenv("DELTA_MODE","mtime_size")
+ALLOWED_EXT = {".pdf",".html",".htm",".xlsx",".xls",".txt"}
+def ensure_schema(conn):
+    with conn.cursor() as cur:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS vector; CREATE EXTENSION IF NOT EXISTS unaccent;")
+        cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS docs (
+          id BIGSERIAL PRIMARY KEY,
+          path TEXT NOT NULL,
+          chunk_no INT NOT NULL,
+          chunk_hash TEXT NOT NULL,
+          sha256 TEXT NOT NULL,
+          mime TEXT,
+          size_bytes BIGINT,
+          mtime TIMESTAMPTZ,
+          title TEXT,
+          content TEXT NOT NULL,
+          meta JSONB DEFAULT '{{}}'::jsonb,
+          embedding VECTOR({EMBED_DIM}),
+          tsv TSVECTOR,
+          UNIQUE(path, chunk_no)
+        );""")
+        cur.execute(f"""CREATE TABLE IF NOT EXISTS emb_cache (chunk_hash TEXT PRIMARY KEY, embedding VECTOR({EMBED_DIM}) NOT NULL, created_at TIMESTAMPTZ DEFAULT now());""")
+        cur.execute("""CREATE TABLE IF NOT EXISTS file_inventory (path TEXT PRIMARY KEY, size_bytes BIGINT NOT NULL, mtime TIMESTAMPTZ NOT NULL, sha256 TEXT, last_seen TIMESTAMPTZ DEFAULT now());""")
+        cur.execute("""
+        CREATE OR REPLACE FUNCTION docs_tsv_update() RETURNS trigger AS $f$
+        BEGIN NEW.tsv := to_tsvector('portuguese', unaccent(coalesce(NEW.content, ''))); RETURN NEW; END $f$ LANGUAGE plpgsql;""")
+        if not chunk_store.enabled():
+            # Com CHUNK_STORE=chunks o tsv e o GIN ficam em chunks (chunk_store.ensure_schema).
+            cur.execute("""DO $$ BEGIN
+              IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname='docs_tsv_update_tr') THEN
+                CREATE TRIGGER docs_tsv_update_tr BEFORE INSERT OR UPDATE OF content ON docs
+                FOR EACH ROW EXECUTE FUNCTION docs_tsv_update();
+              END IF; END $$;""")
+            cur.execute("CREATE INDEX IF NOT EXISTS docs_tsv_idx ON docs USING GIN (tsv);")
+        cur.execute("CREATE INDEX IF NOT EXISTS docs_meta_gin ON docs USING GIN (meta);")
+        cur.execute("CREATE INDEX IF NOT EXISTS docs_chunk_hash_idx ON docs (chunk_hash);")
+    conn.commit()
+    chunk_store.ensure_schema(conn)
+def hnsw_tables(conn, paths):
+    """Tabelas cujo HNSW é refeito: ``docs``, ``chunks`` ou só as partições tocadas por ``paths``."""
+    if chunk_store.enabled(): return ["chunks"]
+    if not partitions.is_partitioned(conn): return ["docs"]
+    return sorted({partitions.ensure_partition(conn, partitions.partition_key(str(p))) for p in paths})
+def drop_hnsw_if_exists(conn, tables=("docs",)):
+    for t in tables: vector_index.drop_indexes(conn, t)
+def create_hnsw_concurrently(conn, tables=("docs",)):
+    for t in tables: vector_index.create_index(conn, vector_index.VECTOR_INDEX, t)
+def clean_text_safe(s:str)->str: return (s or "").replace("\x00"," ").strip()
+def upsert_chunk(conn, path, chunk_no, chunk_hash, sha256, size_bytes, mtime, title, content, meta):
+    title = clean_text_safe(title); content = clean_text_safe(content)
+    if partitions.is_partitioned(conn):
+        with conn.cursor(row_factory=dict_row) as cur:
+            cur.execute("""
+              INSERT INTO docs(part, path, chunk_no, chunk_hash, sha256, size_bytes, mtime, title, content, meta)
+              VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+              ON CONFLICT (part, path, chunk_no) DO UPDATE SET
+                chunk_hash=EXCLUDED.chunk_hash, sha256=EXCLUDED.sha256, size_bytes=EXCLUDED.size_bytes,
+                mtime=EXCLUDED.mtime, title=EXCLUDED.title, content=EXCLUDED.content, meta=EXCLUDED.meta
+              RETURNING id;""",(partitions.partition_key(path), path, chunk_no, chunk_hash, sha256, size_bytes, mtime, title, content, psycopg.types.json.Json(meta)))
+            return cur.fetchone()["id"]
+    with conn.cursor(row_factory=dict_row) as cur:
+        cur.execute("""
+          INSERT INTO docs(path, chunk_no, chunk_hash, sha256, size_bytes, mtime, title, content, meta)
+          VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s)
+          ON CONFLICT (path, chunk_no) DO UPDATE SET
+            chunk_hash=EXCLUDED.chunk_hash, sha256=EXCLUDED.sha256, size_bytes=EXCLUDED.size_bytes,
+            mtime=EXCLUDED.mtime, title=EXCLUDED.title, content=EXCLUDED.content, meta=EXCLUDED.meta
+          RETURNING id;""",(path, chunk_no, chunk_hash, sha256, size_bytes, mtime, title, content, psycopg.types.json.Json(meta)))
+        return cur.fetchone()["id"]
+class EmbeddingWorker(threading.Thread):
+    def __init__(self, dsn, batch_size, model, token_budget, prof=None):
+        super().__init__(daemon=True); self.dsn=dsn; self.batch_size=batch_size; self.model=model; self.token_budget=token_budget; self.prof=prof
+        self.q=queue.Queue(maxsize=max(64, batch_size*8)); self.stop=False; self.pending=[]; self.pending_tokens=0; self.last_flush=0.0; self.max_wait=10.0
+        import tiktoken as tk; self.enc=tk.get_encoding("cl100k_base")
+    def run(self):
+        with psycopg.connect(self.dsn) as conn:
+            with conn.cursor() as cur: cur.execute("SET synchronous_commit=off;")
+            while not self.stop or self.pending:
+                try:
+                    item=self.q.get(timeout=0.3)
+                    if item is None: self.stop=True; continue
+                    self._queue(item, conn)
+                except queue.Empty: pass
+                if self.pending and (time.time()-self.last_flush)>=self.max_wait: self._flush(conn)
+            if self.pending: self._flush(conn)
+    def _queue(self, item, conn):
+        doc_id, chash, text = item
+        tc=len(self.enc.encode(text or ""))
+        if (self.pending_tokens+tc)>self.token_budget or len(self.pending)>=self.batch_size:
+            self._flush(conn)
+        self.pending.append((doc_id, chash, text)); self.pending_tokens+=tc
+    def _flush(self, conn):
+        if not self.pending: return
+        hashes=[h for _,h,_ in self.pending]
+        texts=[clean_text_safe(t) for *_,t in self.pending]
+        out=[]; start=0
+        while start<len(texts):
+            sub=texts[start:start+self.batch_size]; t0=time.time()
+            resp=llm_gateway.embed("ingest.embed", model=self.model, input=sub, **vector_index.embed_kwargs())
+            if self.prof: self.prof.embed_batch(len(sub), getattr(getattr(resp,"usage",None),"prompt_tokens",0) or 0, int((time.time()-t0)*1000))
+            out.extend(resp.data); start+=self.batch_size
+        with conn.cursor() as cur:
+            cur.executemany("INSERT INTO emb_cache(chunk_hash, embedding) VALUES(%s,%s) ON CONFLICT (chunk_hash) DO NOTHING",
+                            list({h:v.embedding for h,v in zip(hashes,out)}.items()))
+            if chunk_store.enabled():
+                cur.executemany("UPDATE chunks k SET embedding=c.embedding FROM emb_cache c WHERE k.chunk_hash=%s AND c.chunk_hash=%s",
+                                [(chash, chash) for chash in dict.fromkeys(hashes)])
+            else:
+                cur.executemany("UPDATE docs d SET embedding=c.embedding FROM emb_cache c WHERE d.id=%s AND c.chunk_hash=%s",
+                                [(doc_id, chash) for doc_id, chash, _ in self.pending])
+        conn.commit(); self.pending.clear(); self.pending_tokens=0; self.last_flush=time.time()
+    def submit(self, doc_id, chash, text): self.q.put((doc_id, chash, text))
+    def finish(self): self.q.put(None); self.join()
+def upsert_inventory(conn, path:str, size_bytes:int, mtime, sha:str):
+    with conn.cursor() as cur:
+        cur.execute("""INSERT INTO file_inventory(path,size_bytes,mtime,sha256,last_seen)
+                       VALUES(%s,%s,%s,%s,now())
+                       ON CONFLICT(path) DO UPDATE SET size_bytes=EXCLUDED.size_bytes, mtime=EXCLUDED.mtime, sha256=EXCLUDED.sha256, last_seen=now();""",
+                    (path,size_bytes,mtime,sha)); conn.commit()
+def iter_all_files(root: Path):
+    for p,_,files in os.walk(root):
+        for f in files:
+            ext=os.path.splitext(f)[1].lower()
+            if ext in {".pdf",".html",".htm",".xlsx",".xls",".txt"}:
+                yield Path(p)/f
+def _timings(t0, t1, t2, t3):
+    return dict(hash_ms=int((t1-t0)*1000), extract_ms=int((t2-t1)*1000), chunk_ms=int((t3-t2)*1000))
+def process_no_ocr(path: str, chunk_tokens: int, overlap: int):
+    t0=time.time(); p=Path(path); st=p.stat(); title=p.stem
+    h=hashlib.sha256()
+    with open(p,'rb') as f:
+        for b in iter(lambda: f.read(1<<20), b""):
+            h.update(b)
+    file_sha=h.hexdigest(); t1=time.time()
+    text=extract_text_no_ocr(str(p)); t2=time.time()
+    chunks=chunk_by_tokens(text, chunk_tokens, overlap) if text.strip() else []; t3=time.time()
+    return dict(path=str(p), chunks=chunks, sha=file_sha, size_bytes=st.st_size,
+                mtime=datetime.fromtimestamp(st.st_mtime), title=title, mode="FAST", started=t0, finished=t3,
+                timings=_timings(t0, t1, t2, t3))
+def process_with_ocr(path: str, chunk_tokens: int, overlap: int):
+    t0=time.time(); p=Path(path); st=p.stat(); title=p.stem
+    h=hashlib.sha256()
+    with open(p,'rb') as f:
+        for b in iter(lambda: f.read(1<<20), b""):
+            h.update(b)
+    file_sha=h.hexdigest(); t1=time.time()
+    text=extract_text_full(str(p)); t2=time.time()
+    chunks=chunk_by_tokens(text, chunk_tokens, overlap) if text.strip() else []; t3=time.time()
+    return dict(path=str(p), chunks=chunks, sha=file_sha, size_bytes=st.st_size,
+                mtime=datetime.fromtimestamp(st.st_mtime), title=title, mode="OCR", started=t0, finished=t3,
+                timings=_timings(t0, t1, t2, t3))
+def ingest_group(conn, paths, use_ocr=False, workers=8, batch_size=256, desc="", prof=None):
+    process_fn=process_with_ocr if use_ocr else process_no_ocr
+    prof=prof or ingest_stats.Profiler({})
+    with conn.cursor() as cur: cur.execute("SET synchronous_commit=off;")
+    embw=EmbeddingWorker(os.getenv("DATABASE_URL"), batch_size, os.getenv("EMBED_MODEL","text-embedding-3-small"),
+                         int(os.getenv("EMBED_TOKEN_BUDGET","220000")), prof); embw.start()
+    log_buf=deque(maxlen=1000); processed=0; queued=set(); spans=[]; wait=0.0; t_group=time.time()
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        futures=[ex.submit(process_fn, str(p), int(os.getenv("CHUNK_TOKENS","1100")), int(os.getenv("CHUNK_OVERLAP","100"))) for p in paths]
+        with tqdm(total=len(futures), unit="arq", desc=desc, ascii=True, mininterval=0.2, dynamic_ncols=True) as bar:
+            t_wait=time.time()
+            for fut in as_completed(futures):
+                info=fut.result(); processed+=1; t_db=time.time(); wait+=t_db-t_wait
+                log_buf.append(f"[{info['mode']}] {Path(info['path']).name}  chunks={len(info['chunks'])}")
+                for idx, chunk in enumerate(info["chunks"]):
+                    chash=hashlib.sha256((chunk or "").encode("utf-8",errors="ignore")).hexdigest()
+                    doc_id=upsert_chunk(conn, info["path"], idx, chash, info["sha"], info["size_bytes"], info["mtime"], info["title"], chunk,
+                                        {"dir": str(Path(info["path"]).parent), "ext": Path(info["path"]).suffix.lower()})
+                    if chunk_store.enabled():
+                        # Texto repetido (em outro arquivo ou neste lote) não é gravado nem embutido de novo.
+                        if chunk_store.upsert(conn, chash, clean_text_safe(chunk)) and chash not in queued:
+                            queued.add(chash); embw.submit(doc_id, chash, chunk)
+                    else:
+                        with conn.cursor() as cur:
+                            cur.execute("SELECT embedding IS NULL FROM docs WHERE id=%s",(doc_id,))
+                            if cur.fetchone()[0]: embw.submit(doc_id, chash, chunk)
+                # Trechos além do novo fim do arquivo saem (e invalidam o cache de QA que os cita).
+                with conn.cursor() as cur:
+                    cur.execute("DELETE FROM docs WHERE path=%s AND chunk_no>=%s",(info["path"], len(info["chunks"])))
+                upsert_inventory(conn, info["path"], info["size_bytes"], info["mtime"], info["sha"])
+                prof.file(info, int((time.time()-t_db)*1000)); spans.append(dict(started=info["started"], finished=info["finished"]))
+                if processed % int(os.getenv("LOG_EVERY","120")) == 0:
+                    tail=list(log_buf)[-int(os.getenv("LOG_LINES","5")):]
+                    if tail: from tqdm import tqdm as _t; _t.write("\n".join(tail))
+                bar.update(1); t_wait=time.time()
+    prof.pool(desc, workers, spans, time.time()-t_group, wait)
+    with prof.stage("embed_drain"): embw.finish()
+def main():
+    DATA = DATA_DIR
+    prof=ingest_stats.Profiler(dict(MAX_WORKERS=MAX_WORKERS, OCR_WORKERS=OCR_WORKERS, EMBED_BATCH_SIZE=EMBED_BATCH_SIZE,
+        EMBED_TOKEN_BUDGET=EMBED_TOKEN_BUDGET, CHUNK_TOKENS=CHUNK_TOKENS, CHUNK_OVERLAP=CHUNK_OVERLAP, EMBED_MODEL=EMBED_MODEL,
+        OCR_ENABLED=OCR_ENABLED, DELTA_MODE=DELTA_MODE, CHUNK_STORE=chunk_store.CHUNK_STORE))
+    all_files=[p for p in iter_all_files(DATA)]
+    all_files.sort(key=lambda p: p.stat().st_size if p.exists() else 0)
+    with psycopg.connect(DB_URL) as conn:
+        ensure_schema(conn)
+        inv={}
+        with conn.cursor() as cur:
+            cur.execute("SELECT path,size_bytes,mtime,sha256 FROM file_inventory WHERE path LIKE %s", (str(DATA_DIR)+"%",))
+            for path,size_bytes,mtime,sha in cur: inv[path]=(int(size_bytes), mtime, sha)
+        added, maybe_mod, unchanged = [], [], []
+        for p in all_files:
+            st=p.stat(); size=st.st_size; mtime=datetime.fromtimestamp(st.st_mtime); rec=inv.get(str(p))
+            if not rec: added.append(p)
+            else:
+                s0,m0,_=rec
+                if size==s0 and mtime==m0: unchanged.append(p)
+                else: maybe_mod.append(p)
+        if os.getenv("DELTA_MODE","mtime_size")=="sha":
+            changed=[]; from tqdm import tqdm as tq
+            for p in tq(maybe_mod, desc="Verificando SHA (delta)", unit="arq", ascii=True):
+                if sha256_file(str(p)) != inv.get(str(p),(None,None,None))[2]: changed.append(p)
+        else:
+            changed=maybe_mod
+        targets=added+changed
+        from tqdm import tqdm as _t; _t.write(f"[DELTA] Novos: {len(added)} | Alterados: {len(changed)} | Inalterados: {len(unchanged)}")
+        prof.stages["delta"]+=int((time.time()-prof.started)*1000)
+        hnsw=hnsw_tables(conn, targets)
+        with prof.stage("index_drop"): drop_hnsw_if_exists(conn, hnsw)
+        fast_group, ocr_group = [], []
+        with prof.stage("classify"):
+            for p in targets:
+                if p.suffix.lower()==".pdf":
+                    (fast_group if pdf_is_likely_textual(str(p)) else ocr_group).append(p)
+                else:
+                    fast_group.append(p)
+        if fast_group:
+            ingest_group(conn, fast_group, use_ocr=False, workers=int(os.getenv("MAX_WORKERS","8")),
+                         batch_size=int(os.getenv("EMBED_BATCH_SIZE","256")), desc=f"Fase 1 (texto nativo) [{len(fast_group)}]", prof=prof)
+        if os.getenv("OCR_ENABLED","false").lower()=="true" and ocr_group:
+            ingest_group(conn, ocr_group, use_ocr=True, workers=int(os.getenv("OCR_WORKERS","2")),
+                         batch_size=int(os.getenv("EMBED_BATCH_SIZE","256")), desc=f"Fase 2 (OCR) [{len(ocr_group)}]", prof=prof)
+        if chunk_store.enabled():
+            with prof.stage("gc"): _t.write(f"[CHUNKS] Trechos sem referência removidos: {chunk_store.gc(conn)}")
+        with prof.stage("index_build"): create_hnsw_concurrently(conn, hnsw)
+    if chunk_graph.GRAPH_AFTER_INGEST and targets:
+        import jobs
+        _t.write(f"[GRAFO] Job chunk_graph enfileirado: id={jobs.enqueue('chunk_graph')}")
+    if ingest_stats.INGEST_PROFILE:
+        summary=prof.summary(); print("\n".join(ingest_stats.report_lines(summary)))
+        run_id=prof.save(summary)
+        if run_id: print(f"[PERFIL] Gravado em ingest_runs id={run_id} (python app/ingest_stats.py --run {run_id})")
+    print("Ingestão concluída.")
+if __name__=="__main__": main()
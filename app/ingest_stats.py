@@ -0,0 +1,250 @@
+"""Perfil da ingestão: tempos por etapa, por arquivo e por lote de embeddings.
+
+``app/ingest.py`` registra, para cada arquivo, o tempo de hash, extração
+(texto nativo ou OCR, conforme ``mode``) e chunking medidos no processo do
+pool, e o das gravações no banco medido no processo principal. Para cada
+chamada de embeddings registra a latência, o número de textos e de tokens;
+para cada grupo do pool, o tempo ocioso dos workers. Ao final da execução o
+resumo é impresso e gravado em ``ingest_runs``/``ingest_file_stats``/
+``ingest_embed_batches`` (``initdb/013_ingest_stats.sql``), o que permite
+ajustar ``MAX_WORKERS``, ``OCR_WORKERS``, ``EMBED_BATCH_SIZE`` e
+``EMBED_TOKEN_BUDGET`` a partir de dados.
+
+Execuções anteriores::
+
+    python app/ingest_stats.py            # última execução
+    python app/ingest_stats.py --run 42 --top 20
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+import psycopg
+from dotenv import load_dotenv
+from psycopg.rows import dict_row
+from psycopg.types.json import Json
+
+load_dotenv(Path(__file__).with_name(".env"), override=True)
+DB_URL = os.getenv("DATABASE_URL")
+INGEST_PROFILE = os.getenv("INGEST_PROFILE", "true").lower() == "true"
+INGEST_PROFILE_TOP = int(os.getenv("INGEST_PROFILE_TOP", "10"))
+logger = logging.getLogger("sophia.ingest")
+
+FILE_STAGES = ("hash_ms", "extract_ms", "chunk_ms")
+
+
+def _ms(start: float, end: float) -> int:
+    return int(round((end - start) * 1000))
+
+
+def _pct(values: Sequence[float], q: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    return float(s[min(len(s) - 1, int(q * len(s)))])
+
+
+class Profiler:
+    """Acumula as medições de uma execução; seguro para a thread de embeddings."""
+
+    def __init__(self, config: Dict[str, Any]):
+        self.config = config
+        self.started = time.time()
+        self.files: List[Dict[str, Any]] = []
+        self.batches: List[Dict[str, int]] = []
+        self.stages: Counter = Counter()
+        self.pools: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def file(self, info: Dict[str, Any], db_ms: int) -> None:
+        t = info.get("timings") or {}
+        busy = _ms(info["started"], info["finished"]) if "started" in info else 0
+        self.files.append(
+            {
+                "path": info["path"],
+                "mode": info["mode"],
+                "chunks": len(info["chunks"]),
+                "size_bytes": info.get("size_bytes"),
+                **{k: t.get(k, 0) for k in FILE_STAGES},
+                "db_ms": db_ms,
+                "total_ms": busy + db_ms,
+            }
+        )
+
+    def embed_batch(self, texts: int, tokens: int, latency_ms: int) -> None:
+        with self._lock:
+            self.batches.append({"texts": texts, "tokens": tokens, "latency_ms": latency_ms})
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.stages[name] += _ms(t0, time.time())
+
+    def pool(self, desc: str, workers: int, results: Sequence[Dict[str, Any]], elapsed_s: float, wait_s: float) -> None:
+        """Ocupação do pool: tempo dos workers com arquivo em mãos sobre ``workers × elapsed``.
+
+        ``wait_s`` é o tempo do processo principal parado esperando o pool;
+        perto de zero, o gargalo é o principal (banco), não os workers.
+        """
+
+        busy = sum(r["finished"] - r["started"] for r in results if "started" in r)
+        capacity = max(workers, 1) * max(elapsed_s, 1e-9)
+        self.pools.append(
+            {
+                "group": desc,
+                "workers": workers,
+                "files": len(results),
+                "elapsed_s": round(elapsed_s, 2),
+                "busy_s": round(busy, 2),
+                "idle_pct": round(max(0.0, 1 - busy / capacity) * 100, 1),
+                "main_wait_s": round(wait_s, 2),
+            }
+        )
+
+    def summary(self, top: int = INGEST_PROFILE_TOP) -> Dict[str, Any]:
+        elapsed = max(time.time() - self.started, 1e-9)
+        chunks = sum(f["chunks"] for f in self.files)
+        stages: Dict[str, int] = {k: 0 for k in ("hash_ms", "extract_ms", "ocr_ms", "chunk_ms", "db_ms")}
+        for f in self.files:
+            stages["hash_ms"] += f["hash_ms"]
+            stages["ocr_ms" if f["mode"] == "OCR" else "extract_ms"] += f["extract_ms"]
+            stages["chunk_ms"] += f["chunk_ms"]
+            stages["db_ms"] += f["db_ms"]
+        stages.update({f"{k}_ms": v for k, v in self.stages.items()})
+        lat = [b["latency_ms"] for b in self.batches]
+        tokens = sum(b["tokens"] for b in self.batches)
+        slowest = sorted(self.files, key=lambda f: f["total_ms"], reverse=True)[:top]
+        return {
+            "elapsed_s": round(elapsed, 2),
+            "files": len(self.files),
+            "chunks": chunks,
+            "files_per_s": round(len(self.files) / elapsed, 3),
+            "chunks_per_s": round(chunks / elapsed, 3),
+            "stages_ms": stages,
+            "embed": {
+                "batches": len(self.batches),
+                "texts": sum(b["texts"] for b in self.batches),
+                "tokens": tokens,
+                "latency_ms_total": sum(lat),
+                "latency_ms_p50": _pct(lat, 0.5),
+                "latency_ms_p95": _pct(lat, 0.95),
+                "latency_ms_max": max(lat, default=0),
+                "tokens_per_s": round(tokens / (sum(lat) / 1000), 1) if sum(lat) else 0.0,
+            },
+            "pools": self.pools,
+            "slowest": [
+                {k: f[k] for k in ("path", "mode", "chunks", "total_ms", "extract_ms", "db_ms")} for f in slowest
+            ],
+        }
+
+    def save(self, summary: Dict[str, Any], dsn: Optional[str] = DB_URL) -> Optional[int]:
+        """Grava a execução; devolve o id ou ``None`` se as tabelas não existirem."""
+
+        try:
+            with psycopg.connect(dsn) as conn, conn.cursor() as cur:
+                cur.execute(
+                    """INSERT INTO ingest_runs(started_at, finished_at, files, chunks, config, summary)
+                       VALUES(to_timestamp(%s), now(), %s, %s, %s, %s) RETURNING id""",
+                    (self.started, summary["files"], summary["chunks"], Json(self.config), Json(summary)),
+                )
+                run_id = cur.fetchone()[0]
+                cur.executemany(
+                    """INSERT INTO ingest_file_stats(run_id, path, mode, chunks, size_bytes,
+                         hash_ms, extract_ms, chunk_ms, db_ms, total_ms)
+                       VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)""",
+                    [
+                        (run_id, f["path"], f["mode"], f["chunks"], f["size_bytes"], f["hash_ms"],
+                         f["extract_ms"], f["chunk_ms"], f["db_ms"], f["total_ms"])
+                        for f in self.files
+                    ],
+                )
+                cur.executemany(
+                    "INSERT INTO ingest_embed_batches(run_id, texts, tokens, latency_ms) VALUES(%s,%s,%s,%s)",
+                    [(run_id, b["texts"], b["tokens"], b["latency_ms"]) for b in self.batches],
+                )
+                conn.commit()
+                return run_id
+        except psycopg.Error as exc:
+            logger.warning("Não foi possível gravar o perfil da ingestão: %s", exc)
+            return None
+
+
+def report_lines(summary: Dict[str, Any]) -> List[str]:
+    """Resumo legível de ``Profiler.summary`` (ou de ``ingest_runs.summary``)."""
+
+    st, emb = summary["stages_ms"], summary["embed"]
+    lines = [
+        f"[PERFIL] {summary['files']} arquivos, {summary['chunks']} trechos em {summary['elapsed_s']}s "
+        f"({summary['files_per_s']} arq/s, {summary['chunks_per_s']} trechos/s)",
+        "[PERFIL] Etapas (s): " + ", ".join(f"{k[:-3]}={v / 1000:.1f}" for k, v in st.items()),
+        f"[PERFIL] Embeddings: {emb['batches']} lotes, {emb['texts']} textos, {emb['tokens']} tokens, "
+        f"latência p50={emb['latency_ms_p50']:.0f}ms p95={emb['latency_ms_p95']:.0f}ms "
+        f"máx={emb['latency_ms_max']}ms, {emb['tokens_per_s']} tokens/s",
+    ]
+    for p in summary["pools"]:
+        lines.append(
+            f"[PERFIL] Pool {p['group']}: {p['workers']} workers, {p['files']} arquivos em {p['elapsed_s']}s, "
+            f"ociosidade {p['idle_pct']}%, principal esperando {p['main_wait_s']}s"
+        )
+    if summary["slowest"]:
+        lines.append("[PERFIL] Arquivos mais lentos:")
+        for f in summary["slowest"]:
+            lines.append(
+                f"  {f['total_ms'] / 1000:8.1f}s  [{f['mode']}] {f['path']}  chunks={f['chunks']} "
+                f"extração={f['extract_ms'] / 1000:.1f}s banco={f['db_ms'] / 1000:.1f}s"
+            )
+    return lines
+
+
+def load_run(run_id: Optional[int] = None, top: int = INGEST_PROFILE_TOP) -> Optional[Dict[str, Any]]:
+    with psycopg.connect(DB_URL) as conn, conn.cursor(row_factory=dict_row) as cur:
+        if run_id is None:
+            cur.execute("SELECT id, config, summary FROM ingest_runs WHERE summary IS NOT NULL ORDER BY id DESC LIMIT 1")
+        else:
+            cur.execute("SELECT id, config, summary FROM ingest_runs WHERE id=%s", (run_id,))
+        row = cur.fetchone()
+        if not row:
+            return None
+        cur.execute(
+            """SELECT path, mode, chunks, total_ms, extract_ms, db_ms FROM ingest_file_stats
+                WHERE run_id=%s ORDER BY total_ms DESC LIMIT %s""",
+            (row["id"], top),
+        )
+        row["summary"]["slowest"] = cur.fetchall()
+        return row
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="Perfil das execuções de ingestão")
+    ap.add_argument("--run", type=int, help="Id em ingest_runs (padrão: a última)")
+    ap.add_argument("--top", type=int, default=INGEST_PROFILE_TOP, help="Arquivos mais lentos a listar")
+    ap.add_argument("--json", action="store_true")
+    a = ap.parse_args(argv)
+    row = load_run(a.run, a.top)
+    if row is None:
+        print("Nenhuma execução registrada.", file=sys.stderr)
+        return 1
+    if a.json:
+        print(json.dumps(row, ensure_ascii=False, default=str))
+    else:
+        print(f"Execução {row['id']}: " + json.dumps(row["config"], ensure_ascii=False))
+        print("\n".join(report_lines(row["summary"])))
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover - CLI entry
+    sys.exit(main())
@@ -0,0 +1,422 @@
+"""Fila de jobs administrativos persistida no Postgres.
+
+Endpoints longos (análises, exportação e fine-tuning) apenas enfileiram um
+registro em ``jobs`` e devolvem o ID. Workers reivindicam jobs com
+``FOR UPDATE SKIP LOCKED`` respeitando um limite de concorrência por tipo
+(``JOB_LIMITS``), publicam progresso/heartbeat e atendem pedidos de
+cancelamento. Os workers podem rodar dentro da API (``JOBS_EMBEDDED_WORKER``)
+ou como processo próprio (``python jobs.py worker``).
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import psycopg
+from dotenv import load_dotenv
+from psycopg.rows import dict_row
+from psycopg.types.json import Json
+
+load_dotenv(Path(__file__).with_name(".env"), override=True)
+DB_URL = os.getenv("DATABASE_URL")
+APP_DIR = Path(__file__).parent
+JOB_SLOTS = int(os.getenv("JOB_SLOTS", "2"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "2"))
+JOB_STALE_SECONDS = int(os.getenv("JOB_STALE_SECONDS", "300"))
+DEFAULT_LIMITS = {
+    "analyze_doc": 4,
+    "analyze_batch": 1,
+    "finetune": 1,
+    "finetune_export": 1,
+    "finetune_start": 1,
+    "chunk_graph": 1,
+}
+FINAL_STATUSES = ("succeeded", "failed", "cancelled")
+logger = logging.getLogger("sophia.jobs")
+
+
+def _parse_limits(raw: str) -> Dict[str, int]:
+    limits = dict(DEFAULT_LIMITS)
+    for item in filter(None, (p.strip() for p in raw.split(","))):
+        kind, _, val = item.partition("=")
+        try:
+            limits[kind.strip()] = int(val)
+        except ValueError:
+            logger.warning("Limite de job inválido ignorado: %s", item)
+    return limits
+
+
+JOB_LIMITS = _parse_limits(os.getenv("JOB_LIMITS", ""))
+
+
+class JobCancelled(Exception):
+    """Sinaliza que o job foi cancelado durante a execução."""
+
+
+class JobContext:
+    """Canal do handler com a linha do job: progresso, heartbeat e cancelamento."""
+
+    def __init__(self, job_id: int, min_interval: float = 1.0):
+        self.job_id = job_id
+        self.min_interval = min_interval
+        self._last = 0.0
+        self._cancelled = False
+
+    def progress(self, fraction: Optional[float] = None, message: Optional[str] = None, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - self._last < self.min_interval:
+            return
+        self._last = now
+        with psycopg.connect(DB_URL) as conn, conn.cursor() as cur:
+            cur.execute(
+                """UPDATE jobs SET progress=COALESCE(%s, progress), message=COALESCE(%s, message),
+                          heartbeat_at=now()
+                     WHERE id=%s RETURNING cancel_requested""",
+                (fraction, message, self.job_id),
+            )
+            row = cur.fetchone()
+            conn.commit()
+        self._cancelled = bool(row and row[0])
+
+    def cancelled(self) -> bool:
+        self.progress()
+        return self._cancelled
+
+
+# --------------------------------------------------------------------------- fila
+
+
+def enqueue(kind: str, params: Optional[Dict[str, Any]] = None) -> int:
+    if kind not in HANDLERS:
+        raise ValueError(f"tipo de job desconhecido: {kind}")
+    with psycopg.connect(DB_URL) as conn, conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO jobs(kind, params) VALUES (%s, %s) RETURNING id",
+            (kind, Json(params or {})),
+        )
+        job_id = cur.fetchone()[0]
+        cur.execute("SELECT pg_notify('sophia_jobs', %s)", (kind,))
+        conn.commit()
+    return job_id
+
+
+def get(job_id: int) -> Optional[Dict[str, Any]]:
+    with psycopg.connect(DB_URL) as conn, conn.cursor(row_factory=dict_row) as cur:
+        cur.execute("SELECT * FROM jobs WHERE id=%s", (job_id,))
+        return cur.fetchone()
+
+
+def list_jobs(kind: Optional[str] = None, status: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
+    with psycopg.connect(DB_URL) as conn, conn.cursor(row_factory=dict_row) as cur:
+        cur.execute(
+            """SELECT id, kind, status, progress, message, created_at, started_at, finished_at
+                 FROM jobs
+                WHERE (%(kind)s::text IS NULL OR kind=%(kind)s)
+                  AND (%(status)s::text IS NULL OR status=%(status)s)
+                ORDER BY id DESC LIMIT %(limit)s""",
+            {"kind": kind, "status": status, "limit": limit},
+        )
+        return cur.fetchall()
+
+
+def cancel(job_id: int) -> Optional[Dict[str, Any]]:
+    """Cancela na hora jobs enfileirados; jobs em execução recebem o pedido."""
+
+    with psycopg.connect(DB_URL) as conn, conn.cursor(row_factory=dict_row) as cur:
+        cur.execute(
+            """UPDATE jobs SET cancel_requested=true,
+                      status=CASE WHEN status='queued' THEN 'cancelled' ELSE status END,
+                      finished_at=CASE WHEN status='queued' THEN now() ELSE finished_at END
+                WHERE id=%s RETURNING id, kind, status, cancel_requested""",
+            (job_id,),
+        )
+        row = cur.fetchone()
+        conn.commit()
+    return row
+
+
+def claim(worker: str) -> Optional[Dict[str, Any]]:
+    """Reivindica o job enfileirado mais antigo cujo tipo ainda tem vaga."""
+
+    with psycopg.connect(DB_URL) as conn, conn.cursor(row_factory=dict_row) as cur:
+        cur.execute(
+            "SELECT kind, count(*) AS n FROM jobs WHERE status='running' GROUP BY kind"
+        )
+        running = {r["kind"]: r["n"] for r in cur.fetchall()}
+        kinds = [k for k, lim in JOB_LIMITS.items() if running.get(k, 0) < lim and k in HANDLERS]
+        for kind in kinds:
+            # Serializa a checagem de limite por tipo entre workers concorrentes.
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('sophia_jobs:' || %s))", (kind,))
+            cur.execute("SELECT count(*) AS n FROM jobs WHERE status='running' AND kind=%s", (kind,))
+            if cur.fetchone()["n"] >= JOB_LIMITS[kind]:
+                continue
+            cur.execute(
+                """UPDATE jobs SET status='running', started_at=now(), heartbeat_at=now(), worker=%s
+                    WHERE id = (
+                      SELECT id FROM jobs
+                       WHERE status='queued' AND kind=%s
+                       ORDER BY id
+                       FOR UPDATE SKIP LOCKED
+                       LIMIT 1)
+                RETURNING *""",
+                (worker, kind),
+            )
+            job = cur.fetchone()
+            if job:
+                conn.commit()
+                return job
+        conn.commit()
+    return None
+
+
+def finish(job_id: int, status: str, result: Any = None, error: Optional[str] = None) -> None:
+    """Fecha o job; um job já dado como perdido (``fail_stale``) ou cancelado não volta."""
+
+    with psycopg.connect(DB_URL) as conn, conn.cursor() as cur:
+        cur.execute(
+            """UPDATE jobs SET status=%s, result=%s, error=%s, finished_at=now(),
+                      progress=CASE WHEN %s='succeeded' THEN 1.0 ELSE progress END
+                WHERE id=%s AND status='running'""",
+            (status, Json(result) if result is not None else None, error, status, job_id),
+        )
+        if cur.rowcount == 0:
+            logger.warning("Job %s já não estava em execução; status %s descartado", job_id, status)
+        conn.commit()
+
+
+def _heartbeat(job_id: int, stop: threading.Event) -> None:
+    """Mantém ``heartbeat_at`` em dia enquanto o handler roda, mesmo sem progresso."""
+
+    interval = max(1.0, JOB_STALE_SECONDS / 3)
+    while not stop.wait(interval):
+        try:
+            with psycopg.connect(DB_URL) as conn, conn.cursor() as cur:
+                cur.execute(
+                    "UPDATE jobs SET heartbeat_at=now() WHERE id=%s AND status='running'", (job_id,)
+                )
+                conn.commit()
+        except psycopg.Error as exc:  # pragma: no cover - fallback defensivo
+            logger.warning("Falha ao enviar heartbeat do job %s: %s", job_id, exc)
+
+
+def fail_stale() -> int:
+    """Marca como falhos jobs cujo worker parou de enviar heartbeat."""
+
+    with psycopg.connect(DB_URL) as conn, conn.cursor() as cur:
+        cur.execute(
+            """UPDATE jobs SET status='failed', error='worker sem heartbeat', finished_at=now()
+                WHERE status='running' AND heartbeat_at < now() - make_interval(secs => %s)""",
+            (JOB_STALE_SECONDS,),
+        )
+        n = cur.rowcount
+        conn.commit()
+    return n
+
+
+# ----------------------------------------------------------------------- handlers
+
+
+def _run_script(ctx: JobContext, script: str, args: List[str]) -> Any:
+    """Executa um script do app, acompanhando cancelamento e heartbeat."""
+
+    cmd = [sys.executable, "-u", str(APP_DIR / script), *args]
+    with tempfile.TemporaryFile("w+") as out, tempfile.TemporaryFile("w+") as err:
+        proc = subprocess.Popen(cmd, stdout=out, stderr=err, text=True, cwd=APP_DIR)
+        ctx.progress(message=f"executando {script}", force=True)
+        while proc.poll() is None:
+            if ctx.cancelled():
+                proc.terminate()
+                try:
+                    proc.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                raise JobCancelled()
+            time.sleep(1)
+        out.seek(0)
+        err.seek(0)
+        stdout, stderr = out.read().strip(), err.read().strip()
+    if proc.returncode != 0:
+        raise RuntimeError(stderr or stdout or f"{script} terminou com código {proc.returncode}")
+    try:
+        return json.loads(stdout.splitlines()[-1]) if stdout else {"ok": True}
+    except json.JSONDecodeError:
+        return {"ok": True, "raw": stdout}
+
+
+def _analyze_doc(ctx: JobContext, params: Dict[str, Any]) -> Any:
+    args: List[str] = []
+    if params.get("path"):
+        args += ["--path", params["path"]]
+    if params.get("doc_id") is not None:
+        args += ["--doc_id", str(params["doc_id"])]
+    if params.get("k"):
+        args += ["--k", str(params["k"])]
+    if params.get("mode"):
+        args += ["--mode", params["mode"]]
+    return _run_script(ctx, "analyze_doc.py", args)
+
+
+def _analyze_batch(ctx: JobContext, params: Dict[str, Any]) -> Any:
+    import analyze_batch
+
+    def progress(done: int, total: int) -> None:
+        ctx.progress(done / total if total else 1.0, f"{done}/{total} documentos")
+
+    result = analyze_batch.run(
+        params.get("prefix"),
+        params.get("limit") or 50,
+        concurrency=params.get("concurrency") or analyze_batch.ANALYZE_CONCURRENCY,
+        force=bool(params.get("force")),
+        mode=params.get("mode") or analyze_batch.ANALYSIS_MODE,
+        progress=progress,
+        should_stop=ctx.cancelled,
+    )
+    if ctx.cancelled():
+        raise JobCancelled()
+    return result
+
+
+def _chunk_graph(ctx: JobContext, params: Dict[str, Any]) -> Any:
+    import chunk_graph
+
+    def progress(done: int, total: int, message: str) -> None:
+        ctx.progress(done / total if total else 1.0, message)
+
+    result = chunk_graph.run(
+        divergences=params.get("divergences", True),
+        limit=params.get("limit"),
+        progress=progress,
+        should_stop=ctx.cancelled,
+    )
+    if ctx.cancelled():
+        raise JobCancelled()
+    return result
+
+
+def _finetune(ctx: JobContext, params: Dict[str, Any]) -> Any:
+    args: List[str] = []
+    if params.get("status"):
+        args += ["--status", params["status"]]
+    if params.get("watch"):
+        args.append("--watch")
+    return _run_script(ctx, "finetune.py", args)
+
+
+HANDLERS: Dict[str, Callable[[JobContext, Dict[str, Any]], Any]] = {
+    "analyze_doc": _analyze_doc,
+    "analyze_batch": _analyze_batch,
+    "chunk_graph": _chunk_graph,
+    "finetune": _finetune,
+    "finetune_export": lambda ctx, p: _run_script(ctx, "finetune_export.py", []),
+    "finetune_start": lambda ctx, p: _run_script(ctx, "finetune_openai.py", []),
+}
+
+
+def execute(job: Dict[str, Any]) -> None:
+    ctx = JobContext(job["id"])
+    stop = threading.Event()
+    beat = threading.Thread(target=_heartbeat, args=(job["id"], stop), daemon=True, name=f"job-{job['id']}-hb")
+    beat.start()
+    try:
+        result = HANDLERS[job["kind"]](ctx, job.get("params") or {})
+    except JobCancelled:
+        finish(job["id"], "cancelled")
+    except Exception as exc:
+        logger.exception("Job %s (%s) falhou", job["id"], job["kind"])
+        finish(job["id"], "failed", error=str(exc))
+    else:
+        finish(job["id"], "succeeded", result=result)
+    finally:
+        stop.set()
+
+
+# ------------------------------------------------------------------------ worker
+
+
+class Worker(threading.Thread):
+    """Laço que reivindica e executa jobs em até ``slots`` threads."""
+
+    def __init__(self, slots: int = JOB_SLOTS, poll: float = JOB_POLL_SECONDS):
+        super().__init__(daemon=True, name="sophia-jobs")
+        self.slots = max(1, slots)
+        self.poll = poll
+        self.name_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.stop_event = threading.Event()
+        self._busy = threading.Semaphore(self.slots)
+
+    def run(self) -> None:
+        with ThreadPoolExecutor(max_workers=self.slots, thread_name_prefix="job") as ex:
+            while not self.stop_event.is_set():
+                try:
+                    fail_stale()
+                    while self._busy.acquire(blocking=False):
+                        job = claim(self.name_id)
+                        if not job:
+                            self._busy.release()
+                            break
+                        ex.submit(self._execute, job)
+                except psycopg.Error as exc:  # pragma: no cover - fallback defensivo
+                    logger.warning("Falha ao consultar fila de jobs: %s", exc)
+                self.stop_event.wait(self.poll)
+
+    def _execute(self, job: Dict[str, Any]) -> None:
+        try:
+            execute(job)
+        finally:
+            self._busy.release()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="Fila de jobs da Sophia")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    w = sub.add_parser("worker", help="Executar worker em primeiro plano")
+    w.add_argument("--slots", type=int, default=JOB_SLOTS)
+    e = sub.add_parser("enqueue", help="Enfileirar job")
+    e.add_argument("kind", choices=sorted(HANDLERS))
+    e.add_argument("--params", default="{}", help="Parâmetros em JSON")
+    s = sub.add_parser("status", help="Consultar job")
+    s.add_argument("job_id", type=int)
+    c = sub.add_parser("cancel", help="Cancelar job")
+    c.add_argument("job_id", type=int)
+    args = ap.parse_args(argv)
+
+    if args.cmd == "worker":
+        logging.basicConfig(level=logging.INFO)
+        worker = Worker(slots=args.slots)
+        worker.start()
+        try:
+            while worker.is_alive():
+                worker.join(1)
+        except KeyboardInterrupt:
+            worker.stop()
+        return 0
+    if args.cmd == "enqueue":
+        out: Any = {"ok": True, "job_id": enqueue(args.kind, json.loads(args.params))}
+    elif args.cmd == "status":
+        out = get(args.job_id)
+    else:
+        out = cancel(args.job_id)
+    if out is None:
+        print(json.dumps({"ok": False, "error": "job não encontrado"}, ensure_ascii=False), file=sys.stderr)
+        return 1
+    print(json.dumps(out, ensure_ascii=False, default=str))
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover - CLI entry
+    sys.exit(main())
@@ -0,0 +1,321 @@
+"""Ponto único de saída para a API da OpenAI (chat, embeddings e fine-tuning).
+
+Todas as chamadas passam por aqui e recebem, por processo:
+
+- orçamento de requisições e tokens por minuto (``LLM_RPM``/``LLM_TPM`` para
+  chat, ``EMBED_RPM``/``EMBED_TPM`` para embeddings; ``0`` = sem limite). A
+  estimativa prévia de tokens é corrigida pelo ``usage`` devolvido;
+- no máximo ``LLM_MAX_INFLIGHT`` chamadas simultâneas;
+- até ``LLM_MAX_RETRIES`` novas tentativas para 429/5xx/timeout, com espera
+  exponencial com jitter (respeitando ``Retry-After`` quando presente);
+- disjuntor: após ``LLM_BREAKER_FAILURES`` falhas seguidas do provedor as
+  chamadas falham na hora com ``CircuitOpenError`` por
+  ``LLM_BREAKER_COOLDOWN`` segundos; depois uma chamada de teste decide se ele
+  fecha;
+- contabilidade por chamador (``usage()``, inclusive ``cached_tokens``), exibida
+  em ``/health``.
+
+``OPENAI_BASE_URL`` aponta o cliente para outro servidor compatível (por
+exemplo, um servidor falso local para testes de carga).
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import random
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional
+
+if TYPE_CHECKING:  # o SDK só é importado na primeira chamada
+    from openai import OpenAI
+
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "120"))
+LLM_MAX_INFLIGHT = int(os.getenv("LLM_MAX_INFLIGHT", "8"))
+LLM_RPM = int(os.getenv("LLM_RPM", "0"))
+LLM_TPM = int(os.getenv("LLM_TPM", "0"))
+EMBED_RPM = int(os.getenv("EMBED_RPM", "0"))
+EMBED_TPM = int(os.getenv("EMBED_TPM", "0"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "5"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "30"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "8"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+logger = logging.getLogger("sophia.llm")
+
+class CircuitOpenError(RuntimeError):
+    """O disjuntor está aberto: o provedor falhou seguidamente há pouco."""
+
+
+class _MinuteBudget:
+    """Balde de fichas reabastecido continuamente até ``limit`` por minuto."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.level = float(limit)
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.limit, self.level + (now - self.stamp) * self.limit / 60.0)
+        self.stamp = now
+
+    def acquire(self, amount: float) -> float:
+        """Consome ``amount`` (limitado ao teto), esperando o necessário; devolve a espera."""
+
+        if self.limit <= 0:
+            return 0.0
+        amount = min(amount, self.limit)
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                if self.level >= amount:
+                    self.level -= amount
+                    return waited
+                delay = (amount - self.level) * 60.0 / self.limit
+            time.sleep(delay)
+            waited += delay
+
+    def adjust(self, delta: float) -> None:
+        """Corrige a estimativa com o consumo real (pode deixar o saldo negativo)."""
+
+        if self.limit <= 0 or not delta:
+            return
+        with self.lock:
+            self._refill()
+            self.level -= delta
+
+
+class _Breaker:
+    def __init__(self, failures: int, cooldown: float):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.count = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def before(self) -> None:
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.cooldown or self.probing:
+                raise CircuitOpenError("API do modelo indisponível (disjuntor aberto)")
+            self.probing = True  # meia-abertura: uma chamada de teste
+
+    def success(self) -> None:
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info("Disjuntor fechado")
+            self.count = 0
+            self.opened_at = None
+            self.probing = False
+
+    def failure(self) -> None:
+        with self.lock:
+            self.count += 1
+            self.probing = False
+            if self.failures > 0 and self.count >= self.failures:
+                if self.opened_at is None:
+                    logger.warning("Disjuntor aberto após %s falhas seguidas", self.count)
+                self.opened_at = time.monotonic()
+
+    def state(self) -> str:
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half-open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+
+_client: Optional["OpenAI"] = None
+_client_lock = threading.Lock()
+_inflight = threading.BoundedSemaphore(max(1, LLM_MAX_INFLIGHT))
+_budgets = {
+    "chat": (_MinuteBudget(LLM_RPM), _MinuteBudget(LLM_TPM)),
+    "embed": (_MinuteBudget(EMBED_RPM), _MinuteBudget(EMBED_TPM)),
+}
+_breaker = _Breaker(LLM_BREAKER_FAILURES, LLM_BREAKER_COOLDOWN)
+_usage_lock = threading.Lock()
+_usage: Dict[str, Dict[str, float]] = {}
+
+
+def raw_client() -> "OpenAI":
+    """Cliente compartilhado, sem as novas tentativas do SDK (feitas aqui)."""
+
+    global _client
+    with _client_lock:
+        if _client is None:
+            from openai import OpenAI
+
+            _client = OpenAI(
+                api_key=os.getenv("OPENAI_API_KEY"),
+                base_url=OPENAI_BASE_URL,
+                timeout=LLM_TIMEOUT,
+                max_retries=0,
+            )
+        return _client
+
+
+def _account(caller: str, **inc: float) -> None:
+    with _usage_lock:
+        row = _usage.setdefault(
+            caller,
+            {
+                "calls": 0,
+                "errors": 0,
+                "retries": 0,
+                "rejected": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "cached_tokens": 0,
+                "throttled_seconds": 0.0,
+            },
+        )
+        for k, v in inc.items():
+            row[k] = row.get(k, 0) + v
+
+
+def usage() -> Dict[str, Any]:
+    """Uso acumulado por chamador desde o início do processo e estado do disjuntor."""
+
+    with _usage_lock:
+        callers = {k: dict(v, throttled_seconds=round(v["throttled_seconds"], 3)) for k, v in _usage.items()}
+    return {"breaker": _breaker.state(), "callers": callers}
+
+
+def _estimate_tokens(kind: str, kwargs: Dict[str, Any]) -> int:
+    # ~4 caracteres por token; basta para o orçamento, que é corrigido depois.
+    if kind == "embed":
+        data = kwargs.get("input") or ""
+        chars = sum(len(x) for x in data) if isinstance(data, list) else len(str(data))
+        return chars // 4 + 1
+    chars = sum(len(str(m.get("content") or "")) for m in kwargs.get("messages") or [])
+    return chars // 4 + int(kwargs.get("max_tokens") or kwargs.get("max_completion_tokens") or 0) + 1
+
+
+def cached_tokens(usage_obj: Any) -> int:
+    """Tokens do prompt servidos pelo cache do provedor (``prompt_tokens_details``)."""
+
+    details = getattr(usage_obj, "prompt_tokens_details", None)
+    return int(getattr(details, "cached_tokens", None) or 0)
+
+
+def _retry_after(exc: Exception) -> Optional[float]:
+    response = getattr(exc, "response", None)
+    try:
+        value = response.headers.get("retry-after") if response is not None else None
+        return float(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _retryable(exc: Exception) -> bool:
+    import openai
+
+    if getattr(exc, "code", None) == "insufficient_quota":
+        return False
+    return isinstance(
+        exc,
+        (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError),
+    )
+
+
+def call(caller: str, fn: Callable[..., Any], *args: Any, kind: Optional[str] = None, **kwargs: Any) -> Any:
+    """Executa ``fn(*args, **kwargs)`` com orçamento, limite, novas tentativas e disjuntor.
+
+    ``kind`` (``"chat"``/``"embed"``) escolhe o orçamento por minuto; outras
+    chamadas (arquivos, jobs de fine-tuning) só passam pelo semáforo, pelas
+    novas tentativas e pelo disjuntor.
+    """
+
+    rpm, tpm = _budgets.get(kind or "", (None, None))
+    estimate = _estimate_tokens(kind, kwargs) if tpm is not None else 0
+    attempt = 0
+    while True:
+        try:
+            _breaker.before()
+        except CircuitOpenError:
+            _account(caller, calls=1, errors=1, rejected=1)
+            raise
+        throttled = 0.0
+        if rpm is not None:
+            throttled += rpm.acquire(1)
+            throttled += tpm.acquire(estimate)
+        try:
+            with _inflight:
+                resp = fn(*args, **kwargs)
+        except Exception as exc:
+            if tpm is not None:
+                tpm.adjust(-estimate)  # a chamada não consumiu a cota estimada
+            if not _retryable(exc):
+                _breaker.success()  # o provedor respondeu; erro é da requisição
+                _account(caller, calls=1, errors=1, throttled_seconds=throttled)
+                raise
+            _breaker.failure()
+            if attempt >= LLM_MAX_RETRIES:
+                _account(caller, calls=1, errors=1, throttled_seconds=throttled)
+                raise
+            attempt += 1
+            delay = _retry_after(exc)
+            if delay is None:
+                delay = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2**attempt))
+            _account(caller, retries=1, throttled_seconds=throttled + delay)
+            logger.info("%s: %s; nova tentativa %s em %.1fs", caller, type(exc).__name__, attempt, delay)
+            time.sleep(delay)
+            continue
+        _breaker.success()
+        u = getattr(resp, "usage", None)
+        prompt = getattr(u, "prompt_tokens", None) or 0
+        completion = getattr(u, "completion_tokens", None) or 0
+        cached = cached_tokens(u)
+        if tpm is not None and u is not None:
+            tpm.adjust(prompt + completion - estimate)
+        _account(
+            caller,
+            calls=1,
+            prompt_tokens=prompt,
+            completion_tokens=completion,
+            cached_tokens=cached,
+            throttled_seconds=throttled,
+        )
+        return resp
+
+
+def chat(caller: str, **kwargs: Any) -> Any:
+    """``chat.completions.create`` pelo gateway."""
+
+    return call(caller, raw_client().chat.completions.create, kind="chat", **kwargs)
+
+
+def embed(caller: str, **kwargs: Any) -> Any:
+    """``embeddings.create`` pelo gateway."""
+
+    return call(caller, raw_client().embeddings.create, kind="embed", **kwargs)
+
+
+class _Proxy:
+    """Percorre atributos do cliente e executa a chamada final via ``call``."""
+
+    def __init__(self, caller: str, path: tuple = ()):
+        self._caller = caller
+        self._path = path
+
+    def __getattr__(self, name: str) -> "_Proxy":
+        return _Proxy(self._caller, self._path + (name,))
+
+    def __call__(self, *args: Any, **kwargs: Any) -> Any:
+        target: Any = raw_client()
+        for name in self._path:
+            target = getattr(target, name)
+        kind = {"chat.completions.create": "chat", "embeddings.create": "embed"}.get(".".join(self._path))
+        return call(self._caller, target, *args, kind=kind, **kwargs)
+
+
+def client(caller: str) -> Any:
+    """Objeto com a mesma interface de ``OpenAI`` cujas chamadas passam pelo gateway."""
+
+    return _Proxy(caller)
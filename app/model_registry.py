@@ -1,14 +1,35 @@
-import json, os, sys
+"""Registro do modelo de geração em uso.
+
+O estado fica em ``models.json`` (``current``/``prev``/``canary``/``routes``/
+``shadow``) e é lido a
+cada chamada por ``gen_model()``: o arquivo só é relido quando o ``mtime``
+muda, e uma troca feita por outro processo ou host chega via ``NOTIFY`` no
+canal ``sophia_models``. A gravação é atômica (arquivo temporário +
+``os.replace``), então todos os workers passam a usar o novo modelo sem
+reiniciar o serviço. ``"latest"`` resolve para o último modelo concluído em
+``finetune_runs``.
+"""
+import json, os, sys, hashlib, logging, tempfile, threading, time
 from pathlib import Path
 from dotenv import load_dotenv
 
 APP_DIR = Path(__file__).parent
 ENV_P = APP_DIR / ".env"
-REG_P = APP_DIR / "models.json"
+REG_P = Path(os.getenv("MODEL_REGISTRY_FILE", APP_DIR / "models.json"))
 if not ENV_P.exists():
     ENV_P.write_text("", encoding="utf-8")
 load_dotenv(ENV_P, override=True)
 
+DB_URL = os.getenv("DATABASE_URL")
+DEFAULT_MODEL = os.getenv("GEN_MODEL", "gpt-5")
+CHANNEL = "sophia_models"
+LISTEN = os.getenv("MODEL_REGISTRY_LISTEN", "true").lower() == "true"
+logger = logging.getLogger("sophia.models")
+
+_lock = threading.Lock()
+_state = {"mtime": None, "data": None}
+_listener = None
+
 def load_env(): return ENV_P.read_text(encoding="utf-8").splitlines()
 def save_env(lines): ENV_P.write_text("\n".join(lines) + "\n", encoding="utf-8")
 
@@ -20,26 +41,171 @@ def set_env(key, val):
     if not found: lines.append(f"{key}={val}")
     save_env(lines)
 
+def _read_file():
+    if REG_P.exists(): return json.loads(REG_P.read_text(encoding="utf-8"))
+    return {"current": None, "prev": None}
+
+def _write_file(d):
+    fd, tmp = tempfile.mkstemp(dir=REG_P.parent, prefix=".models.", suffix=".json")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(d, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, REG_P)
+
+def _notify(d):
+    if not DB_URL: return
+    try:
+        import psycopg
+        with psycopg.connect(DB_URL, autocommit=True) as conn:
+            conn.execute("SELECT pg_notify(%s, %s)", (CHANNEL, json.dumps(d, ensure_ascii=False)))
+    except Exception as exc:  # pragma: no cover - melhor esforço
+        logger.warning("Falha ao notificar troca de modelo: %s", exc)
+
+def _listen_loop():
+    import psycopg
+    while True:
+        try:
+            with psycopg.connect(DB_URL, autocommit=True) as conn:
+                conn.execute(f"LISTEN {CHANNEL}")
+                for n in conn.notifies():
+                    try: d = json.loads(n.payload)
+                    except json.JSONDecodeError: d = None
+                    with _lock:
+                        # Sem payload válido, força a releitura do arquivo.
+                        _state["data"] = d; _state["mtime"] = _mtime()
+        except Exception as exc:  # pragma: no cover - reconecta
+            logger.warning("LISTEN %s interrompido: %s", CHANNEL, exc)
+            time.sleep(5)
+
+def _ensure_listener():
+    global _listener
+    if _listener is None and LISTEN and DB_URL:
+        _listener = threading.Thread(target=_listen_loop, name="model-registry", daemon=True)
+        _listener.start()
+
+def _mtime():
+    try: return REG_P.stat().st_mtime_ns
+    except FileNotFoundError: return 0
+
 def get_current():
-    if REG_P.exists(): d = json.loads(REG_P.read_text(encoding="utf-8"))
-    else: d = {"current": None, "prev": None}
+    """Estado atual do registro (relê ``models.json`` só se ele mudou)."""
+    _ensure_listener()
+    mtime = _mtime()
+    with _lock:
+        if _state["data"] is None or mtime != _state["mtime"]:
+            _state["data"] = _read_file(); _state["mtime"] = mtime
+        return dict(_state["data"])
+
+def _bucket(key, salt="", size=100):
+    return int(hashlib.sha256(f"{salt}{key}".encode("utf-8")).hexdigest()[:8], 16) % size
+
+def gen_model(key=None):
+    """Modelo de geração para esta chamada.
+
+    ``key`` (hash da pergunta ou sessão) escolhe de forma estável o braço do
+    teste A/B (``routes``, por peso) ou, sem ele, se a chamada cai no canário.
+    """
+    d = get_current()
+    routes = [r for r in d.get("routes") or [] if r.get("model") and r.get("weight", 0) > 0]
+    if key is not None and routes:
+        total = sum(int(r["weight"]) for r in routes)
+        b = _bucket(key, "ab:", total)
+        for r in routes:
+            b -= int(r["weight"])
+            if b < 0: return r["model"]
+    canary = d.get("canary") or {}
+    if key is not None and canary.get("model") and _bucket(key) < int(canary.get("percent") or 0):
+        return canary["model"]
+    return d.get("current") or DEFAULT_MODEL
+
+def shadow_model(key):
+    """Modelo candidato que roda em sombra para ``key``, ou ``None``."""
+    sh = get_current().get("shadow") or {}
+    if sh.get("model") and _bucket(key, "shadow:") < int(sh.get("percent") or 0):
+        return sh["model"]
+    return None
+
+def latest_trained():
+    """Último ``trained_model_id`` concluído em ``finetune_runs``."""
+    import psycopg
+    with psycopg.connect(DB_URL) as conn, conn.cursor() as cur:
+        cur.execute("""SELECT id, trained_model_id FROM finetune_runs
+                       WHERE status='succeeded' AND trained_model_id IS NOT NULL
+                       ORDER BY finished_at DESC NULLS LAST, id DESC LIMIT 1""")
+        return cur.fetchone()
+
+def _resolve(model_id):
+    if model_id != "latest": return model_id, None
+    row = latest_trained() if DB_URL else None
+    if not row: raise ValueError("nenhum fine-tuning concluído em finetune_runs")
+    return row[1], row[0]
+
+def _publish(d):
+    d["updated_at"] = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    _write_file(d)
+    set_env("GEN_MODEL", d.get("current") or os.getenv("FINETUNE_BASE","gpt-4o-mini"))
+    with _lock:
+        _state["data"] = dict(d); _state["mtime"] = _mtime()
+    _notify(d)
     return d
 
 def set_current(model_id):
-    d = get_current(); d["prev"] = d.get("current"); d["current"] = model_id
-    REG_P.write_text(json.dumps(d, ensure_ascii=False, indent=2), encoding="utf-8")
-    set_env("GEN_MODEL", model_id or os.getenv("FINETUNE_BASE","gpt-4o-mini"))
-    return d
+    model_id, run_id = _resolve(model_id)
+    d = _read_file(); d["prev"] = d.get("current"); d["current"] = model_id
+    d["run_id"] = run_id; d.pop("canary", None)
+    return _publish(d)
+
+def set_canary(model_id, percent):
+    """Envia ``percent``% do tráfego para ``model_id`` (0 desliga o canário)."""
+    d = _read_file()
+    if percent <= 0:
+        d.pop("canary", None)
+    else:
+        model_id, run_id = _resolve(model_id)
+        d["canary"] = {"model": model_id, "percent": min(100, int(percent)), "run_id": run_id}
+    return _publish(d)
+
+def set_routes(routes):
+    """Teste A/B: ``routes`` é uma lista ``[{"model", "weight"}]`` (vazia desliga)."""
+    d = _read_file()
+    routes = [{"model": _resolve(r["model"])[0], "weight": int(r.get("weight", 1))} for r in routes or []]
+    if routes: d["routes"] = routes
+    else: d.pop("routes", None)
+    return _publish(d)
+
+def set_shadow(model_id, percent=100):
+    """Executa ``model_id`` em sombra para ``percent``% das chamadas (0 desliga)."""
+    d = _read_file()
+    if percent <= 0: d.pop("shadow", None)
+    else: d["shadow"] = {"model": _resolve(model_id)[0], "percent": min(100, int(percent))}
+    return _publish(d)
+
+def rollback():
+    d = _read_file()
+    prev = d.get("prev")
+    if not prev: raise ValueError("sem prev")
+    return set_current(prev)
 
 if __name__ == "__main__":
     cmd = sys.argv[1] if len(sys.argv)>1 else ""
-    if cmd == "use":
-        mid = sys.argv[2] if len(sys.argv)>2 else ""
-        print(json.dumps(set_current(mid), ensure_ascii=False))
-    elif cmd == "rollback":
-        d = get_current()
-        prev = d.get("prev")
-        if prev: print(json.dumps(set_current(prev), ensure_ascii=False))
-        else: print(json.dumps({"error":"sem prev"}, ensure_ascii=False))
-    else:
-        print(json.dumps(get_current(), ensure_ascii=False))
+    try:
+        if cmd == "use":
+            mid = sys.argv[2] if len(sys.argv)>2 else ""
+            print(json.dumps(set_current(mid), ensure_ascii=False))
+        elif cmd == "canary":
+            mid = sys.argv[2] if len(sys.argv)>2 else ""
+            pct = int(sys.argv[3]) if len(sys.argv)>3 else 10
+            print(json.dumps(set_canary(mid, pct), ensure_ascii=False))
+        elif cmd == "ab":
+            # ab modelo_a=50 modelo_b=50  (sem argumentos desliga o A/B)
+            routes = [dict(zip(("model", "weight"), a.rsplit("=", 1))) for a in sys.argv[2:]]
+            print(json.dumps(set_routes(routes), ensure_ascii=False))
+        elif cmd == "shadow":
+            mid = sys.argv[2] if len(sys.argv)>2 else ""
+            pct = int(sys.argv[3]) if len(sys.argv)>3 else 100
+            print(json.dumps(set_shadow(mid, pct if mid else 0), ensure_ascii=False))
+        elif cmd == "rollback":
+            print(json.dumps(rollback(), ensure_ascii=False))
+        else:
+            print(json.dumps(_read_file(), ensure_ascii=False))
+    except ValueError as exc:
+        print(json.dumps({"error": str(exc)}, ensure_ascii=False))
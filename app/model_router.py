@@ -0,0 +1,141 @@
+"""Roteamento da etapa de geração entre modelos, com métricas por modelo.
+
+``complete()`` escolhe o modelo pelo registro (A/B estável pelo hash da
+pergunta ou sessão, canário ou ``current``), mede latência e tokens e grava
+uma linha em ``model_calls``. Quando há modelo em sombra, a mesma chamada é
+repetida em segundo plano com o candidato; a resposta do usuário não espera
+por ela nem é afetada. ``stats()`` cruza as chamadas com ``feedback`` (pelo
+``query_hash``) e com ``finetune_runs.trained_model_id``.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import psycopg
+from psycopg.rows import dict_row
+
+import db
+import llm_gateway
+import model_registry
+
+DB_URL = os.getenv("DATABASE_URL")
+MODEL_METRICS = os.getenv("MODEL_METRICS", "true").lower() == "true"
+SHADOW_WORKERS = int(os.getenv("SHADOW_WORKERS", "2"))
+logger = logging.getLogger("sophia.router")
+
+# Gravação de métricas e chamadas em sombra ficam fora do caminho da resposta.
+_background = ThreadPoolExecutor(max_workers=max(1, SHADOW_WORKERS), thread_name_prefix="router")
+
+
+def _record(row: Dict[str, Any]) -> None:
+    if not MODEL_METRICS:
+        return
+    try:
+        with psycopg.connect(DB_URL) as conn, conn.cursor() as cur:
+            cur.execute(
+                """INSERT INTO model_calls(model, source, query_hash, shadow, latency_ms,
+                                           prompt_tokens, completion_tokens, cached_tokens, error)
+                   VALUES (%(model)s, %(source)s, %(query_hash)s, %(shadow)s, %(latency_ms)s,
+                           %(prompt_tokens)s, %(completion_tokens)s, %(cached_tokens)s, %(error)s)""",
+                row,
+            )
+            conn.commit()
+    except psycopg.Error as exc:  # pragma: no cover - fallback defensivo
+        logger.warning("Não foi possível registrar métricas do modelo: %s", exc)
+
+
+def _call(model: str, messages: List[Dict[str, str]], source: str, qhash: str, shadow: bool, **kwargs):
+    row = {
+        "model": model,
+        "source": source,
+        "query_hash": qhash,
+        "shadow": shadow,
+        "prompt_tokens": None,
+        "completion_tokens": None,
+        "cached_tokens": None,
+        "error": None,
+    }
+    t0 = time.perf_counter()
+    try:
+        resp = llm_gateway.chat(f"router.{source}", model=model, messages=messages, **kwargs)
+        usage = getattr(resp, "usage", None)
+        row["prompt_tokens"] = getattr(usage, "prompt_tokens", None)
+        row["completion_tokens"] = getattr(usage, "completion_tokens", None)
+        row["cached_tokens"] = llm_gateway.cached_tokens(usage) if usage is not None else None
+        return resp.choices[0].message.content or ""
+    except Exception as exc:
+        row["error"] = str(exc)[:500]
+        raise
+    finally:
+        row["latency_ms"] = int((time.perf_counter() - t0) * 1000)
+        _background.submit(_record, row)
+
+
+def _shadow(model: str, messages: List[Dict[str, str]], source: str, qhash: str, **kwargs) -> None:
+    try:
+        _call(model, messages, source, qhash, True, **kwargs)
+    except Exception as exc:  # pragma: no cover - sombra nunca afeta a resposta
+        logger.info("Chamada em sombra (%s) falhou: %s", model, exc)
+
+
+def complete(
+    messages: List[Dict[str, str]],
+    key: str,
+    source: str,
+    qhash: str,
+    **kwargs: Any,
+) -> Tuple[str, str]:
+    """Gera a resposta e devolve ``(texto, modelo)``; exceções da chamada principal sobem."""
+
+    model = model_registry.gen_model(key)
+    candidate = model_registry.shadow_model(key)
+    if candidate and candidate != model:
+        _background.submit(_shadow, candidate, messages, source, qhash, **kwargs)
+    return _call(model, messages, source, qhash, False, **kwargs), model
+
+
+def stats(days: int = 7, source: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Latência, tokens e taxa de feedback por modelo nos últimos ``days`` dias."""
+
+    where = "mc.created_at > now() - make_interval(days => %(days)s)"
+    if source:
+        where += " AND mc.source = %(source)s"
+    sql = f"""
+    WITH fb AS (
+      SELECT query_hash,
+             COUNT(*) FILTER (WHERE signal > 0) AS pos,
+             COUNT(*) FILTER (WHERE signal < 0) AS neg
+      FROM feedback GROUP BY query_hash
+    )
+    SELECT mc.model, mc.shadow, fr.id AS run_id, fr.base_model,
+           COUNT(*) AS calls,
+           COUNT(*) FILTER (WHERE mc.error IS NOT NULL) AS errors,
+           ROUND(AVG(mc.latency_ms)) AS latency_avg_ms,
+           percentile_cont(0.5) WITHIN GROUP (ORDER BY mc.latency_ms) AS latency_p50_ms,
+           percentile_cont(0.95) WITHIN GROUP (ORDER BY mc.latency_ms) AS latency_p95_ms,
+           ROUND(AVG(mc.prompt_tokens)) AS prompt_tokens_avg,
+           ROUND(AVG(mc.completion_tokens)) AS completion_tokens_avg,
+           ROUND(SUM(mc.cached_tokens)::numeric / NULLIF(SUM(mc.prompt_tokens), 0), 3) AS cached_ratio,
+           COUNT(fb.query_hash) AS with_feedback,
+           COALESCE(SUM(fb.pos), 0) AS feedback_pos,
+           COALESCE(SUM(fb.neg), 0) AS feedback_neg
+    FROM model_calls mc
+    LEFT JOIN fb ON fb.query_hash = mc.query_hash AND NOT mc.shadow
+    LEFT JOIN finetune_runs fr ON fr.trained_model_id = mc.model
+    WHERE {where}
+    GROUP BY mc.model, mc.shadow, fr.id, fr.base_model
+    ORDER BY calls DESC
+    """
+    with db.connect(readonly=True) as conn, conn.cursor(row_factory=dict_row) as cur:
+        cur.execute(sql, {"days": days, "source": source})
+        rows = cur.fetchall()
+    for r in rows:
+        rated = r["feedback_pos"] + r["feedback_neg"]
+        r["positive_rate"] = round(r["feedback_pos"] / rated, 3) if rated else None
+        r["feedback_rate"] = round(r["with_feedback"] / r["calls"], 3) if r["calls"] else None
+    return rows
@@ -0,0 +1,217 @@
+"""Particionamento de ``docs`` e ``emb_cache`` para corpora muito grandes.
+
+``docs`` passa a ser particionada por LIST na coluna ``part``: a subárvore de
+primeiro nível de ``DATA_DIR`` onde o arquivo está (``_root`` para arquivos
+soltos na raiz e ``_other`` para caminhos fora dela). Cada partição tem o seu
+próprio HNSW (criado por ``vector_index``) e herda os índices GIN/B-tree
+declarados na tabela-mãe, então a ingestão de um diretório só reconstrói o
+índice vetorial das partições que tocou. ``emb_cache`` é particionada por
+HASH de ``chunk_hash`` em ``EMB_CACHE_PARTITIONS`` partes.
+
+A migração do schema atual é opcional e explícita::
+
+    python app/partitions.py migrate [--drop-legacy]
+
+As FKs de ``feedback``/``doc_analysis`` para ``docs(id)`` não são possíveis
+com a chave primária ``(id, part)``; um gatilho ``AFTER DELETE`` reproduz o
+``ON DELETE CASCADE``.
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import psycopg
+from dotenv import load_dotenv
+
+import vector_index
+
+load_dotenv(Path(__file__).with_name(".env"), override=True)
+DB_URL = os.getenv("DATABASE_URL")
+DATA_DIR = str(Path(os.getenv("DATA_DIR", ".")).expanduser()).rstrip("/")
+DOCS_PARTITIONED = os.getenv("DOCS_PARTITIONED", "auto").lower()
+EMB_CACHE_PARTITIONS = int(os.getenv("EMB_CACHE_PARTITIONS", "8"))
+
+_partitioned: Optional[bool] = None
+
+
+def partition_key(path: str, root: str = DATA_DIR) -> str:
+    """Valor de ``part`` para ``path`` (mesma regra da função SQL ``docs_part``)."""
+
+    if root and path.startswith(root + "/"):
+        rest = path[len(root) + 1 :]
+        return rest.split("/", 1)[0] if "/" in rest else "_root"
+    return "_other"
+
+
+def prefix_partition(prefix: str, root: str = DATA_DIR) -> Optional[str]:
+    """Partição que contém todo ``prefix``, se ele descer abaixo do 1º nível."""
+
+    if not root or not prefix.startswith(root + "/"):
+        return None
+    rest = prefix[len(root) + 1 :]
+    if "/" not in rest:
+        # "raiz/sub" também casa com "raiz/sub2/..."; só poda com a barra final.
+        return None
+    return rest.split("/", 1)[0] or None
+
+
+def partition_table(part: str) -> str:
+    slug = re.sub(r"[^a-z0-9]+", "_", part.lower()).strip("_")[:40] or "p"
+    return f"docs_{slug}_{hashlib.sha1(part.encode('utf-8')).hexdigest()[:6]}"
+
+
+def is_partitioned(conn: Optional[psycopg.Connection] = None) -> bool:
+    """``docs`` é particionada? (``DOCS_PARTITIONED=auto`` consulta o catálogo uma vez)."""
+
+    global _partitioned
+    if DOCS_PARTITIONED in ("true", "false"):
+        return DOCS_PARTITIONED == "true"
+    if _partitioned is None:
+        sql = "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('docs'))"
+        try:
+            if conn is not None:
+                _partitioned = bool(conn.execute(sql).fetchone()[0])
+            else:
+                with psycopg.connect(DB_URL) as c:
+                    _partitioned = bool(c.execute(sql).fetchone()[0])
+        except psycopg.Error:
+            return False
+    return _partitioned
+
+
+def list_partitions(conn: psycopg.Connection) -> List[Tuple[str, str]]:
+    """``[(tabela, valor)]`` das partições LIST de ``docs`` (vazio se não particionada)."""
+
+    cur = conn.execute(
+        """SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+             FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass('docs')
+            ORDER BY c.relname"""
+    )
+    out = []
+    for name, bound in cur.fetchall():
+        m = re.search(r"IN \('(.*)'\)", bound or "")
+        out.append((name, m.group(1).replace("''", "'") if m else "DEFAULT"))
+    return out
+
+
+def ensure_partition(conn: psycopg.Connection, part: str) -> str:
+    """Cria a partição de ``part`` se ainda não existir e devolve o nome da tabela."""
+
+    table = partition_table(part)
+    with conn.cursor() as cur:
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {table} PARTITION OF docs FOR VALUES IN ({_lit(part)})")
+    conn.commit()
+    return table
+
+
+def _lit(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def migrate(drop_legacy: bool = False) -> Dict[str, Any]:
+    """Converte ``docs``/``emb_cache`` em tabelas particionadas, preservando ids."""
+
+    with psycopg.connect(DB_URL) as conn:
+        if is_partitioned(conn):
+            return {"ok": True, "skipped": "docs já é particionada"}
+        with conn.cursor() as cur:
+            # Índices da tabela antiga ganham sufixo para os nomes ficarem com a nova.
+            for idx in ("docs_tsv_idx", "docs_meta_gin", "docs_chunk_hash_idx", "idx_docs_path_pattern"):
+                cur.execute(f"ALTER INDEX IF EXISTS {idx} RENAME TO {idx}_legacy")
+            for mode in vector_index.VECTOR_INDEX_MODES:
+                cur.execute(f"DROP INDEX IF EXISTS {vector_index.index_name(mode)}")
+            cur.execute("ALTER TABLE docs RENAME TO docs_legacy")
+            cur.execute("ALTER TABLE docs_legacy RENAME CONSTRAINT docs_pkey TO docs_legacy_pkey")
+            cur.execute("ALTER TABLE emb_cache RENAME TO emb_cache_legacy")
+            cur.execute("ALTER TABLE emb_cache_legacy RENAME CONSTRAINT emb_cache_pkey TO emb_cache_legacy_pkey")
+            cur.execute(
+                """SELECT conrelid::regclass::text, conname FROM pg_constraint
+                    WHERE contype = 'f' AND confrelid = 'docs_legacy'::regclass"""
+            )
+            for table, con in cur.fetchall():
+                cur.execute(f'ALTER TABLE {table} DROP CONSTRAINT "{con}"')
+
+            cur.execute(
+                "CREATE TABLE docs (LIKE docs_legacy INCLUDING DEFAULTS, part TEXT NOT NULL) PARTITION BY LIST (part)"
+            )
+            cur.execute("ALTER SEQUENCE docs_id_seq OWNED BY docs.id")
+            cur.execute("ALTER TABLE docs ADD PRIMARY KEY (id, part), ADD UNIQUE (part, path, chunk_no)")
+            cur.execute("CREATE INDEX docs_tsv_idx ON docs USING GIN (tsv)")
+            cur.execute("CREATE INDEX docs_meta_gin ON docs USING GIN (meta)")
+            cur.execute("CREATE INDEX docs_chunk_hash_idx ON docs (chunk_hash)")
+            cur.execute("CREATE INDEX idx_docs_path_pattern ON docs (path text_pattern_ops)")
+            cur.execute("CREATE TABLE docs_default PARTITION OF docs DEFAULT")
+            cur.execute(
+                """CREATE TRIGGER docs_tsv_update_tr BEFORE INSERT OR UPDATE OF content ON docs
+                   FOR EACH ROW EXECUTE FUNCTION docs_tsv_update()"""
+            )
+            cur.execute(
+                """CREATE TRIGGER docs_cleanup_refs_tr AFTER DELETE ON docs
+                   FOR EACH ROW EXECUTE FUNCTION docs_cleanup_refs()"""
+            )
+            cur.execute("SELECT to_regproc('qa_cache_invalidate') IS NOT NULL")
+            if cur.fetchone()[0]:
+                cur.execute(
+                    """CREATE TRIGGER docs_qa_cache_invalidate_tr AFTER UPDATE OF chunk_hash ON docs
+                       FOR EACH ROW WHEN (OLD.chunk_hash IS DISTINCT FROM NEW.chunk_hash)
+                       EXECUTE FUNCTION qa_cache_invalidate()"""
+                )
+                cur.execute(
+                    """CREATE TRIGGER docs_qa_cache_delete_tr AFTER DELETE ON docs
+                       FOR EACH ROW EXECUTE FUNCTION qa_cache_invalidate()"""
+                )
+            cur.execute("SELECT DISTINCT docs_part(path, %s) FROM docs_legacy", (DATA_DIR,))
+            parts = [r[0] for r in cur.fetchall()]
+            for part in parts:
+                cur.execute(
+                    f"CREATE TABLE {partition_table(part)} PARTITION OF docs FOR VALUES IN ({_lit(part)})"
+                )
+            cur.execute("INSERT INTO docs SELECT l.*, docs_part(l.path, %s) FROM docs_legacy l", (DATA_DIR,))
+            moved = cur.rowcount
+
+            cur.execute(
+                "CREATE TABLE emb_cache (LIKE emb_cache_legacy INCLUDING DEFAULTS) PARTITION BY HASH (chunk_hash)"
+            )
+            cur.execute("ALTER TABLE emb_cache ADD PRIMARY KEY (chunk_hash)")
+            n = max(1, EMB_CACHE_PARTITIONS)
+            for i in range(n):
+                cur.execute(
+                    f"CREATE TABLE emb_cache_p{i} PARTITION OF emb_cache FOR VALUES WITH (MODULUS {n}, REMAINDER {i})"
+                )
+            cur.execute("INSERT INTO emb_cache SELECT * FROM emb_cache_legacy")
+            if drop_legacy:
+                cur.execute("DROP TABLE docs_legacy, emb_cache_legacy")
+        conn.commit()
+
+        for table, _ in list_partitions(conn):
+            vector_index.create_index(conn, vector_index.VECTOR_INDEX, table)
+    return {"ok": True, "partitions": len(parts), "rows": moved, "legacy_dropped": drop_legacy}
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="Particionamento de docs/emb_cache")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    m = sub.add_parser("migrate", help="Converter o schema atual em tabelas particionadas")
+    m.add_argument("--drop-legacy", action="store_true", help="Remover docs_legacy/emb_cache_legacy ao final")
+    sub.add_parser("list", help="Listar partições de docs")
+    a = ap.parse_args(argv)
+    if a.cmd == "migrate":
+        out: Any = migrate(a.drop_legacy)
+    else:
+        with psycopg.connect(DB_URL) as conn:
+            out = [{"table": t, "part": p} for t, p in list_partitions(conn)]
+    print(json.dumps(out, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover - CLI entry
+    sys.exit(main())
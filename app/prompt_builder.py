@@ -0,0 +1,109 @@
+"""Montagem de prompts com prefixo estável para o cache de prompt do provedor.
+
+O cache automático da OpenAI só reaproveita o prefixo idêntico da requisição.
+Por isso a ordem é sempre: instruções fixas (mensagem de sistema), contexto em
+ordem canônica (``path``/``chunk_no``, não pela nota, que muda a cada busca) e,
+por último, a parte variável (pergunta). A verificação self-RAG continua a
+mesma conversa (``verify_messages``), então todo o prompt de geração vira
+prefixo já em cache.
+"""
+
+from __future__ import annotations
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+VERIFY_INSTRUCTIONS = (
+    "Revise a resposta, mantendo apenas afirmações suportadas pelo CONTEXTO.\n"
+    "Se algo não estiver claramente suportado, remova ou marque como incerto. Mantenha as citações [#n].\n"
+    "Devolva somente a resposta revisada."
+)
+
+
+MAX_HEADER_COPIES = 5
+
+
+def _header(n: int, r: Dict[str, Any]) -> str:
+    """``[#n] path (chunk c)`` e, para texto repetido, os demais caminhos."""
+
+    head = f"[#{n}] {r['path']} (chunk {r['chunk_no']})"
+    others = [s["path"] for s in (r.get("sources") or [])[1:]]
+    if others:
+        head += " — também em: " + "; ".join(others[:MAX_HEADER_COPIES])
+        if len(others) > MAX_HEADER_COPIES:
+            head += f" (+{len(others) - MAX_HEADER_COPIES})"
+    return head
+
+
+def select_context(
+    rows: Sequence[Dict[str, Any]], k: int, max_chars: int
+) -> Tuple[List[str], List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Escolhe os trechos pela nota e os numera em ordem canônica.
+
+    Devolve ``(blocks, cites, used)``: ``blocks[i]`` é o bloco ``[#i+1]`` e
+    ``used[i]`` a linha de ``rows`` correspondente. Trechos com o mesmo texto
+    em vários arquivos (``sources``) viram um bloco só, citado com todos os
+    caminhos.
+    """
+
+    chosen: List[Tuple[Dict[str, Any], str]] = []
+    total = 0
+    for r in rows[:k]:
+        body = (r["content"] or "").replace("\n", " ").strip()
+        # O número [#n] só é conhecido depois da ordenação; reserva espaço para ele.
+        size = len(f"{_header(k, r)}\n{body}\n")
+        if total + size > max_chars:
+            break
+        chosen.append((r, body))
+        total += size
+    chosen.sort(key=lambda item: (item[0]["path"], item[0]["chunk_no"]))
+
+    blocks, cites, used = [], [], []
+    for i, (r, body) in enumerate(chosen, 1):
+        blocks.append(f"{_header(i, r)}\n{body}\n")
+        cites.append(
+            {
+                "n": i,
+                "id": r["id"],
+                "path": r["path"],
+                "chunk": r["chunk_no"],
+                "chunk_hash": r.get("chunk_hash"),
+                "sources": r.get("sources") or [{"id": r["id"], "path": r["path"], "chunk": r["chunk_no"]}],
+            }
+        )
+        used.append(r)
+    return blocks, cites, used
+
+
+def messages(system: str, blocks: Sequence[str], tail: str, empty: str) -> List[Dict[str, str]]:
+    """``[sistema fixo, contexto + parte variável]`` — a parte variável sempre no fim."""
+
+    contexts = "\n---\n".join(blocks) or empty
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": f"CONTEXTO:\n{contexts}\n\n{tail}"},
+    ]
+
+
+def verify_instructions(focus: Optional[Sequence[int]] = None, claims: Optional[Sequence[str]] = None) -> str:
+    instr = VERIFY_INSTRUCTIONS
+    if focus:
+        instr += "\nConfira em especial as afirmações apoiadas em " + ", ".join(f"[#{n}]" for n in focus) + "."
+    if claims:
+        instr += "\nFrases com pouco apoio aparente no contexto (as demais podem ser mantidas):\n"
+        instr += "\n".join(f"- {c}" for c in claims)
+    return instr
+
+
+def verify_messages(
+    prefix: Sequence[Dict[str, str]],
+    draft: str,
+    focus: Optional[Sequence[int]] = None,
+    claims: Optional[Sequence[str]] = None,
+) -> List[Dict[str, str]]:
+    """Continua a conversa de geração pedindo a revisão do rascunho."""
+
+    return [
+        *prefix,
+        {"role": "assistant", "content": draft},
+        {"role": "user", "content": verify_instructions(focus, claims)},
+    ]
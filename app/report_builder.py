@@ -0,0 +1,203 @@
+"""Relatório das análises em ``doc_analysis``.
+
+O relatório é gerado em fluxo a partir de um cursor no servidor
+(``REPORT_ITERSIZE`` linhas por ida ao banco), lendo só as colunas exibidas.
+A paginação usa cursor opaco sobre ``(created_at, id)`` e a saída pode ser
+markdown, NDJSON ou CSV.
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import csv
+import io
+import itertools
+import json
+import os
+import sys
+from datetime import date, datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from psycopg.rows import dict_row
+
+import db
+
+load_dotenv(Path(__file__).with_name(".env"), override=True)
+DB_URL = os.getenv("DATABASE_URL")
+REPORT_ITERSIZE = int(os.getenv("REPORT_ITERSIZE", "200"))
+REPORT_FORMATS = ("markdown", "ndjson", "csv")
+MEDIA_TYPES = {
+    "markdown": "text/markdown; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+COLUMNS = ("id", "path", "tipo", "numero", "data", "orgao", "summary", "pros", "cons", "timeline", "created_at")
+CSV_COLUMNS = ("path", "tipo", "numero", "data", "orgao", "summary", "n_pros", "n_cons", "created_at")
+
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    raw = f"{created_at.isoformat()}|{row_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(token: str) -> Tuple[datetime, int]:
+    try:
+        ts, row_id = base64.urlsafe_b64decode(token.encode("ascii")).decode("utf-8").split("|", 1)
+        return datetime.fromisoformat(ts), int(row_id)
+    except (ValueError, UnicodeDecodeError) as exc:
+        raise ValueError(f"cursor inválido: {token}") from exc
+
+
+def _escape_like(prefix: str) -> str:
+    return prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _where(prefix: Optional[str], after: Optional[str]) -> Tuple[str, List[Any]]:
+    clauses, params = [], []
+    if prefix:
+        # LIKE com prefixo literal usa o índice idx_da_path_pattern (text_pattern_ops).
+        clauses.append("path LIKE %s")
+        params.append(_escape_like(prefix.rstrip("/")) + "%")
+    if after:
+        created_at, row_id = decode_cursor(after)
+        clauses.append("(created_at, id) < (%s, %s)")
+        params += [created_at, row_id]
+    return ("WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+
+def iter_rows(
+    prefix: Optional[str] = None,
+    limit: int = 100,
+    after: Optional[str] = None,
+    page: Optional[Dict[str, Any]] = None,
+) -> Iterator[Dict[str, Any]]:
+    """Linhas da página; ``page["next_cursor"]`` é preenchido antes da primeira.
+
+    O cursor no servidor lê ``limit + 1`` linhas: antes de devolver a página,
+    ele salta para a última linha emitida e para a seguinte, e o cursor da
+    próxima página sai da mesma consulta (e do mesmo snapshot) que gera a página.
+    """
+
+    where, params = _where(prefix, after)
+    sql = f"SELECT {', '.join(COLUMNS)} FROM doc_analysis {where} ORDER BY created_at DESC, id DESC LIMIT %s"
+    limit = max(0, limit)
+    with db.connect(readonly=True) as conn:
+        with conn.cursor(name="report_rows", row_factory=dict_row, scrollable=True) as cur:
+            cur.itersize = REPORT_ITERSIZE
+            cur.execute(sql, params + [limit + 1])
+            if page is not None:
+                page["next_cursor"] = None
+                if limit:
+                    cur.scroll(limit - 1, mode="absolute")
+                    tail = cur.fetchmany(2)
+                    if len(tail) == 2:
+                        page["next_cursor"] = encode_cursor(tail[0]["created_at"], tail[0]["id"])
+                    cur.scroll(0, mode="absolute")
+            yield from itertools.islice(cur, limit)
+
+
+def _jsonable(v: Any) -> Any:
+    return v.isoformat() if isinstance(v, (date, datetime)) else v
+
+
+def render_markdown(rows: Iterator[Dict[str, Any]]) -> Iterator[str]:
+    # Lê a primeira linha antes do título para que o primeiro pedaço já
+    # execute a consulta (a API trata os erros do banco nesse ponto).
+    rows = iter(rows)
+    first = next(rows, None)
+    yield "# Relatório de Análise\n\n"
+    if first is None:
+        return
+    for r in itertools.chain([first], rows):
+        lines = [f"## {r['path']}"]
+        meta = [f"**{k}**: {r[k]}" for k in ("tipo", "numero", "data", "orgao") if r.get(k)]
+        if meta:
+            lines.append(" | ".join(meta))
+        if r.get("summary"):
+            lines.append("\n**Resumo:** " + r["summary"])
+        for label, key in (("Prós", "pros"), ("Contras", "cons")):
+            items = r.get(key) or []
+            if items:
+                lines.append(f"\n**{label}:**")
+                lines += [f"- {it.get('claim', '')} — {it.get('why', '')}" for it in items]
+        timeline = r.get("timeline") or []
+        if timeline:
+            lines.append("\n**Linha do tempo:**")
+            lines += [f"- {ev.get('date', '')}: {ev.get('event', '')}" for ev in timeline]
+        yield "\n".join(lines) + "\n\n"
+
+
+def render_ndjson(rows: Iterator[Dict[str, Any]]) -> Iterator[str]:
+    for r in rows:
+        yield json.dumps({k: _jsonable(v) for k, v in r.items()}, ensure_ascii=False) + "\n"
+
+
+def render_csv(rows: Iterator[Dict[str, Any]]) -> Iterator[str]:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(CSV_COLUMNS)
+    for r in rows:
+        writer.writerow(
+            [
+                r["path"],
+                r.get("tipo"),
+                r.get("numero"),
+                _jsonable(r.get("data")),
+                r.get("orgao"),
+                r.get("summary"),
+                len(r.get("pros") or []),
+                len(r.get("cons") or []),
+                _jsonable(r.get("created_at")),
+            ]
+        )
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+RENDERERS = {"markdown": render_markdown, "ndjson": render_ndjson, "csv": render_csv}
+
+
+def stream(
+    prefix: Optional[str] = None,
+    limit: int = 100,
+    fmt: str = "markdown",
+    after: Optional[str] = None,
+    page: Optional[Dict[str, Any]] = None,
+) -> Iterator[str]:
+    """Relatório em pedaços; com ``page``, o cursor da próxima página fica em
+    ``page["next_cursor"]`` assim que o primeiro pedaço é produzido."""
+
+    if fmt not in RENDERERS:
+        raise ValueError(f"formato desconhecido: {fmt}")
+    if after:
+        decode_cursor(after)
+    return RENDERERS[fmt](iter_rows(prefix, limit, after, page))
+
+
+def build(prefix: Optional[str] = None, limit: int = 100) -> str:
+    return "".join(stream(prefix, limit))
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="Gerar relatório das análises")
+    ap.add_argument("--prefix", default=None)
+    ap.add_argument("--limit", type=int, default=100)
+    ap.add_argument("--format", dest="fmt", choices=REPORT_FORMATS, default="markdown")
+    ap.add_argument("--cursor", default=None, help="Cursor devolvido pela página anterior")
+    a = ap.parse_args(argv)
+    page: Dict[str, Any] = {}
+    for piece in stream(a.prefix or None, a.limit, a.fmt, a.cursor, page):
+        sys.stdout.write(piece)
+    if page.get("next_cursor"):
+        print(f"next_cursor={page['next_cursor']}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover - CLI entry
+    sys.exit(main())
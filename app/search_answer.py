@@ -1,116 +1,104 @@
 from pathlib import Path
+import json
 import logging
 import os
-from typing import List, Dict
 
 from dotenv import load_dotenv
-from openai import OpenAI
 
+import model_router
+import prompt_builder
+import singleflight
 from search_utils import (
     embed_query,
-    expand_query,
-    retrieve_hybrid,
-    rerank_pairs,
-    apply_glossary_boost,
-    inject_notes,
+    retrieve_adaptive,
     try_cache,
     save_cache,
-    self_rag_verify,
+    verify_adaptive,
     sha,
 )
 
 load_dotenv(Path(__file__).with_name(".env"), override=True)
-GEN_MODEL = os.getenv("GEN_MODEL", "gpt-5")
 REASONING_EFFORT = os.getenv("REASONING_EFFORT", "high")
 EMBED_MODEL = os.getenv("EMBED_MODEL", "text-embedding-3-small")
 TOPK = int(os.getenv("TOPK", "12"))
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 logger = logging.getLogger("sophia.answer")
 
-PROMPT = """
-Você é um analista jurídico-regulatório. Responda usando apenas o contexto abaixo.
+# Instruções fixas primeiro (prefixo em cache); contexto e pergunta vêm depois.
+PROMPT = """Você é um analista jurídico-regulatório. Responda tecnicamente, sem inventar fatos, usando apenas o CONTEXTO.
 - Faça um resumo crítico.
 - Liste favoráveis e contrários com justificativas.
 - Compare documentos quando houver divergências/convergências.
 - Cite fontes como [#n] + caminho.
-- Se faltar base, diga o que falta.
+- Se faltar base, diga o que falta."""
 
-Pergunta: "{question}"
+def _cached(question, primary=False):
+    row = try_cache(question, primary=primary)
+    if row:
+        return row["answer"], row.get("citations") or []
+    return None
 
-Contexto:
-{contexts}
-"""
 
-def answer(question, k=TOPK, max_ctx_chars=20000, return_metadata=False):
-    qhash = sha(question)
-    row = try_cache(question)
-    if row:
-        answer_text = row["answer"]
-        citations = row.get("citations") or []
-        if return_metadata:
-            return answer_text, citations, qhash
-        print(answer_text)
-        return
-
-    variants = expand_query(question)
-    all_rows: List[Dict] = []
-    for v in variants:
-        qvec = embed_query(v, os.getenv("EMBED_MODEL", "text-embedding-3-small"))
-        if qvec is None:
-            logger.warning("Não foi possível obter embedding para a variante da consulta: %s", v)
-            continue
-        rows = retrieve_hybrid(v, qvec, k=k)
-        all_rows.extend(rows)
-    by_id = {r["id"]: r for r in all_rows}
-    rows = list(by_id.values())
-    rows = apply_glossary_boost(question, rows)
-    rows = inject_notes(rows)
-    rows = rerank_pairs(question, rows)
-
-    blocks = []
-    total = 0
-    cites = []
-    for i, r in enumerate(rows[:k], 1):
-        header = f"[#{i}] {r['path']} (chunk {r['chunk_no']})"
-        body = (r["content"] or "").replace("\n", " ").strip()
-        piece = f"{header}\n{body}\n"
-        if total + len(piece) > max_ctx_chars:
-            break
-        blocks.append(piece)
-        total += len(piece)
-        cites.append(
-            {
-                "n": i,
-                "id": r["id"],
-                "path": r["path"],
-                "chunk": r["chunk_no"],
-            }
-        )
-    contexts = "\n---\n".join(blocks)
-    if not contexts:
-        contexts = "Não localizei documentos relevantes no momento."
-    user_prompt = PROMPT.format(question=question, contexts=contexts)
+def _generate(question, qhash, k, max_ctx_chars, filters):
+    embed_model = os.getenv("EMBED_MODEL", "text-embedding-3-small")
+    qvec = embed_query(question, embed_model)
+    if qvec is None:
+        logger.warning("Não foi possível obter embedding para a consulta: %s", question)
+    rows = retrieve_adaptive(question, qvec, k=k, embed_model=embed_model, filters=filters)
+    return generate_from_rows(question, qhash, rows, k, max_ctx_chars, filters)
+
+
+def build_messages(question, rows, k=TOPK, max_ctx_chars=20000):
+    """``(msgs, blocks, cites, used)`` do prompt de ``/ask`` para os trechos ``rows``."""
+
+    blocks, cites, used = prompt_builder.select_context(rows, k, max_ctx_chars)
+    msgs = prompt_builder.messages(
+        PROMPT, blocks, f'Pergunta: "{question}"', "Não localizei documentos relevantes no momento."
+    )
+    return msgs, blocks, cites, used
+
+
+def generate_from_rows(question, qhash, rows, k=TOPK, max_ctx_chars=20000, filters=None):
+    """Gera, verifica e grava no cache a resposta para trechos já recuperados."""
+
+    msgs, blocks, cites, used = build_messages(question, rows, k, max_ctx_chars)
     try:
-        resp = client.chat.completions.create(
-            model=GEN_MODEL,
-            messages=[
-                {
-                    "role": "system",
-                    "content": "Responda tecnicamente, sem inventar fatos, e cite fontes.",
-                },
-                {"role": "user", "content": user_prompt},
-            ],
+        draft, model = model_router.complete(
+            msgs,
+            key=qhash,
+            source="ask",
+            qhash=qhash,
             temperature=0.2,
             reasoning={"effort": REASONING_EFFORT},
         )
-        draft = resp.choices[0].message.content or ""
     except Exception as exc:  # pragma: no cover - fallback defensivo
         logger.exception("Falha ao gerar resposta", exc_info=exc)
-        draft = (
-            "Não foi possível gerar uma resposta automática agora. Tente novamente em alguns instantes."
+        return (
+            "Não foi possível gerar uma resposta automática agora. Tente novamente em alguns instantes.",
+            cites,
+        )
+    final = verify_adaptive(draft, blocks, used, model, prefix=msgs)
+    if not filters:
+        save_cache(question, final, cites)
+    return final, cites
+
+
+def answer(question, k=TOPK, max_ctx_chars=20000, return_metadata=False, filters=None):
+    qhash = sha(question)
+    # Com filtros explícitos a resposta depende deles; o cache é por pergunta.
+    hit = None if filters else _cached(question)
+    if hit is None:
+        # Perguntas idênticas simultâneas esperam a primeira em vez de repetir
+        # embedding, busca e geração; entre workers, o cache gravado pelo líder
+        # é relido no primário depois que o advisory lock é liberado.
+        key = f"ask:{qhash}:{k}"
+        if filters:
+            key += ":" + sha(json.dumps(filters, sort_keys=True, ensure_ascii=False, default=str))
+        hit = singleflight.do(
+            key,
+            lambda: _generate(question, qhash, k, max_ctx_chars, filters),
+            recheck=None if filters else (lambda: _cached(question, primary=True)),
         )
-    final = self_rag_verify(draft, contexts)
-    save_cache(question, final, cites)
+    final, cites = hit
 
     if return_metadata:
         return final, cites, qhash
@@ -2,84 +2,52 @@ from pathlib import Path
 import logging
 import os
 import json
-from typing import List, Dict
 
 from dotenv import load_dotenv
-from openai import OpenAI
 
+import model_router
+import prompt_builder
 from search_utils import (
     embed_query,
-    retrieve_hybrid,
-    apply_glossary_boost,
-    inject_notes,
-    rerank_pairs,
-    self_rag_verify,
+    retrieve_adaptive,
+    verify_adaptive,
     sha,
 )
 
 load_dotenv(Path(__file__).with_name(".env"), override=True)
-GEN_MODEL = os.getenv("GEN_MODEL", "gpt-5")
 REASONING_EFFORT = os.getenv("REASONING_EFFORT", "high")
 EMBED_MODEL = os.getenv("EMBED_MODEL", "text-embedding-3-small")
 TOPK = int(os.getenv("TOPK", "12"))
 SESS_DIR = Path("/opt/rag-sophia/sessions")
 SESS_DIR.mkdir(parents=True, exist_ok=True)
-SYSTEM = "Você é um assistente analítico. Baseie-se no contexto recuperado e no histórico. Cite fontes como [#n] + caminho."
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+SYSTEM = (
+    "Você é um assistente analítico. Baseie-se no CONTEXTO recuperado e no histórico.\n"
+    "Regras:\n- Seja específico e crítico.\n- Liste prós/contras quando fizer sentido.\n"
+    "- Cite fontes como [#n] + caminho.\n- Se faltar base, diga o que falta."
+)
 logger = logging.getLogger("sophia.chat")
 
-def chat_respond(session_name: str, user_text: str):
+def chat_respond(session_name: str, user_text: str, filters=None):
     qhash = sha(user_text)
     qvec = embed_query(user_text, EMBED_MODEL)
-    rows = retrieve_hybrid(user_text, qvec, k=TOPK)
-    seen = set()
-    uniq: List[Dict] = []
-    for r in rows:
-        if r["id"] in seen:
-            continue
-        seen.add(r["id"])
-        uniq.append(r)
-    rows = apply_glossary_boost(user_text, uniq)
-    rows = inject_notes(rows)
-    rows = rerank_pairs(user_text, rows)
-    blocks = []
-    cites = []
-    total = 0
-    max_ctx = 18000
-    for i, r in enumerate(rows[:TOPK], 1):
-        header = f"[#{i}] {r['path']} (chunk {r['chunk_no']})"
-        body = (r["content"] or "").replace("\n", " ").strip()
-        piece = f"{header}\n{body}\n"
-        if total + len(piece) > max_ctx:
-            break
-        blocks.append(piece)
-        total += len(piece)
-        cites.append(
-            {
-                "n": i,
-                "id": r["id"],
-                "path": r["path"],
-                "chunk": r["chunk_no"],
-            }
-        )
-    contexts = "\n---\n".join(blocks)
-    if not contexts:
-        contexts = (
-            "Nenhum documento relevante foi encontrado para complementar a análise agora."
-        )
-    prompt = (
-        f"Pergunta: \"{user_text}\"\n\nContexto recuperado:\n{contexts}\n\n"
-        "Regras:\n- Seja específico e crítico.\n- Liste prós/contras quando fizer sentido.\n"
-        "- Cite fontes como [#n] + caminho.\n- Se faltar base, diga o que falta."
+    rows = retrieve_adaptive(user_text, qvec, k=TOPK, expand=False, filters=filters)
+    blocks, cites, used = prompt_builder.select_context(rows, TOPK, 18000)
+    msgs = prompt_builder.messages(
+        SYSTEM,
+        blocks,
+        f'Pergunta: "{user_text}"',
+        "Nenhum documento relevante foi encontrado para complementar a análise agora.",
     )
     try:
-        resp = client.chat.completions.create(
-            model=GEN_MODEL,
-            messages=[{"role": "system", "content": SYSTEM}, {"role": "user", "content": prompt}],
+        draft, model = model_router.complete(
+            msgs,
+            key=session_name,
+            source="chat",
+            qhash=qhash,
             temperature=0.2,
             reasoning={"effort": REASONING_EFFORT},
         )
-        draft = resp.choices[0].message.content or "(sem conteúdo)"
+        draft = draft or "(sem conteúdo)"
     except Exception as exc:  # pragma: no cover - fallback defensivo
         logger.exception("Falha ao gerar resposta do chat", exc_info=exc)
         return (
@@ -88,7 +56,7 @@ def chat_respond(session_name: str, user_text: str):
             qhash,
         )
 
-    final = self_rag_verify(draft, contexts)
+    final = verify_adaptive(draft, blocks, used, model, prefix=msgs)
     return final, cites, qhash
 
 if __name__ == "__main__":
@@ -6,51 +6,109 @@ import hashlib
 import json
 import logging
 import os
-from typing import Any, Dict, List, Optional, Sequence
+import re
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
 import psycopg
-from openai import OpenAI
 from psycopg.rows import dict_row
 
+import chunk_store
+import db
+import grounding
+import llm_gateway
+import model_registry
+import partitions
+import prompt_builder
+import vector_index
+
 
 logger = logging.getLogger("sophia.search")
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 DB_URL = os.getenv("DATABASE_URL")
-GEN_MODEL = os.getenv("GEN_MODEL", "gpt-5")
-EXP_MODEL = os.getenv("EXPANSION_MODEL", GEN_MODEL)
+EXP_MODEL = os.getenv("EXPANSION_MODEL")
 REASONING_EFFORT = os.getenv("REASONING_EFFORT", "high")
 TOPK = int(os.getenv("TOPK", "12"))
 EXPANSIONS = int(os.getenv("EXPANSIONS", "4"))
 RERANK_TOP = int(os.getenv("RERANK_TOP", "24"))
 SELF_RAG = os.getenv("SELF_RAG", "true").lower() == "true"
 USE_QA_CACHE = os.getenv("USE_QA_CACHE", "true").lower() == "true"
-QA_CACHE_TTL_DAYS = int(os.getenv("QA_CACHE_TTL_DAYS", "90"))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "256"))
+QA_CACHE_TTL_DAYS = int(os.getenv("QA_CACHE_TTL_DAYS", "365"))
 FEEDBACK_ALPHA = float(os.getenv("FEEDBACK_ALPHA", "0.15"))
 GLOSSARY_BOOST = float(os.getenv("GLOSSARY_BOOST", "0.2"))
 NOTES_BOOST = float(os.getenv("NOTES_BOOST", "0.35"))
 EMBED_DIM = int(os.getenv("EMBED_DIM", "1536"))
+VECTOR_INDEX = vector_index.VECTOR_INDEX
+# "adaptive" só expande, reranqueia e verifica quando a recuperação é incerta;
+# "full" executa sempre todas as etapas.
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "adaptive").lower()
+ADAPTIVE_TOPN = int(os.getenv("ADAPTIVE_TOPN", "5"))
+ADAPTIVE_MIN_TOP = float(os.getenv("ADAPTIVE_MIN_TOP", "0.35"))
+ADAPTIVE_MIN_MARGIN = float(os.getenv("ADAPTIVE_MIN_MARGIN", "0.15"))
+ADAPTIVE_MIN_AGREEMENT = float(os.getenv("ADAPTIVE_MIN_AGREEMENT", "0.4"))
+ADAPTIVE_VERIFY_MIN_SCORE = float(os.getenv("ADAPTIVE_VERIFY_MIN_SCORE", "0.3"))
+SELF_RAG_MODE = os.getenv("SELF_RAG_MODE", "hybrid").lower()  # hybrid | local | llm
+GROUNDING_ACTION = os.getenv("GROUNDING_ACTION", "flag").lower()  # flag | strip
+AUTO_FILTERS = os.getenv("AUTO_FILTERS", "false").lower() == "true"
+# pgvector >= 0.8: continua a varredura do HNSW até achar linhas que passem nos filtros.
+HNSW_ITERATIVE_SCAN = os.getenv("HNSW_ITERATIVE_SCAN", "relaxed_order")
+HNSW_MAX_SCAN_TUPLES = int(os.getenv("HNSW_MAX_SCAN_TUPLES", "20000"))
+FILTER_KEYS = ("path_prefix", "ext", "tipo", "orgao", "date_from", "date_to")
+# "staged" limita quantas linhas têm ts_rank_cd calculado (termos comuns casam
+# com centenas de milhares de trechos); "full" ranqueia todas as que casam.
+LEXICAL_ENGINE = os.getenv("LEXICAL_ENGINE", "staged").lower()
+LEXICAL_CANDIDATES = int(os.getenv("LEXICAL_CANDIDATES", "5000"))
+
+
+def lexical_cte(engine: str = LEXICAL_ENGINE, table: str = "docs", key: str = "id") -> str:
+    """CTE ``lexical`` de ``SQL_BASE`` (com ``/*FILTERS*/`` e ``%(lex_cap)s``).
+
+    No modo ``staged`` os candidatos vêm primeiro dos trechos que contêm a
+    frase (``phraseto_tsquery``, mais seletiva), completados pelos que casam
+    com todos os termos, até ``LEXICAL_CANDIDATES``; só eles são ranqueados.
+    ``table``/``key`` como em ``vector_index.vector_cte``.
+    """
+
+    if engine == "full":
+        return f"""lexical AS (
+  SELECT d.{key} AS id, ts_rank_cd(d.tsv, q.tsq) AS lscore
+  FROM {table} d, q
+  WHERE d.tsv @@ q.tsq /*FILTERS*/
+  ORDER BY lscore DESC
+  LIMIT 300
+)"""
+    return f"""phrase_cand AS MATERIALIZED (
+  SELECT d.{key} AS id, d.tsv
+  FROM {table} d, q
+  WHERE d.tsv @@ q.phq /*FILTERS*/
+  LIMIT %(lex_cap)s
+),
+lexical_cand AS MATERIALIZED (
+  SELECT id, tsv FROM phrase_cand
+  UNION ALL
+  (SELECT d.{key} AS id, d.tsv
+   FROM {table} d, q
+   WHERE d.tsv @@ q.tsq /*FILTERS*/
+     AND NOT EXISTS (SELECT 1 FROM phrase_cand p WHERE p.id = d.{key})
+   LIMIT GREATEST(%(lex_cap)s - (SELECT COUNT(*) FROM phrase_cand), 0))
+),
+lexical AS (
+  SELECT c.id, ts_rank_cd(c.tsv, q.tsq) AS lscore
+  FROM lexical_cand c, q
+  ORDER BY lscore DESC
+  LIMIT 300
+)"""
 
 
+# A consulta passa por unaccent como o texto indexado (docs_tsv_update).
 SQL_BASE = f"""
 WITH q AS (
-  SELECT websearch_to_tsquery('portuguese', %(q)s) AS tsq,
+  SELECT websearch_to_tsquery('portuguese', unaccent(%(q)s)) AS tsq,
+         phraseto_tsquery('portuguese', unaccent(%(q)s)) AS phq,
          %(qvec)s::vector({EMBED_DIM}) AS qvec
 ),
-lexical AS (
-  SELECT id, ts_rank_cd(d.tsv, q.tsq) AS lscore
-  FROM docs d, q
-  WHERE d.tsv @@ q.tsq
-  ORDER BY lscore DESC
-  LIMIT 300
-),
-vectorial AS (
-  SELECT id, 1 - (d.embedding <=> q.qvec) AS vscore
-  FROM docs d, q
-  WHERE d.embedding IS NOT NULL
-  ORDER BY d.embedding <=> q.qvec
-  LIMIT 300
-),
+{lexical_cte(LEXICAL_ENGINE)},
+{vector_index.vector_cte(VECTOR_INDEX, EMBED_DIM)},
 merged AS (
   SELECT COALESCE(l.id, v.id) AS id,
          COALESCE(l.lscore, 0) AS lscore,
@@ -59,7 +117,8 @@ merged AS (
   FULL OUTER JOIN vectorial v ON l.id = v.id
 ),
 joined AS (
-  SELECT d.id, d.path, d.chunk_no, d.title, d.meta, d.content,
+  SELECT d.id, d.path, d.chunk_no, d.chunk_hash, d.title, d.meta, d.content,
+         merged.lscore, merged.vscore,
          (0.6 * lscore + 0.4 * vscore) AS base_score
   FROM merged JOIN docs d ON d.id = merged.id
 ),
@@ -73,6 +132,113 @@ ORDER BY base_score DESC
 LIMIT %(n)s;
 """
 
+# CHUNK_STORE=chunks: busca em ``chunks`` (um registro por texto) e junta os
+# caminhos de ``docs``; o representante é o primeiro por (path, chunk_no).
+SQL_CHUNKS = f"""
+WITH q AS (
+  SELECT websearch_to_tsquery('portuguese', unaccent(%(q)s)) AS tsq,
+         phraseto_tsquery('portuguese', unaccent(%(q)s)) AS phq,
+         %(qvec)s::vector({EMBED_DIM}) AS qvec
+),
+{lexical_cte(LEXICAL_ENGINE, "chunks", "chunk_hash")},
+{vector_index.vector_cte(VECTOR_INDEX, EMBED_DIM, "chunks", "chunk_hash")},
+merged AS (
+  SELECT COALESCE(l.id, v.id) AS id,
+         COALESCE(l.lscore, 0) AS lscore,
+         COALESCE(v.vscore, 0) AS vscore
+  FROM lexical l
+  FULL OUTER JOIN vectorial v ON l.id = v.id
+),
+src AS (
+  SELECT d.chunk_hash,
+         (array_agg(d.id ORDER BY d.path, d.chunk_no))[1] AS id,
+         jsonb_agg(jsonb_build_object('id', d.id, 'path', d.path, 'chunk', d.chunk_no)
+                   ORDER BY d.path, d.chunk_no) AS sources
+  FROM merged m JOIN docs d ON d.chunk_hash = m.id
+  WHERE TRUE /*SRCFILTERS*/
+  GROUP BY d.chunk_hash
+),
+joined AS (
+  SELECT d.id, d.path, d.chunk_no, d.chunk_hash, d.title, d.meta, c.content, s.sources,
+         merged.lscore, merged.vscore,
+         (0.6 * lscore + 0.4 * vscore) AS base_score
+  FROM merged
+  JOIN src s ON s.chunk_hash = merged.id
+  JOIN chunks c ON c.chunk_hash = merged.id
+  JOIN docs d ON d.id = s.id
+)
+SELECT j.*, COALESCE(fb.fscore, 0) AS fscore
+FROM joined j
+LEFT JOIN LATERAL (
+  SELECT SUM(f.signal)::REAL AS fscore FROM feedback f
+  WHERE f.doc_id IN (SELECT (x->>'id')::bigint FROM jsonb_array_elements(j.sources) x)
+) fb ON TRUE
+ORDER BY base_score DESC
+LIMIT %(n)s;
+"""
+
+
+def filter_clause(filters: Optional[Dict[str, Any]], alias: str = "d") -> Tuple[str, Dict[str, Any]]:
+    """Traduz filtros estruturados em ``AND ...`` para as CTEs lexical e vetorial.
+
+    ``path_prefix`` e ``ext`` usam colunas de ``docs`` (``meta`` tem índice
+    GIN); ``tipo``, ``orgao`` e o intervalo ``date_from``/``date_to`` vêm de
+    ``doc_analysis`` do mesmo caminho. ``alias`` é o nome de ``docs`` na query.
+    """
+
+    f = {k: v for k, v in (filters or {}).items() if k in FILTER_KEYS and v not in (None, "")}
+    clauses: List[str] = []
+    params: Dict[str, Any] = {}
+    if f.get("path_prefix"):
+        clauses.append(f"{alias}.path LIKE %(f_path)s")
+        params["f_path"] = _escape_like(f["path_prefix"]) + "%"
+        part = partitions.prefix_partition(f["path_prefix"]) if partitions.is_partitioned() else None
+        if part:
+            # Igualdade na chave de partição permite ao planner descartar as demais.
+            clauses.append(f"{alias}.part = %(f_part)s")
+            params["f_part"] = part
+    if f.get("ext"):
+        ext = f["ext"].lower()
+        clauses.append(f"{alias}.meta @> %(f_ext)s::jsonb")
+        params["f_ext"] = json.dumps({"ext": ext if ext.startswith(".") else "." + ext})
+    da: List[str] = []
+    if f.get("tipo"):
+        da.append("da.tipo ILIKE %(f_tipo)s")
+        params["f_tipo"] = f["tipo"]
+    if f.get("orgao"):
+        da.append("da.orgao = %(f_orgao)s")
+        params["f_orgao"] = f["orgao"].upper()
+    if f.get("date_from"):
+        da.append("da.data >= %(f_from)s")
+        params["f_from"] = f["date_from"]
+    if f.get("date_to"):
+        da.append("da.data <= %(f_to)s")
+        params["f_to"] = f["date_to"]
+    if da:
+        clauses.append(
+            f"EXISTS (SELECT 1 FROM doc_analysis da WHERE da.path = {alias}.path AND " + " AND ".join(da) + ")"
+        )
+    return "".join(" AND " + c for c in clauses), params
+
+
+def _escape_like(prefix: str) -> str:
+    return prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def auto_filters(question: str) -> Dict[str, Any]:
+    """Filtros inferidos da pergunta (tipo, órgão e ano) via ``extract_meta``."""
+
+    try:
+        from analyzers.legal_extractors import extract_meta
+    except ImportError:  # pragma: no cover - analisadores não instalados
+        return {}
+    meta = extract_meta(question, {})
+    out = {k: meta[k] for k in ("tipo", "orgao") if meta.get(k)}
+    m = re.search(r"\b(?:de|em)\s+(20\d{2})\b", question) or re.search(r"/(20\d{2})\b", question)
+    if m:
+        out["date_from"], out["date_to"] = f"{m.group(1)}-01-01", f"{m.group(1)}-12-31"
+    return out
+
 
 def sha(text: str) -> str:
     return hashlib.sha256(text.encode("utf-8", errors="ignore")).hexdigest()
@@ -82,12 +248,32 @@ def embed_query(q: str, embed_model: str) -> Optional[List[float]]:
     """Retorna embedding para a consulta ou ``None`` em caso de falha."""
 
     try:
-        return client.embeddings.create(model=embed_model, input=q).data[0].embedding
+        return (
+            llm_gateway.embed("search.embed", model=embed_model, input=q, **vector_index.embed_kwargs())
+            .data[0]
+            .embedding
+        )
     except Exception as exc:  # pragma: no cover - fallback defensivo
         logger.exception("Falha ao gerar embedding para a consulta", exc_info=exc)
         return None
 
 
+def embed_many(texts: Sequence[str], embed_model: str) -> List[Optional[List[float]]]:
+    """Embeddings de vários textos em poucas chamadas (lotes de ``EMBED_BATCH_SIZE``)."""
+
+    out: List[Optional[List[float]]] = []
+    step = max(1, EMBED_BATCH_SIZE)
+    for start in range(0, len(texts), step):
+        chunk = list(texts[start : start + step])
+        try:
+            resp = llm_gateway.embed("search.embed", model=embed_model, input=chunk, **vector_index.embed_kwargs())
+            out.extend(d.embedding for d in sorted(resp.data, key=lambda d: d.index))
+        except Exception as exc:  # pragma: no cover - fallback defensivo
+            logger.exception("Falha ao gerar embeddings em lote", exc_info=exc)
+            out.extend([None] * len(chunk))
+    return out
+
+
 def expand_query(q: str) -> List[str]:
     """Expande a consulta com variações, mantendo sempre o texto original."""
 
@@ -100,8 +286,9 @@ def expand_query(q: str) -> List[str]:
     )
 
     try:
-        r = client.chat.completions.create(
-            model=EXP_MODEL,
+        r = llm_gateway.chat(
+            "search.expand",
+            model=EXP_MODEL or model_registry.gen_model(),
             messages=[{"role": "user", "content": prompt}],
             temperature=0.3,
         )
@@ -144,7 +331,9 @@ def rerank_pairs(question: str, items: List[Dict[str, Any]]) -> List[Dict[str, A
     ]
 
     try:
-        r = client.chat.completions.create(model=EXP_MODEL, messages=msgs, temperature=0)
+        r = llm_gateway.chat(
+            "search.rerank", model=EXP_MODEL or model_registry.gen_model(), messages=msgs, temperature=0
+        )
         raw = r.choices[0].message.content or "[]"
     except Exception as exc:  # pragma: no cover - fallback defensivo
         logger.exception("Falha ao reordenar trechos; mantendo ordem original", exc_info=exc)
@@ -175,16 +364,231 @@ def rerank_pairs(question: str, items: List[Dict[str, Any]]) -> List[Dict[str, A
     return items
 
 
-def apply_glossary_boost(question: str, rows: List[Dict[str, Any]]):
-    if GLOSSARY_BOOST <= 0:
-        return rows
+def sort_by_score(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Ordena como ``rerank_pairs``, mas sem a nota do LLM."""
 
+    for it in items:
+        it["final_score"] = (
+            it.get("base_score", 0)
+            + FEEDBACK_ALPHA * it.get("fscore", 0)
+            + (it.get("rerank", 0) / 10.0)
+        )
+    items.sort(key=lambda x: x["final_score"], reverse=True)
+    return items
+
+
+def retrieval_confidence(rows: List[Dict[str, Any]], n: int = ADAPTIVE_TOPN) -> Dict[str, Any]:
+    """Mede se a recuperação já é confiável o bastante para pular etapas.
+
+    Usa a nota do primeiro trecho, a margem relativa entre o primeiro e o
+    ``n``-ésimo e a concordância entre os ``n`` melhores pela busca lexical e
+    pela vetorial.
+    """
+
+    if not rows:
+        return {"confident": False, "top": 0.0, "margin": 0.0, "agreement": 0.0}
+    ranked = sorted(rows, key=lambda r: r.get("base_score", 0), reverse=True)
+    top = float(ranked[0].get("base_score") or 0)
+    tail = float(ranked[min(n, len(ranked)) - 1].get("base_score") or 0)
+    margin = (top - tail) / top if top > 0 else 0.0
+    by_lex = {r["id"] for r in sorted(rows, key=lambda r: r.get("lscore") or 0, reverse=True)[:n] if r.get("lscore")}
+    by_vec = {r["id"] for r in sorted(rows, key=lambda r: r.get("vscore") or 0, reverse=True)[:n] if r.get("vscore")}
+    agreement = len(by_lex & by_vec) / n if n else 0.0
+    confident = (
+        top >= ADAPTIVE_MIN_TOP
+        and (margin >= ADAPTIVE_MIN_MARGIN or agreement >= ADAPTIVE_MIN_AGREEMENT)
+    )
+    return {
+        "confident": confident,
+        "top": round(top, 4),
+        "margin": round(margin, 4),
+        "agreement": round(agreement, 4),
+    }
+
+
+def log_decision(stage: str, **info: Any) -> None:
+    logger.info("pipeline %s %s", stage, json.dumps(info, ensure_ascii=False, default=str))
+
+
+def first_pass(
+    question: str,
+    qvec: Optional[Sequence[float]],
+    k: int = TOPK,
+    expand: bool = True,
+    filters: Optional[Dict[str, Any]] = None,
+) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, Any]], Dict[str, bool]]:
+    """Primeira busca de ``retrieve_adaptive``: ``(trechos, filtros, plano)``.
+
+    ``plano`` diz se a pergunta ainda precisa de expansão e rerank, conforme
+    a confiança da busca e ``PIPELINE_MODE``.
+    """
+
+    auto = not filters and AUTO_FILTERS
+    if auto:
+        filters = auto_filters(question)
+    rows = retrieve_hybrid(question, qvec, k=k, filters=filters)
+    if auto and filters and not rows:
+        log_decision("filters", action="drop_auto", filters=filters)
+        filters = None
+        rows = retrieve_hybrid(question, qvec, k=k)
+    if filters:
+        log_decision("filters", qhash=sha(question)[:12], auto=auto, filters=filters)
+    conf = retrieval_confidence(rows)
+    adaptive = PIPELINE_MODE == "adaptive"
+    plan = {
+        "expand": expand and not (adaptive and conf["confident"]),
+        "rerank": not (adaptive and conf["confident"]),
+    }
+    log_decision(
+        "retrieval", qhash=sha(question)[:12], mode=PIPELINE_MODE, expand=plan["expand"], rerank=plan["rerank"], **conf
+    )
+    return rows, filters, plan
+
+
+def finish_retrieval(
+    question: str,
+    rows: List[Dict[str, Any]],
+    plan: Dict[str, bool],
+    k: int = TOPK,
+    filters: Optional[Dict[str, Any]] = None,
+    variants: Sequence[Tuple[str, Optional[Sequence[float]]]] = (),
+    glossary: Optional[List[Dict[str, Any]]] = None,
+    notes: Optional[List[Dict[str, Any]]] = None,
+) -> List[Dict[str, Any]]:
+    """Completa a busca de ``first_pass`` com as variantes ``(texto, embedding)`` já calculadas."""
+
+    if plan["expand"]:
+        for v, vvec in variants:
+            if vvec is None:
+                logger.warning("Não foi possível obter embedding para a variante da consulta: %s", v)
+                continue
+            rows.extend(retrieve_hybrid(v, vvec, k=k, filters=filters))
+        rows = list({r["chunk_hash"]: r for r in rows}.values())
+
+    rows = apply_glossary_boost(question, rows, glossary)
+    rows = inject_notes(rows, notes)
+    return rerank_pairs(question, rows) if plan["rerank"] else sort_by_score(rows)
+
+
+def retrieve_adaptive(
+    question: str,
+    qvec: Optional[Sequence[float]],
+    k: int = TOPK,
+    embed_model: Optional[str] = None,
+    expand: bool = True,
+    filters: Optional[Dict[str, Any]] = None,
+    glossary: Optional[List[Dict[str, Any]]] = None,
+    notes: Optional[List[Dict[str, Any]]] = None,
+) -> List[Dict[str, Any]]:
+    """Busca única; expande e reranqueia só se a confiança for baixa.
+
+    Devolve os trechos já com glossário, notas e ordenação aplicados. Com
+    ``PIPELINE_MODE=full`` executa sempre expansão (se ``expand``) e rerank.
+    Sem ``filters`` explícitos e com ``AUTO_FILTERS``, os filtros inferidos da
+    pergunta são aplicados e descartados se nada for encontrado. ``glossary``
+    e ``notes`` já carregados (``load_glossary``/``load_notes``) evitam as
+    consultas por pergunta em lotes; para expandir várias perguntas com um
+    só lote de embeddings, use ``first_pass`` e ``finish_retrieval``.
+    """
+
+    rows, filters, plan = first_pass(question, qvec, k=k, expand=expand, filters=filters)
+    variants: List[Tuple[str, Optional[List[float]]]] = []
+    if plan["expand"]:
+        model = embed_model or os.getenv("EMBED_MODEL", "text-embedding-3-small")
+        texts = expand_query(question)[1:]
+        variants = list(zip(texts, embed_many(texts, model)))
+    return finish_retrieval(question, rows, plan, k, filters, variants, glossary, notes)
+
+
+def cited_numbers(draft: str) -> List[int]:
+    return sorted({int(n) for n in re.findall(r"\[#(\d+)\]", draft or "")})
+
+
+def verify_adaptive(
+    draft: str,
+    blocks: Sequence[str],
+    used: Sequence[Dict[str, Any]],
+    model: Optional[str] = None,
+    prefix: Optional[Sequence[Dict[str, str]]] = None,
+) -> str:
+    """Self-RAG só quando necessário, e apenas sobre os trechos citados.
+
+    ``blocks``/``used`` são os trechos numerados ``[#1]..[#n]`` do prompt.
+    Se todas as citações apontam para trechos bem pontuados, a verificação é
+    pulada; caso contrário, o verificador recebe só os blocos citados (ou o
+    contexto inteiro, quando não há citações). Com ``prefix`` (as mensagens da
+    geração), a verificação continua a mesma conversa para reaproveitar o
+    cache de prompt e apenas indica os blocos citados a conferir.
+
+    Antes do LLM, ``grounding`` confere localmente o apoio de cada frase ao
+    bloco citado (``SELF_RAG_MODE=hybrid``): sem frases fracas não há chamada;
+    com elas, o verificador recebe só essas frases. ``SELF_RAG_MODE=local``
+    nunca chama o LLM e marca (ou remove, ``GROUNDING_ACTION=strip``) as frases
+    sem apoio. A conferência local vale nos dois ``PIPELINE_MODE``; só o
+    atalho das citações fortes e o recorte pelos blocos citados dependem do
+    modo adaptativo.
+    """
+
+    if not SELF_RAG:
+        return draft
+    contexts = "\n---\n".join(blocks)
+    adaptive = PIPELINE_MODE == "adaptive"
+    cited = [n for n in cited_numbers(draft) if 1 <= n <= len(used)]
+    strong = [n for n in cited if (used[n - 1].get("base_score") or 0) >= ADAPTIVE_VERIFY_MIN_SCORE]
+    if adaptive and cited and len(strong) == len(cited):
+        log_decision("verify", action="skip", cited=cited)
+        return draft
+    if SELF_RAG_MODE != "llm" and blocks:
+        report = grounding.check(draft, blocks)
+        weak = grounding.weak(report)
+        if not weak:
+            log_decision("verify", action="local_ok", sentences=len(report))
+            return draft
+        if SELF_RAG_MODE == "local":
+            log_decision("verify", action=f"local_{GROUNDING_ACTION}", sentences=len(report), weak=len(weak))
+            return grounding.apply(draft, report, GROUNDING_ACTION)
+        focus = sorted({n for w in weak for n in (w["cited"] or [w["block"]]) if n})
+        log_decision("verify", action="local_weak", sentences=len(report), weak=len(weak), cited=focus)
+        return self_rag_verify(
+            draft,
+            "\n---\n".join(blocks[n - 1] for n in focus) or contexts,
+            model,
+            prefix=prefix,
+            focus=focus,
+            claims=[w["text"] for w in weak],
+        )
+    if not adaptive:
+        return self_rag_verify(draft, contexts, model, prefix=prefix)
+    if cited:
+        log_decision("verify", action="cited_only", cited=cited, weak=sorted(set(cited) - set(strong)))
+        return self_rag_verify(
+            draft, "\n---\n".join(blocks[n - 1] for n in cited), model, prefix=prefix, focus=cited
+        )
+    log_decision("verify", action="full", cited=[])
+    return self_rag_verify(draft, contexts, model, prefix=prefix)
+
+
+def load_glossary() -> Optional[List[Dict[str, Any]]]:
+    if GLOSSARY_BOOST <= 0:
+        return []
     try:
-        with psycopg.connect(DB_URL) as conn, conn.cursor(row_factory=dict_row) as cur:
+        with db.connect(readonly=True) as conn, conn.cursor(row_factory=dict_row) as cur:
             cur.execute("SELECT term, weight FROM glossary")
-            terms = cur.fetchall()
+            return cur.fetchall()
     except psycopg.Error as exc:  # pragma: no cover - fallback defensivo
         logger.warning("Não foi possível aplicar reforço do glossário: %s", exc)
+        return None
+
+
+def apply_glossary_boost(
+    question: str, rows: List[Dict[str, Any]], terms: Optional[List[Dict[str, Any]]] = None
+):
+    if GLOSSARY_BOOST <= 0:
+        return rows
+
+    if terms is None:
+        terms = load_glossary()
+    if not terms:
         return rows
 
     ql = question.lower()
@@ -200,16 +604,25 @@ def apply_glossary_boost(question: str, rows: List[Dict[str, Any]]):
     return rows
 
 
-def inject_notes(rows: List[Dict[str, Any]]):
+def load_notes() -> Optional[List[Dict[str, Any]]]:
     if NOTES_BOOST <= 0:
-        return rows
-
+        return []
     try:
-        with psycopg.connect(DB_URL) as conn, conn.cursor(row_factory=dict_row) as cur:
+        with db.connect(readonly=True) as conn, conn.cursor(row_factory=dict_row) as cur:
             cur.execute("SELECT id, text FROM notes ORDER BY created_at DESC LIMIT 50;")
-            ns = cur.fetchall()
+            return cur.fetchall()
     except psycopg.Error as exc:  # pragma: no cover - fallback defensivo
         logger.warning("Não foi possível recuperar notas adicionais: %s", exc)
+        return None
+
+
+def inject_notes(rows: List[Dict[str, Any]], ns: Optional[List[Dict[str, Any]]] = None):
+    if NOTES_BOOST <= 0:
+        return rows
+
+    if ns is None:
+        ns = load_notes()
+    if not ns:
         return rows
 
     for n in ns:
@@ -228,16 +641,18 @@ def inject_notes(rows: List[Dict[str, Any]]):
     return rows
 
 
-def try_cache(question: str):
+def try_cache(question: str, primary: bool = False):
+    """Resposta em cache; ``primary`` evita o atraso das réplicas logo após uma gravação."""
+
     if not USE_QA_CACHE:
         return None
 
     try:
-        with psycopg.connect(DB_URL) as conn, conn.cursor(row_factory=dict_row) as cur:
+        with db.connect(readonly=not primary) as conn, conn.cursor(row_factory=dict_row) as cur:
             cur.execute(
                 """SELECT answer, citations, created_at FROM qa_cache
-                       WHERE qhash=%s AND created_at >= now() - interval '%s days'""",
-                (sha(question), os.getenv("QA_CACHE_TTL_DAYS", "90")),
+                       WHERE qhash=%s AND created_at >= now() - make_interval(days => %s)""",
+                (sha(question), QA_CACHE_TTL_DAYS),
             )
             return cur.fetchone()
     except psycopg.Error as exc:  # pragma: no cover - fallback defensivo
@@ -245,10 +660,44 @@ def try_cache(question: str):
         return None
 
 
+def try_cache_many(questions: Sequence[str]) -> Dict[str, Dict[str, Any]]:
+    """Entradas válidas do cache para várias perguntas de uma vez, por ``qhash``."""
+
+    if not USE_QA_CACHE or not questions:
+        return {}
+    try:
+        with db.connect(readonly=True) as conn, conn.cursor(row_factory=dict_row) as cur:
+            cur.execute(
+                """SELECT qhash, answer, citations, created_at FROM qa_cache
+                       WHERE qhash = ANY(%s) AND created_at >= now() - make_interval(days => %s)""",
+                ([sha(q) for q in questions], QA_CACHE_TTL_DAYS),
+            )
+            return {r["qhash"]: r for r in cur.fetchall()}
+    except psycopg.Error as exc:  # pragma: no cover - fallback defensivo
+        logger.warning("Não foi possível consultar cache de QA: %s", exc)
+        return {}
+
+
 def save_cache(question: str, answer: str, citations: List[Dict[str, Any]]):
-    if not USE_QA_CACHE:
+    """Grava a resposta e os trechos citados (``qa_cache_deps``).
+
+    A ingestão invalida a entrada quando um trecho citado muda de
+    ``chunk_hash`` ou é removido (gatilhos de ``initdb/011_qa_cache_deps.sql``),
+    o que permite um ``QA_CACHE_TTL_DAYS`` longo. Respostas sem citações não
+    são gravadas: nada as invalidaria quando novos documentos chegassem.
+    """
+
+    if not USE_QA_CACHE or not citations:
         return
 
+    qhash = sha(question)
+    # Cópias do mesmo texto (``sources``) também são dependências: os caminhos citados mudam.
+    deps = [
+        (qhash, src["id"], c["chunk_hash"])
+        for c in citations
+        if c.get("chunk_hash")
+        for src in (c.get("sources") or [c])
+    ]
     try:
         with psycopg.connect(DB_URL) as conn, conn.cursor() as cur:
             cur.execute(
@@ -257,30 +706,57 @@ def save_cache(question: str, answer: str, citations: List[Dict[str, Any]]):
                        ON CONFLICT (qhash) DO UPDATE SET
                          question=EXCLUDED.question, answer=EXCLUDED.answer,
                          citations=EXCLUDED.citations, created_at=now()""",
-                (sha(question), question, answer, psycopg.types.json.Json(citations)),
+                (qhash, question, answer, psycopg.types.json.Json(citations)),
+            )
+            cur.execute("DELETE FROM qa_cache_deps WHERE qhash=%s", (qhash,))
+            cur.executemany(
+                "INSERT INTO qa_cache_deps(qhash,doc_id,chunk_hash) VALUES(%s,%s,%s) ON CONFLICT DO NOTHING",
+                deps,
+            )
+            # Um trecho citado pode ter mudado entre a busca e a gravação.
+            cur.execute(
+                """SELECT 1 FROM qa_cache_deps x LEFT JOIN docs d ON d.id = x.doc_id
+                    WHERE x.qhash=%s AND d.chunk_hash IS DISTINCT FROM x.chunk_hash LIMIT 1""",
+                (qhash,),
             )
+            if cur.fetchone():
+                cur.execute("DELETE FROM qa_cache WHERE qhash=%s", (qhash,))
             conn.commit()
     except psycopg.Error as exc:  # pragma: no cover - fallback defensivo
         logger.warning("Não foi possível salvar resposta em cache: %s", exc)
 
 
-def self_rag_verify(draft: str, contexts: str) -> str:
+def self_rag_verify(
+    draft: str,
+    contexts: str,
+    model: Optional[str] = None,
+    prefix: Optional[Sequence[Dict[str, str]]] = None,
+    focus: Optional[Sequence[int]] = None,
+    claims: Optional[Sequence[str]] = None,
+) -> str:
+    """Revisa ``draft`` contra o contexto.
+
+    Com ``prefix`` (mensagens da geração, que já trazem o contexto) a revisão é
+    pedida na mesma conversa e ``contexts`` é ignorado.
+    """
+
     if os.getenv("SELF_RAG", "true").lower() != "true":
         return draft
 
-    prompt = (
-        "Revise a resposta abaixo, mantendo apenas afirmações suportadas pelo CONTEXTO.\n"
-        "Se algo não estiver claramente suportado, remova ou marque como incerto. Mantenha as citações [#n].\n"
-        f"RESPOSTA:\n{draft}\n\nCONTEXTO:\n{contexts}"
-    )
+    if prefix:
+        messages = prompt_builder.verify_messages(prefix, draft, focus, claims)
+    else:
+        instr = prompt_builder.verify_instructions(None, claims)
+        messages = [
+            {"role": "system", "content": "Você é um verificador factual rigoroso."},
+            {"role": "user", "content": f"CONTEXTO:\n{contexts}\n\n{instr}\n\nRESPOSTA:\n{draft}"},
+        ]
 
     try:
-        r = client.chat.completions.create(
-            model=GEN_MODEL,
-            messages=[
-                {"role": "system", "content": "Você é um verificador factual rigoroso."},
-                {"role": "user", "content": prompt},
-            ],
+        r = llm_gateway.chat(
+            "search.self_rag",
+            model=model or model_registry.gen_model(),
+            messages=messages,
             temperature=0.0,
         )
         return r.choices[0].message.content or draft
@@ -289,24 +765,70 @@ def self_rag_verify(draft: str, contexts: str) -> str:
         return draft
 
 
+def collapse_duplicates(rows: Sequence[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Um resultado por ``chunk_hash``; os caminhos das cópias vão para ``sources``.
+
+    Com ``CHUNK_STORE=chunks`` a própria query já agrupa e as linhas passam
+    direto; no layout ``docs`` a primeira cópia (maior nota) representa as demais.
+    """
+
+    out: List[Dict[str, Any]] = []
+    by_hash: Dict[str, Dict[str, Any]] = {}
+    for r in rows:
+        if r.get("sources") is not None:
+            out.append(r)
+            continue
+        src = {"id": r["id"], "path": r["path"], "chunk": r["chunk_no"]}
+        first = by_hash.get(r["chunk_hash"])
+        if first is None:
+            r = {**r, "sources": [src]}
+            by_hash[r["chunk_hash"]] = r
+            out.append(r)
+        else:
+            first["sources"].append(src)
+            first["fscore"] = (first.get("fscore") or 0) + (r.get("fscore") or 0)
+    return out
+
+
 def retrieve_hybrid(
-    question: str, qvec: Optional[Sequence[float]], k: int = TOPK
+    question: str,
+    qvec: Optional[Sequence[float]],
+    k: int = TOPK,
+    filters: Optional[Dict[str, Any]] = None,
 ) -> List[Dict[str, Any]]:
     if qvec is None:
         return []
 
+    where, fparams = filter_clause(filters)
+    if chunk_store.enabled():
+        cand, _ = filter_clause(filters, alias="x")
+        if cand:
+            cand = f" AND EXISTS (SELECT 1 FROM docs x WHERE x.chunk_hash = d.chunk_hash{cand})"
+        sql = SQL_CHUNKS.replace("/*FILTERS*/", cand).replace("/*SRCFILTERS*/", where)
+    else:
+        sql = SQL_BASE.replace("/*FILTERS*/", where)
     try:
-        with psycopg.connect(DB_URL) as conn, conn.cursor(row_factory=dict_row) as cur:
-            cur.execute("SET hnsw.ef_search=100;")
+        with db.connect(readonly=True) as conn, conn.cursor(row_factory=dict_row) as cur:
+            cur.execute(f"SET hnsw.ef_search={vector_index.ef_search(VECTOR_INDEX)};")
+            if where and HNSW_ITERATIVE_SCAN != "off":
+                try:
+                    with conn.transaction():
+                        cur.execute(f"SET hnsw.iterative_scan={HNSW_ITERATIVE_SCAN};")
+                        cur.execute(f"SET hnsw.max_scan_tuples={HNSW_MAX_SCAN_TUPLES};")
+                except psycopg.Error as exc:  # pragma: no cover - pgvector < 0.8
+                    logger.debug("Varredura iterativa do HNSW indisponível: %s", exc)
             cur.execute(
-                SQL_BASE,
+                sql,
                 {
                     "q": question,
                     "qvec": qvec,
                     "n": max(k * 3, int(os.getenv("RERANK_TOP", "24"))),
+                    "coarse": vector_index.RESCORE_CANDIDATES,
+                    "lex_cap": LEXICAL_CANDIDATES,
+                    **fparams,
                 },
             )
-            return cur.fetchall()
+            return collapse_duplicates(cur.fetchall())
     except psycopg.Error as exc:  # pragma: no cover - fallback defensivo
         logger.exception("Erro ao executar busca híbrida", exc_info=exc)
         return []
@@ -0,0 +1,93 @@
+"""Coalescência de chamadas idênticas em andamento ("single-flight").
+
+Dentro de um processo, chamadas concorrentes com a mesma chave esperam o
+``Future`` da primeira. Entre workers, o líder segura um advisory lock do
+Postgres derivado da chave enquanto calcula; os demais esperam o lock (até
+``SINGLEFLIGHT_WAIT_SECONDS``) e então consultam ``recheck`` — tipicamente o
+cache de QA que o líder acabou de gravar — antes de calcular por conta própria.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional, TypeVar
+
+import psycopg
+
+DB_URL = os.getenv("DATABASE_URL")
+SINGLEFLIGHT = os.getenv("SINGLEFLIGHT", "true").lower() == "true"
+WAIT_SECONDS = int(os.getenv("SINGLEFLIGHT_WAIT_SECONDS", "120"))
+logger = logging.getLogger("sophia.singleflight")
+
+T = TypeVar("T")
+
+_lock = threading.Lock()
+_flights: Dict[str, Future] = {}
+
+
+def _lock_conn(key: str, recheck: Callable[[], Optional[T]]):
+    """Adquire o advisory lock de ``key``; devolve ``(conexão, resultado_de_recheck)``."""
+
+    try:
+        conn = psycopg.connect(DB_URL, autocommit=True)
+    except psycopg.Error as exc:  # pragma: no cover - segue sem coordenação
+        logger.warning("Single-flight sem advisory lock: %s", exc)
+        return None, None
+    try:
+        got = conn.execute("SELECT pg_try_advisory_lock(hashtextextended(%s, 0))", (key,)).fetchone()[0]
+        if got:
+            return conn, None
+        logger.info("Aguardando cálculo em outro worker: %s", key)
+        conn.execute(f"SET lock_timeout = '{WAIT_SECONDS}s'")
+        try:
+            conn.execute("SELECT pg_advisory_lock(hashtextextended(%s, 0))", (key,))
+        except psycopg.errors.LockNotAvailable:
+            logger.warning("Tempo de espera esgotado para %s; calculando localmente", key)
+            return conn, None
+        return conn, recheck()
+    except psycopg.Error as exc:  # pragma: no cover - segue sem coordenação
+        logger.warning("Falha no advisory lock de %s: %s", key, exc)
+        conn.close()
+        return None, None
+
+
+def _run(key: str, fn: Callable[[], T], recheck: Optional[Callable[[], Optional[T]]]) -> T:
+    if recheck is None:
+        return fn()
+    conn, cached = _lock_conn(key, recheck)
+    try:
+        return cached if cached is not None else fn()
+    finally:
+        if conn is not None:
+            conn.close()  # encerra a sessão e libera o advisory lock
+
+
+def do(key: str, fn: Callable[[], T], recheck: Optional[Callable[[], Optional[T]]] = None) -> T:
+    """Executa ``fn`` uma única vez por ``key`` entre chamadas simultâneas.
+
+    ``recheck`` habilita a coordenação entre workers e deve devolver o
+    resultado já persistido pelo líder (ou ``None``).
+    """
+
+    if not SINGLEFLIGHT:
+        return fn()
+    with _lock:
+        fut = _flights.get(key)
+        leader = fut is None
+        if leader:
+            fut = _flights[key] = Future()
+    if not leader:
+        return fut.result()
+    try:
+        result = _run(key, fn, recheck)
+        fut.set_result(result)
+        return result
+    except BaseException as exc:
+        fut.set_exception(exc)
+        raise
+    finally:
+        with _lock:
+            _flights.pop(key, None)
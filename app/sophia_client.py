@@ -0,0 +1,196 @@
+"""Cliente leve de linha de comando para ``/ask`` e ``/chat``.
+
+Usa só a biblioteca padrão e conversa com o serviço FastAPI já em execução
+por uma conexão HTTP mantida aberta entre as perguntas, então cada turno não
+paga a importação de openai/psycopg nem a criação de clientes. Se a API não
+estiver acessível, responde no próprio processo (``search_answer`` e
+``search_chat`` são importados só nesse caso, uma única vez).
+
+Exemplos::
+
+    python app/sophia_client.py ask "Quais entendimentos sobre [tema]?"
+    python app/sophia_client.py chat --session s1          # uma pergunta por linha
+    python app/sophia_client.py chat --session s1 --json   # uma linha JSON por resposta
+
+A URL vem de ``--api``, ``API_URL`` ou ``API_PORT`` (ambiente ou ``app/.env``).
+"""
+
+from __future__ import annotations
+
+import argparse
+import http.client
+import json
+import os
+import sys
+from pathlib import Path
+from typing import Any, Dict, Optional
+from urllib.parse import urlsplit
+
+ENV_FILE = Path(__file__).with_name(".env")
+TIMEOUT = float(os.getenv("SOPHIA_CLIENT_TIMEOUT", "600"))
+
+
+def _env_file() -> Dict[str, str]:
+    out: Dict[str, str] = {}
+    try:
+        lines = ENV_FILE.read_text(encoding="utf-8").splitlines()
+    except OSError:
+        return out
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith("#") and "=" in line:
+            k, v = line.split("=", 1)
+            out[k.strip()] = v.strip().strip("'\"")
+    return out
+
+
+def default_api_url() -> str:
+    env = {**_env_file(), **os.environ}
+    if env.get("API_URL"):
+        return env["API_URL"].rstrip("/")
+    return f"http://127.0.0.1:{env.get('API_PORT') or '18888'}"
+
+
+class ApiUnavailable(Exception):
+    """A API não aceitou a conexão."""
+
+
+class ApiClient:
+    """Conexão HTTP persistente com o serviço; reconecta se o servidor a fechar."""
+
+    def __init__(self, url: str, timeout: float = TIMEOUT):
+        parts = urlsplit(url)
+        cls = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        self.prefix = parts.path.rstrip("/")
+        self.conn = cls(parts.hostname or "127.0.0.1", parts.port, timeout=timeout)
+
+    def post(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+        for attempt in (1, 2):
+            if self.conn.sock is None:
+                try:
+                    self.conn.connect()
+                except OSError as exc:
+                    raise ApiUnavailable(str(exc)) from exc
+            try:
+                self.conn.request("POST", self.prefix + path, body=body, headers=headers)
+                resp = self.conn.getresponse()
+                data = resp.read()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # O servidor encerra conexões ociosas (keep-alive do uvicorn).
+                self.conn.close()
+                if attempt == 2:
+                    raise
+        if resp.status >= 400:
+            try:
+                detail = json.loads(data).get("detail")
+            except ValueError:
+                detail = data.decode("utf-8", "replace")[:500]
+            raise RuntimeError(f"HTTP {resp.status}: {detail}")
+        return json.loads(data)
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+class Sophia:
+    """Responde pela API e, se ela estiver fora, no próprio processo."""
+
+    def __init__(self, api_url: Optional[str], local: bool = False):
+        self.api = None if local else ApiClient(api_url or default_api_url())
+        self._answer = None
+        self._chat = None
+
+    def _load_local(self) -> None:
+        if self._answer is not None:
+            return
+        app_dir = str(Path(__file__).parent)
+        if app_dir not in sys.path:
+            sys.path.insert(0, app_dir)
+        from dotenv import load_dotenv
+
+        load_dotenv(ENV_FILE, override=True)
+        from search_answer import answer
+        from search_chat import chat_respond
+
+        self._answer, self._chat = answer, chat_respond
+
+    def _fallback(self, exc: Exception) -> None:
+        print(f"API indisponível ({exc}); respondendo localmente.", file=sys.stderr)
+        self.api = None
+
+    def ask(self, question: str, top_k: Optional[int] = None) -> Dict[str, Any]:
+        if self.api is not None:
+            try:
+                return self.api.post("/ask", {"question": question, "top_k": top_k})
+            except ApiUnavailable as exc:
+                self._fallback(exc)
+        self._load_local()
+        kwargs = {"k": top_k} if top_k else {}
+        ans, cites, qhash = self._answer(question, return_metadata=True, **kwargs)
+        return {"answer": ans, "citations": cites, "query_hash": qhash}
+
+    def chat(self, session: str, message: str) -> Dict[str, Any]:
+        if self.api is not None:
+            try:
+                return self.api.post("/chat", {"session": session, "message": message})
+            except ApiUnavailable as exc:
+                self._fallback(exc)
+        self._load_local()
+        ans, cites, qhash = self._chat(session, message)
+        return {"answer": ans, "citations": cites, "query_hash": qhash}
+
+
+def _emit(result: Dict[str, Any], as_json: bool) -> None:
+    if as_json:
+        print(json.dumps(result, ensure_ascii=False), flush=True)
+    else:
+        print(result.get("answer") or result.get("error") or "", flush=True)
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="Cliente do Sophia (API com fallback local)")
+    ap.add_argument("--api", help="URL da API (padrão: API_URL/API_PORT)")
+    ap.add_argument("--local", action="store_true", help="Não usar a API; responder no processo")
+    ap.add_argument("--json", action="store_true", help="Saída JSON (uma linha por resposta)")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    a = sub.add_parser("ask", help="Pergunta avulsa (/ask)")
+    a.add_argument("--top-k", type=int)
+    a.add_argument("question", nargs="*")
+    c = sub.add_parser("chat", help="Conversa com sessão (/chat); sem texto, lê uma pergunta por linha")
+    c.add_argument("--session", required=True)
+    c.add_argument("message", nargs="*")
+    args = ap.parse_args(argv)
+
+    sophia = Sophia(args.api, local=args.local)
+
+    def turn(text: str) -> Dict[str, Any]:
+        if args.cmd == "ask":
+            return sophia.ask(text, args.top_k)
+        return sophia.chat(args.session, text)
+
+    text = " ".join(args.question if args.cmd == "ask" else args.message).strip()
+    if text:
+        try:
+            _emit(turn(text), args.json)
+        except Exception as exc:
+            _emit({"error": str(exc)}, args.json)
+            return 1
+        return 0
+
+    # Modo residente: uma pergunta por linha, mesma conexão (ou mesmo processo).
+    for line in sys.stdin:
+        text = line.strip()
+        if not text:
+            continue
+        try:
+            _emit(turn(text), args.json)
+        except Exception as exc:  # segue atendendo as próximas linhas
+            _emit({"error": str(exc)}, args.json)
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover - CLI entry
+    sys.exit(main())
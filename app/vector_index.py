@@ -0,0 +1,176 @@
+"""Índice vetorial de ``docs.embedding`` e busca com re-pontuação.
+
+``VECTOR_INDEX`` escolhe o que o HNSW indexa:
+
+- ``vector``: o próprio ``embedding`` (float32, comportamento original);
+- ``halfvec``: a expressão ``embedding::halfvec(EMBED_DIM)`` (metade do tamanho);
+- ``binary``: ``binary_quantize(embedding)::bit(EMBED_DIM)`` (1 bit por dimensão).
+
+Nos modos compactos a busca grossa percorre o índice compacto e só os
+``VECTOR_RESCORE_CANDIDATES`` primeiros são re-pontuados com o vetor completo.
+``EMBED_DIMENSIONS`` pede embeddings reduzidos (parâmetro ``dimensions`` da
+família text-embedding-3) e deve ser igual a ``EMBED_DIM``.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+from typing import Any, Dict
+
+import psycopg
+from dotenv import load_dotenv
+
+load_dotenv(Path(__file__).with_name(".env"), override=True)
+DB_URL = os.getenv("DATABASE_URL")
+EMBED_DIM = int(os.getenv("EMBED_DIM", "1536"))
+EMBED_DIMENSIONS = int(os.getenv("EMBED_DIMENSIONS", "0"))
+VECTOR_INDEX = os.getenv("VECTOR_INDEX", "vector").lower()
+VECTOR_INDEX_MODES = ("vector", "halfvec", "binary")
+RESCORE_CANDIDATES = int(os.getenv("VECTOR_RESCORE_CANDIDATES", "600"))
+
+INDEX_NAMES = {
+    "vector": "docs_embedding_hnsw",
+    "halfvec": "docs_embedding_half_hnsw",
+    "binary": "docs_embedding_bin_hnsw",
+}
+
+
+def _check(mode: str) -> str:
+    if mode not in VECTOR_INDEX_MODES:
+        raise ValueError(f"VECTOR_INDEX inválido: {mode} (use {', '.join(VECTOR_INDEX_MODES)})")
+    return mode
+
+
+def embed_kwargs() -> Dict[str, Any]:
+    """Argumentos extras de ``embeddings.create`` (dimensão reduzida)."""
+
+    return {"dimensions": EMBED_DIMENSIONS} if EMBED_DIMENSIONS > 0 else {}
+
+
+def _expr(mode: str, col: str, dim: int) -> str:
+    if mode == "halfvec":
+        return f"({col}::halfvec({dim}))"
+    if mode == "binary":
+        return f"(binary_quantize({col})::bit({dim}))"
+    return col
+
+
+def index_name(mode: str = VECTOR_INDEX, table: str = "docs") -> str:
+    """Nome do índice; partições de ``docs`` e ``chunks`` levam o nome da tabela como prefixo."""
+
+    name = INDEX_NAMES[_check(mode)]
+    return name if table == "docs" else f"{table}_{name[len('docs_'):]}"
+
+
+def index_sql(mode: str = VECTOR_INDEX, dim: int = EMBED_DIM, table: str = "docs") -> str:
+    ops = {"vector": "vector_cosine_ops", "halfvec": "halfvec_cosine_ops", "binary": "bit_hamming_ops"}
+    return (
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name(mode, table)} "
+        f"ON {table} USING hnsw ({_expr(mode, 'embedding', dim)} {ops[mode]})"
+    )
+
+
+def vector_cte(mode: str = VECTOR_INDEX, dim: int = EMBED_DIM, table: str = "docs", key: str = "id") -> str:
+    """CTE ``vectorial`` para ``SQL_BASE`` (com ``/*FILTERS*/`` e ``%(coarse)s``).
+
+    ``table``/``key`` trocam a origem (``chunks``/``chunk_hash`` no modo
+    endereçado por conteúdo); a coluna de saída continua sendo ``id``.
+    """
+
+    _check(mode)
+    if mode == "vector":
+        return f"""vectorial AS (
+  SELECT d.{key} AS id, 1 - (d.embedding <=> q.qvec) AS vscore
+  FROM {table} d, q
+  WHERE d.embedding IS NOT NULL /*FILTERS*/
+  ORDER BY d.embedding <=> q.qvec
+  LIMIT 300
+)"""
+    op = "<~>" if mode == "binary" else "<=>"
+    # A expressão do ORDER BY precisa ser idêntica à do índice para usá-lo.
+    return f"""coarse AS MATERIALIZED (
+  SELECT d.{key} AS id, d.embedding
+  FROM {table} d, q
+  WHERE d.embedding IS NOT NULL /*FILTERS*/
+  ORDER BY {_expr(mode, 'd.embedding', dim)} {op} {_expr(mode, 'q.qvec', dim)}
+  LIMIT %(coarse)s
+),
+vectorial AS (
+  SELECT c.id, 1 - (c.embedding <=> q.qvec) AS vscore
+  FROM coarse c, q
+  ORDER BY c.embedding <=> q.qvec
+  LIMIT 300
+)"""
+
+
+def knn_order(mode: str, col: str, qcol: str, dim: int = EMBED_DIM) -> str:
+    """Expressão de ``ORDER BY`` que usa o HNSW do modo (``col`` contra ``qcol``)."""
+
+    op = "<~>" if _check(mode) == "binary" else "<=>"
+    return f"{_expr(mode, col, dim)} {op} {_expr(mode, qcol, dim)}"
+
+
+def ef_search(mode: str = VECTOR_INDEX) -> int:
+    return 100 if mode == "vector" else max(100, RESCORE_CANDIDATES)
+
+
+def drop_indexes(conn: psycopg.Connection, table: str = "docs") -> None:
+    with conn.cursor() as cur:
+        for mode in VECTOR_INDEX_MODES:
+            cur.execute(f"DROP INDEX IF EXISTS {index_name(mode, table)};")
+    conn.commit()
+
+
+def create_index(conn: psycopg.Connection, mode: str = VECTOR_INDEX, table: str = "docs") -> None:
+    old = conn.autocommit
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute(index_sql(mode, table=table))
+    finally:
+        conn.autocommit = old
+
+
+def rebuild(mode: str = VECTOR_INDEX) -> Dict[str, Any]:
+    """Troca o índice HNSW para ``mode`` (remove os dos outros modos).
+
+    Com ``docs`` particionada, cada partição recebe o seu próprio índice; com
+    ``CHUNK_STORE=chunks`` o índice é o de ``chunks``.
+    """
+
+    import chunk_store
+    import partitions
+
+    _check(mode)
+    out = []
+    with psycopg.connect(DB_URL) as conn:
+        if chunk_store.enabled():
+            tables = ["chunks"]
+        else:
+            tables = [t for t, _ in partitions.list_partitions(conn)] or ["docs"]
+        for table in tables:
+            create_index(conn, mode, table)
+            with conn.cursor() as cur:
+                for other in VECTOR_INDEX_MODES:
+                    if other != mode:
+                        cur.execute(f"DROP INDEX IF EXISTS {index_name(other, table)};")
+                conn.commit()
+                cur.execute("SELECT pg_size_pretty(pg_relation_size(%s::regclass))", (index_name(mode, table),))
+                out.append({"index": index_name(mode, table), "size": cur.fetchone()[0]})
+    return {"ok": True, "mode": mode, "indexes": out}
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="Recriar o índice HNSW de docs.embedding")
+    ap.add_argument("--mode", choices=VECTOR_INDEX_MODES, default=VECTOR_INDEX)
+    a = ap.parse_args(argv)
+    print(json.dumps(rebuild(a.mode), ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover - CLI entry
+    sys.exit(main())
@@ -99,18 +99,13 @@ detect_api_url(){
   API_ENDPOINT="http://127.0.0.1:18888"
 }
 
-send_question(){
-  ensure_api_key
-  local q ans tmp
-  if command -v dialog >/dev/null 2>&1; then
-    dialog --inputbox "Digite sua pergunta" 12 78 "" 2>/.tmp.q || return
-    q="$(cat /.tmp.q)"
-  else
-    q=$(whiptail --inputbox "Digite sua pergunta" 12 78 --title "💬 Nova pergunta" 3>&1 1>&2 2>&3) || return
+# Cliente residente: um único processo Python por sessão, que reaproveita a
+# conexão HTTP com a API (ou responde localmente se ela estiver fora).
+start_client(){
+  if [[ -n "${CLIENT_PID:-}" ]] && kill -0 "$CLIENT_PID" 2>/dev/null; then
+    return
   fi
-  [[ -z "$q" ]] && return
-  log_line "Pergunta enviada: $q"
-  tmp="$(mktemp)"
+  detect_api_url
   cd "$APP"
   source .venv/bin/activate
   if [[ -f .env ]]; then
@@ -121,25 +116,41 @@ send_question(){
     set +a
     set -u
   fi
+  coproc SOPHIA_CLIENT { python -u "$APP/sophia_client.py" --api "$API_ENDPOINT" --json chat --session "$SESSION" 2>>"$CHAT_LOG"; }
+  CLIENT_PID=$SOPHIA_CLIENT_PID
+  log_line "Cliente residente iniciado (pid $CLIENT_PID, API $API_ENDPOINT)"
+}
+
+send_question(){
+  ensure_api_key
+  local q ans line
+  if command -v dialog >/dev/null 2>&1; then
+    dialog --inputbox "Digite sua pergunta" 12 78 "" 2>/.tmp.q || return
+    q="$(cat /.tmp.q)"
+  else
+    q=$(whiptail --inputbox "Digite sua pergunta" 12 78 --title "💬 Nova pergunta" 3>&1 1>&2 2>&3) || return
+  fi
+  q="${q//$'\n'/ }"
+  [[ -z "$q" ]] && return
+  log_line "Pergunta enviada: $q"
+  start_client
   show_progress "Consultando Sophia..."
-  python -u - "$SESSION" "$q" > "$tmp" 2>&1 <<'PY'
-import sys, json
-from search_chat import chat_respond
-ans, cites, qhash = chat_respond(sys.argv[1], sys.argv[2])
-print(json.dumps({"answer": ans, "cites": cites, "query_hash": qhash}, ensure_ascii=False))
-PY
-  if jq -e . >/dev/null 2>&1 <"$tmp"; then
-    LAST_RESULT_JSON="$(cat "$tmp")"
+  line=""
+  if printf '%s\n' "$q" >&"${SOPHIA_CLIENT[1]}"; then
+    IFS= read -r line <&"${SOPHIA_CLIENT[0]}" || line=""
+  fi
+  if [[ -n "$line" ]] && jq -e '.answer' >/dev/null 2>&1 <<<"$line"; then
+    LAST_RESULT_JSON="$line"
     ans="$(printf '%s' "$LAST_RESULT_JSON" | jq -r '.answer' 2>/dev/null)"
     log_line "Resposta recebida: ${ans//$'\n'/ }"
   else
     LAST_RESULT_JSON=""
-    ans="$(tail -n 200 "$tmp")"
+    ans="$(printf '%s' "$line" | jq -r '.error // empty' 2>/dev/null)"
+    [[ -z "$ans" ]] && ans="$(tail -n 20 "$CHAT_LOG")"
     log_line "Falha ao obter resposta: ${ans//$'\n'/ }"
   fi
   [[ -z "$ans" ]] && ans="(sem resposta / verifique logs)"
   show_box "🤖 Resposta" "$ans"
-  rm -f "$tmp"
 }
 
 choose_from_menu(){
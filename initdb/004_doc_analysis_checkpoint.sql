@@ -0,0 +1 @@
+ALTER TABLE doc_analysis ADD COLUMN IF NOT EXISTS source_hash TEXT;
@@ -0,0 +1,8 @@
+CREATE TABLE IF NOT EXISTS doc_analysis_parts (
+  group_hash TEXT PRIMARY KEY,
+  path TEXT NOT NULL,
+  group_no INT NOT NULL,
+  result JSONB NOT NULL,
+  created_at TIMESTAMPTZ DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS idx_dap_path ON doc_analysis_parts(path);
@@ -0,0 +1,2 @@
+CREATE INDEX IF NOT EXISTS idx_da_path_pattern ON doc_analysis (path text_pattern_ops);
+CREATE INDEX IF NOT EXISTS idx_da_created_id ON doc_analysis (created_at DESC, id DESC);
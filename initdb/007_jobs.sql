@@ -0,0 +1,18 @@
+CREATE TABLE IF NOT EXISTS jobs (
+  id BIGSERIAL PRIMARY KEY,
+  kind TEXT NOT NULL,
+  params JSONB NOT NULL DEFAULT '{}'::jsonb,
+  status TEXT NOT NULL DEFAULT 'queued',
+  progress REAL,
+  message TEXT,
+  result JSONB,
+  error TEXT,
+  cancel_requested BOOLEAN NOT NULL DEFAULT false,
+  worker TEXT,
+  created_at TIMESTAMPTZ DEFAULT now(),
+  started_at TIMESTAMPTZ,
+  heartbeat_at TIMESTAMPTZ,
+  finished_at TIMESTAMPTZ
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_queued ON jobs(kind, id) WHERE status = 'queued';
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, kind);
@@ -0,0 +1,15 @@
+CREATE TABLE IF NOT EXISTS model_calls (
+  id BIGSERIAL PRIMARY KEY,
+  model TEXT NOT NULL,
+  source TEXT NOT NULL,
+  query_hash TEXT,
+  shadow BOOLEAN NOT NULL DEFAULT false,
+  latency_ms INTEGER,
+  prompt_tokens INTEGER,
+  completion_tokens INTEGER,
+  error TEXT,
+  created_at TIMESTAMPTZ DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS idx_mc_model_created ON model_calls(model, created_at);
+CREATE INDEX IF NOT EXISTS idx_mc_query_hash ON model_calls(query_hash);
+CREATE INDEX IF NOT EXISTS idx_feedback_query_hash ON feedback(query_hash);
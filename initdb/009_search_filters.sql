@@ -0,0 +1,4 @@
+-- Filtros estruturados da busca híbrida (prefixo de caminho e doc_analysis).
+CREATE INDEX IF NOT EXISTS idx_docs_path_pattern ON docs(path text_pattern_ops);
+CREATE INDEX IF NOT EXISTS idx_da_orgao_data ON doc_analysis(orgao, data);
+CREATE INDEX IF NOT EXISTS idx_da_data ON doc_analysis(data);
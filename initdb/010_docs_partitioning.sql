@@ -0,0 +1,20 @@
+-- Funções usadas por app/partitions.py (migração opcional para docs particionada).
+-- docs_part replica partitions.partition_key: subárvore de 1º nível de DATA_DIR.
+CREATE OR REPLACE FUNCTION docs_part(p TEXT, root TEXT) RETURNS TEXT AS $$
+  SELECT CASE
+    WHEN root <> '' AND left(p, length(root) + 1) = root || '/' THEN
+      CASE WHEN position('/' IN substr(p, length(root) + 2)) > 0
+           THEN split_part(substr(p, length(root) + 2), '/', 1)
+           ELSE '_root' END
+    ELSE '_other'
+  END
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Substitui o ON DELETE CASCADE das FKs para docs(id), que não cabem na PK (id, part).
+CREATE OR REPLACE FUNCTION docs_cleanup_refs() RETURNS trigger AS $$
+BEGIN
+  DELETE FROM feedback WHERE doc_id = OLD.id;
+  DELETE FROM doc_analysis WHERE doc_id = OLD.id;
+  RETURN OLD;
+END
+$$ LANGUAGE plpgsql;
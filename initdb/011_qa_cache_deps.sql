@@ -0,0 +1,42 @@
+-- Índice reverso trecho -> respostas em cache: cada resposta guarda os trechos citados.
+CREATE TABLE IF NOT EXISTS qa_cache_deps (
+  qhash TEXT NOT NULL REFERENCES qa_cache(qhash) ON DELETE CASCADE,
+  doc_id BIGINT NOT NULL,
+  chunk_hash TEXT NOT NULL,
+  PRIMARY KEY (qhash, doc_id)
+);
+CREATE INDEX IF NOT EXISTS idx_qcd_doc ON qa_cache_deps(doc_id);
+CREATE INDEX IF NOT EXISTS idx_qcd_chunk_hash ON qa_cache_deps(chunk_hash);
+
+-- Trecho citado alterado (novo chunk_hash) ou removido invalida as respostas que o citam.
+CREATE OR REPLACE FUNCTION qa_cache_invalidate() RETURNS trigger AS $$
+BEGIN
+  DELETE FROM qa_cache c
+   USING qa_cache_deps x
+   WHERE x.qhash = c.qhash AND x.doc_id = OLD.id AND x.chunk_hash = OLD.chunk_hash;
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS docs_qa_cache_invalidate_tr ON docs;
+CREATE TRIGGER docs_qa_cache_invalidate_tr
+  AFTER UPDATE OF chunk_hash ON docs
+  FOR EACH ROW WHEN (OLD.chunk_hash IS DISTINCT FROM NEW.chunk_hash)
+  EXECUTE FUNCTION qa_cache_invalidate();
+DROP TRIGGER IF EXISTS docs_qa_cache_delete_tr ON docs;
+CREATE TRIGGER docs_qa_cache_delete_tr
+  AFTER DELETE ON docs
+  FOR EACH ROW EXECUTE FUNCTION qa_cache_invalidate();
+
+-- Respostas gravadas antes desta migração: dependências a partir de citations[].id;
+-- as que citam trechos que já não existem são descartadas.
+INSERT INTO qa_cache_deps(qhash, doc_id, chunk_hash)
+SELECT c.qhash, d.id, d.chunk_hash
+  FROM qa_cache c
+  CROSS JOIN LATERAL jsonb_array_elements(c.citations) e
+  JOIN docs d ON d.id = (e->>'id')::bigint
+ON CONFLICT DO NOTHING;
+DELETE FROM qa_cache c
+ WHERE jsonb_array_length(c.citations) = 0
+    OR jsonb_array_length(c.citations) >
+       (SELECT COUNT(*) FROM qa_cache_deps x WHERE x.qhash = c.qhash);
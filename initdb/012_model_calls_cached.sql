@@ -0,0 +1,2 @@
+-- Tokens do prompt servidos pelo cache do provedor (usage.prompt_tokens_details.cached_tokens).
+ALTER TABLE model_calls ADD COLUMN IF NOT EXISTS cached_tokens INTEGER;
@@ -0,0 +1,34 @@
+-- Perfil das execuções de app/ingest.py (app/ingest_stats.py).
+CREATE TABLE IF NOT EXISTS ingest_runs (
+  id BIGSERIAL PRIMARY KEY,
+  started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  finished_at TIMESTAMPTZ,
+  files INTEGER,
+  chunks INTEGER,
+  config JSONB NOT NULL DEFAULT '{}'::jsonb,
+  summary JSONB
+);
+
+-- Tempos por arquivo; hash/extract/chunk medidos no processo do pool, db no principal.
+CREATE TABLE IF NOT EXISTS ingest_file_stats (
+  run_id BIGINT NOT NULL REFERENCES ingest_runs(id) ON DELETE CASCADE,
+  path TEXT NOT NULL,
+  mode TEXT NOT NULL,
+  chunks INTEGER NOT NULL,
+  size_bytes BIGINT,
+  hash_ms INTEGER,
+  extract_ms INTEGER,
+  chunk_ms INTEGER,
+  db_ms INTEGER,
+  total_ms INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_ifs_run_total ON ingest_file_stats(run_id, total_ms DESC);
+
+CREATE TABLE IF NOT EXISTS ingest_embed_batches (
+  run_id BIGINT NOT NULL REFERENCES ingest_runs(id) ON DELETE CASCADE,
+  texts INTEGER NOT NULL,
+  tokens INTEGER NOT NULL,
+  latency_ms INTEGER NOT NULL,
+  created_at TIMESTAMPTZ DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS idx_ieb_run ON ingest_embed_batches(run_id);
@@ -0,0 +1,35 @@
+-- Grafo de vizinhos (kNN) entre trechos, mantido por app/chunk_graph.py.
+-- Nós são chunk_hash: cópias do mesmo texto são um nó só e um trecho alterado
+-- vira um nó novo, sem invalidar arestas antigas pelo id.
+CREATE TABLE IF NOT EXISTS chunk_graph_nodes (
+  chunk_hash TEXT PRIMARY KEY,
+  built_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS chunk_neighbors (
+  src_hash TEXT NOT NULL,
+  dst_hash TEXT NOT NULL,
+  sim REAL NOT NULL,
+  PRIMARY KEY (src_hash, dst_hash)
+);
+CREATE INDEX IF NOT EXISTS idx_cn_dst ON chunk_neighbors(dst_hash);
+CREATE INDEX IF NOT EXISTS idx_cn_sim ON chunk_neighbors(sim DESC);
+
+-- Resultado da comparação por LLM de cada par (a_hash < b_hash) de caminhos diferentes.
+CREATE TABLE IF NOT EXISTS chunk_divergences (
+  a_hash TEXT NOT NULL,
+  b_hash TEXT NOT NULL,
+  sim REAL NOT NULL,
+  a_path TEXT NOT NULL,
+  a_chunk INT NOT NULL,
+  b_path TEXT NOT NULL,
+  b_chunk INT NOT NULL,
+  divergent BOOLEAN NOT NULL,
+  topic TEXT,
+  views JSONB NOT NULL DEFAULT '[]'::jsonb,
+  model TEXT,
+  created_at TIMESTAMPTZ DEFAULT now(),
+  PRIMARY KEY (a_hash, b_hash)
+);
+CREATE INDEX IF NOT EXISTS idx_cd_b_hash ON chunk_divergences(b_hash);
+CREATE INDEX IF NOT EXISTS idx_cd_divergent ON chunk_divergences(created_at DESC) WHERE divergent;
@@ -1597,8 +1597,8 @@ send_question(){
   python -u - "$SESSION" "$q" > "$tmp" 2>&1 <<'PY'
 import sys, json
 from search_chat import chat_respond
-ans, cites = chat_respond(sys.argv[1], sys.argv[2])
-print(json.dumps({"answer":ans, "cites":cites}, ensure_ascii=False))
+ans, cites, qhash = chat_respond(sys.argv[1], sys.argv[2])
+print(json.dumps({"answer":ans, "cites":cites, "query_hash":qhash}, ensure_ascii=False))
 PY
   if jq -e . >/dev/null 2>&1 <"$tmp"; then ans="$(jq -r '.answer' "$tmp" 2>/dev/null)"; else ans="$(tail -n 200 "$tmp")"; fi
   [[ -z "$ans" ]] && ans="(sem resposta / verifique logs)"
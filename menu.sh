@@ -269,12 +269,7 @@ finetune_menu() {
         fi
         ;;
       R)
-        run_and_log "model_rollback" bash -c '
-          /opt/rag-sophia/app/.venv/bin/python -u /opt/rag-sophia/app/model_registry.py rollback && {
-            echo "Reiniciando sophia-api"
-            sudo systemctl restart sophia-api || true
-          }
-        '
+        run_and_log "model_rollback" /opt/rag-sophia/app/.venv/bin/python -u /opt/rag-sophia/app/model_registry.py rollback
         ;;
       B)
         return
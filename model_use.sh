@@ -5,5 +5,5 @@ MID="${1:-}"
 [[ -z "$MID" ]] && { echo "uso: $0 <model_id>"; exit 2; }
 cd "$BASE"
 source .venv/bin/activate
+# A API relê models.json a cada chamada (e recebe NOTIFY), sem reinício.
 python -u model_registry.py use "$MID"
-sudo systemctl restart sophia-api || true